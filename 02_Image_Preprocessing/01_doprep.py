@@ -1,76 +1,49 @@
 from esa_snappy import ProductIO, HashMap, GPF
-import os, gc, json, sys, time, datetime
+import os, gc, json, sys, time, datetime, tempfile
+import s1_graph
+import scene_cache
 
 ############################################ 
+def hashmap(params):
+    parameters = HashMap()
+    for key, value in params.items():
+        parameters.put(key, value)
+    return parameters
+
 def do_apply_orbit_file(source):
     print('\tApply orbit file...')
-    parameters = HashMap()
-    parameters.put('Apply-Orbit-File', True)
-    output = GPF.createProduct('Apply-Orbit-File', parameters, source)
+    output = GPF.createProduct('Apply-Orbit-File', hashmap(s1_graph.apply_orbit_file_parameters(s1_graph.DOPREP['orbit_type'])), source)
     return output
 
 def do_thermal_noise_removal(source):
     print('\tThermal noise removal...')
-    parameters = HashMap()
-    parameters.put('removeThermalNoise', True)
-    output = GPF.createProduct('ThermalNoiseRemoval', parameters, source)
+    output = GPF.createProduct('ThermalNoiseRemoval', hashmap(s1_graph.thermal_noise_removal_parameters()), source)
     return output
 
 def do_remove_grd_border_noise(source):
     print('\tRemove GRD border noise...')
-    parameters = HashMap()
-    parameters.put('Remove-GRD-Border-Noise', True)
-    #parameters.put('borderLimit', 500)
-    parameters.put('trimThreshold', .5)
-    output = GPF.createProduct('Remove-GRD-Border-Noise', parameters, source)
+    output = GPF.createProduct('Remove-GRD-Border-Noise', hashmap(s1_graph.remove_grd_border_noise_parameters()), source)
     return output
 
 def do_calibration(source, polarization, pols):
     print('\tCalibration...')
-    parameters = HashMap()
-    #parameters.put('outputSigmaBand', False)
-    parameters.put('outputBetaBand', False)
-    parameters.put('outputGammaBand', False)
-    if polarization == 'DH':
-        parameters.put('sourceBands', 'Intensity_HH,Intensity_HV')
-    elif polarization == 'DV':
-        parameters.put('sourceBands', 'Intensity_VH,Intensity_VV')
-    elif polarization == 'SH' or polarization == 'HH':
-        parameters.put('sourceBands', 'Intensity_HH')
-    elif polarization == 'SV':
-        parameters.put('sourceBands', 'Intensity_VV')
-    else:
-        print("different polarization!")
-    parameters.put('selectedPolarisations', pols)
-    parameters.put('outputImageScaleInDb', False)
-    output = GPF.createProduct("Calibration", parameters, source)
+    output = GPF.createProduct("Calibration", hashmap(s1_graph.calibration_parameters(polarization, pols)), source)
     return output
 
 def do_speckle_filtering(source):
     print('\tSpeckle filtering...')
-    parameters = HashMap()
-    parameters.put('filter', 'Refined Lee')
-    #parameters.put('filterSizeX', 3)
-    #parameters.put('filterSizeY', 3)
-    output = GPF.createProduct('Speckle-Filter', parameters, source)
+    output = GPF.createProduct('Speckle-Filter', hashmap(s1_graph.speckle_filtering_parameters()), source)
     return output
 
 def do_terrain_correction(source, downsample):
     print('\tTerrain correction...')
-    parameters = HashMap()
-    parameters.put('demName', 'Copernicus 30m Global DEM')
-    parameters.put('imgResamplingMethod', 'BICUBIC_INTERPOLATION')
-    parameters.put('saveProjectedLocalIncidenceAngle', False)
-    parameters.put('saveSelectedSourceBand', True)
-    if downsample == 1:
-        parameters.put('pixelSpacingInMeter', 20.0)
-    output = GPF.createProduct('Terrain-Correction', parameters, source)
+    parameters = s1_graph.terrain_correction_parameters(downsample, s1_graph.DOPREP['map_projection'], s1_graph.DOPREP['resampling'])
+    output = GPF.createProduct('Terrain-Correction', hashmap(parameters), source)
     return output
 
 def lineartodb(source):
     print('\tLinear to DB Conversion...')
-    parameters = HashMap()
-    output = GPF.createProduct('LinearToFromdB', parameters, source)
+    output = GPF.createProduct('LinearToFromdB', hashmap(s1_graph.lineartodb_parameters()), source)
     return output
 
 def do_operate(input,output):
@@ -82,18 +55,7 @@ def do_operate(input,output):
     loopstarttime=str(datetime.datetime.now())
     print('Start time:', loopstarttime)
     start_time = time.time()
-    filename=input.split('/')[-1].split('_')
-    polarization=filename[3][2:]
-    if polarization == 'DV':
-        pols = 'VH,VV'
-    elif polarization == 'DH':
-        pols = 'HH,HV'
-    elif polarization == 'SH' or polarization == 'HH':
-        pols = 'HH'
-    elif polarization == 'SV':
-        pols = 'VV'
-    else:
-        print("Polarization error!")
+    polarization, pols = s1_graph.scene_polarization(input)
     applyorbit = do_apply_orbit_file(sentinel_1)
     thermaremoved = do_thermal_noise_removal(applyorbit)
     grdborder = do_remove_grd_border_noise(thermaremoved)
@@ -114,17 +76,56 @@ def do_operate(input,output):
     print("--- %s seconds ---" % (time.time() - start_time))
     print("=============================================")
 
-def do_check(filename):
+def do_operate_gpt(input, output, parallelism=None, cache_size=None):
+    # Same chain as do_operate, run as one SNAP graph through gpt
+    print("=============================================")
+    print('Start time:', str(datetime.datetime.now()))
+    seconds = s1_graph.process_gpt(input, output, 'GeoTIFF', s1_graph.DOPREP, parallelism, cache_size)
+    print("--- %s seconds ---" % seconds)
+    print("=============================================")
+
+def do_cached(input, output, backend='snappy', parallelism=None, cache_size=None, cache_root=scene_cache.CACHE_DIR):
+    # Product comes from the scene cache (computed on a miss) and is linked to output.
+    # An output already there (processed before the cache, raw zip removed) is kept as it is.
+    if os.path.isfile(output+'.tif'):
+        return False
+    def produce(base):
+        if backend == 'gpt':
+            do_operate_gpt(input, base, parallelism, cache_size)
+        else:
+            do_operate(input, base)
+    steps=scene_cache.scene_steps(input, s1_graph.DOPREP)
+    base, produced=scene_cache.fetch(input, steps, 'GeoTIFF', produce, root=cache_root)
+    scene_cache.publish(base, 'GeoTIFF', output, root=cache_root)
+    return produced
+
+def do_check(filename, backend='snappy', parallelism=None, cache_size=None):
     input='/data/ksa/01_Image_Acquisition/01_Raw_Image/'+filename.split('-')[0]+'.zip'
     output=input.replace('01_Raw_Image','02_Processed_Image').replace('.zip','')
-    if os.path.isfile(output+'.tif'):
-        print('File has been processed. Skip')
-    else:
-        do_operate(input,output)
+    if do_cached(input, output, backend, parallelism, cache_size):
         os.remove(input)
-    
+    else:
+        print('File has been processed. Skip')
+
+def benchmark(input, parallelism=None, cache_size=None):
+    # Time one scene through both backends, to pick the faster one for this host
+    outdir=tempfile.mkdtemp(dir=os.path.dirname(input))
+    output=os.path.join(outdir, os.path.basename(input).replace('.zip',''))
+    start_time = time.time()
+    do_operate(input, output+'_snappy')
+    snappy_seconds = time.time() - start_time
+    start_time = time.time()
+    do_operate_gpt(input, output+'_gpt', parallelism, cache_size)
+    gpt_seconds = time.time() - start_time
+    print('snappy --- %s seconds ---' % snappy_seconds)
+    print('gpt -q %s -c %s --- %s seconds ---' % (parallelism, cache_size, gpt_seconds))
+    print('Outputs in', outdir)
+
 def main():
     kdprov=sys.argv[1]
+    backend=sys.argv[2] if len(sys.argv)>2 else 'snappy'
+    parallelism=sys.argv[3] if len(sys.argv)>3 else None
+    cache_size=sys.argv[4] if len(sys.argv)>4 else None
     metadata='/data/ksa/01_Image_Acquisition/04_Json_Raw_Download/'+kdprov+'_metadata_ASF.json'
     with open(metadata,'r') as f:
         dt_prov=json.load(f)
@@ -133,11 +134,13 @@ def main():
         print('*********************************************************')
         print('File: ',i,'/',len(dt_prov['features'])-1)
         print('Start for ',file_name)
-        do_check(file_name)
+        do_check(file_name, backend, parallelism, cache_size)
         print('Finish ')
         print('*********************************************************')
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1] == 'benchmark':
+        benchmark(sys.argv[2], *sys.argv[3:5])
+    else:
+        main()
 
-        
\ No newline at end of file
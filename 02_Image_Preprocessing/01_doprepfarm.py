@@ -0,0 +1,190 @@
+import importlib
+import importlib.util
+import multiprocessing as mp
+from collections import deque, Counter
+from queue import Empty
+import os, json, sys, time, tempfile
+
+RAW_DIR = '/data/ksa/01_Image_Acquisition/01_Raw_Image'
+PROCESSED_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_Image'
+STUB_BACKEND = 'snappy_stub'
+
+############################################
+# Worker side: one spawned process = one JVM
+def load_doprep(backend):
+    # esa_snappy reads _JAVA_OPTIONS when its JVM starts, so this must run before the import.
+    # A stub backend is installed under the esa_snappy name so 01_doprep imports it unchanged.
+    if backend != 'esa_snappy':
+        sys.modules['esa_snappy'] = importlib.import_module(backend)
+    spec = importlib.util.spec_from_file_location('doprep', os.path.join(os.path.dirname(os.path.abspath(__file__)), '01_doprep.py'))
+    doprep = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(doprep)
+    return doprep
+
+def set_tile_cache(tile_cache_mb):
+    snappy = sys.modules['esa_snappy']
+    try:
+        JAI = snappy.jpy.get_type('javax.media.jai.JAI')
+        JAI.getDefaultInstance().getTileCache().setMemoryCapacity(tile_cache_mb * 1024 * 1024)
+    except Exception as e:
+        print('Tile cache not set:', e)
+
+def process_scene(doprep, file_name, config):
+    # Same as 01_doprep.do_check with configurable folders; products go through the scene cache
+    input = os.path.join(config['raw_dir'], file_name.split('-')[0] + '.zip')
+    output = os.path.join(config['processed_dir'], file_name.split('-')[0])
+    if not doprep.do_cached(input, output, backend=config['backend'], cache_root=config['cache_dir']):
+        print('File has been processed. Skip')
+        return 'skipped'
+    if config['remove_raw']:
+        os.remove(input)
+    return 'done'
+
+def worker_main(inbox, results, config):
+    os.environ['_JAVA_OPTIONS'] = f"-Xmx{config['heap']}"
+    pid = os.getpid()
+    doprep = load_doprep(config['backend'])
+    if config['tile_cache_mb']:
+        set_tile_cache(config['tile_cache_mb'])
+    while True:
+        file_name = inbox.get()
+        if file_name is None:
+            break
+        start_time = time.time()
+        try:
+            status = process_scene(doprep, file_name, config)
+            results.put((pid, file_name, status, time.time() - start_time, None))
+        except Exception as e:
+            results.put((pid, file_name, 'failed', time.time() - start_time, repr(e)))
+
+############################################
+# Scheduler side
+class Worker:
+    def __init__(self, ctx, results, config):
+        self.inbox = ctx.Queue()
+        self.process = ctx.Process(target=worker_main, args=(self.inbox, results, config), daemon=True)
+        self.process.start()
+        self.current = None
+        self.count = 0
+
+    def send(self, file_name):
+        self.current = file_name
+        self.inbox.put(file_name)
+
+    def stop(self):
+        self.inbox.put(None)
+        self.process.join()
+
+def run_farm(scenes, n_workers=4, heap='16G', tile_cache_mb=4096, recycle_after=10, max_attempts=3,
+             backend='esa_snappy', raw_dir=RAW_DIR, processed_dir=PROCESSED_DIR, remove_raw=True, cache_dir=None):
+    # Scenes are handed one at a time to idle workers. A worker is restarted after
+    # recycle_after scenes (JVM memory never fully comes back) or when it dies; a scene
+    # whose worker failed or died is queued again until max_attempts. The scene cache sits
+    # next to processed_dir (03_Scene_Cache) unless cache_dir is given.
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(processed_dir)), '03_Scene_Cache')
+    config = {'heap': heap, 'tile_cache_mb': tile_cache_mb, 'backend': backend,
+              'raw_dir': raw_dir, 'processed_dir': processed_dir, 'remove_raw': remove_raw, 'cache_dir': cache_dir}
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    pending = deque(scenes)
+    attempts = Counter()
+    report = {}
+    workers = {}
+
+    def spawn():
+        w = Worker(ctx, results, config)
+        workers[w.process.pid] = w
+
+    def finish(file_name, status, seconds, error):
+        attempts[file_name] += 1
+        report[file_name] = {'status': status, 'attempts': attempts[file_name], 'seconds': seconds, 'error': error}
+        if status == 'failed' and attempts[file_name] < max_attempts:
+            pending.append(file_name)
+        print(f'[{len(report)}/{len(scenes)}] {file_name} {status} ({attempts[file_name]}) --- {seconds:.1f} seconds ---')
+
+    for _ in range(min(n_workers, len(pending))):
+        spawn()
+    while pending or any(w.current is not None for w in workers.values()):
+        for w in workers.values():
+            if w.current is None and pending:
+                w.send(pending.popleft())
+        try:
+            pid, file_name, status, seconds, error = results.get(timeout=5)
+        except Empty:
+            for pid, w in list(workers.items()):
+                if not w.process.is_alive():
+                    print(f'Worker {pid} died with exit code {w.process.exitcode}')
+                    del workers[pid]
+                    if w.current is not None:
+                        finish(w.current, 'failed', 0.0, f'worker exit code {w.process.exitcode}')
+                    if pending or len(workers) == 0:
+                        spawn()
+            continue
+        finish(file_name, status, seconds, error)
+        w = workers.get(pid)
+        if w is None:
+            continue
+        w.current = None
+        w.count += 1
+        if w.count >= recycle_after:
+            w.stop()
+            del workers[pid]
+            if pending:
+                spawn()
+    for w in workers.values():
+        w.stop()
+    return report
+
+############################################
+# Self-test with the stub backend in a temporary raw/processed/cache folder
+def selftest(n_scenes=8, n_workers=2, recycle_after=3):
+    # Stub products are fake: they never go to RAW_DIR/PROCESSED_DIR and raw zips are kept.
+    # A second run over the same folders must skip every scene through the cache.
+    scratch = tempfile.mkdtemp(prefix='doprepfarm_stub_')
+    raw_dir, processed_dir, cache_dir = [os.path.join(scratch, d) for d in ('01_Raw_Image', '02_Processed_Image', '03_Scene_Cache')]
+    for d in (raw_dir, processed_dir):
+        os.makedirs(d)
+    scenes = [f'S1A_IW_GRDH_STUB_{i:03d}-GRD_HD' for i in range(n_scenes)]
+    for file_name in scenes:
+        open(os.path.join(raw_dir, file_name.split('-')[0] + '.zip'), 'w').close()
+    print('Stub backend: raw, processed and cache folders in', scratch)
+    ok = True
+    for run, expected in [(1, 'done'), (2, 'skipped')]:
+        start_time = time.time()
+        report = run_farm(scenes, n_workers=n_workers, recycle_after=recycle_after, backend=STUB_BACKEND,
+                          raw_dir=raw_dir, processed_dir=processed_dir, remove_raw=False, cache_dir=cache_dir)
+        status = Counter(v['status'] for v in report.values())
+        print('Run', run, dict(status), "--- %s seconds ---" % (time.time() - start_time))
+        ok = ok and status[expected] == len(scenes)
+    ok = ok and all(os.path.isfile(os.path.join(processed_dir, s.split('-')[0] + '.tif')) for s in scenes)
+    ok = ok and len(os.listdir(raw_dir)) == len(scenes)
+    print('Self-test passed:', ok)
+    return ok
+
+def main():
+    kdprov=sys.argv[1]
+    n_workers=int(sys.argv[2]) if len(sys.argv)>2 else 4
+    heap=sys.argv[3] if len(sys.argv)>3 else '16G'
+    recycle_after=int(sys.argv[4]) if len(sys.argv)>4 else 10
+    backend=sys.argv[5] if len(sys.argv)>5 else 'esa_snappy'
+    if backend==STUB_BACKEND:
+        sys.exit('The stub backend only runs through: python 01_doprepfarm.py selftest [scenes] [workers]')
+    metadata='/data/ksa/01_Image_Acquisition/04_Json_Raw_Download/'+kdprov+'_metadata_ASF.json'
+    with open(metadata,'r') as f:
+        dt_prov=json.load(f)
+    scenes=[i['properties']['fileID'] for i in dt_prov['features']]
+    print('*********************************************************')
+    print('Preprocessing farm for PROV:',kdprov,'scenes:',len(scenes),'workers:',n_workers,'heap:',heap)
+    start_time=time.time()
+    report=run_farm(scenes, n_workers=n_workers, heap=heap, recycle_after=recycle_after, backend=backend)
+    failed=[k for k,v in report.items() if v['status']=='failed']
+    print('Failed:',failed)
+    print("--- %s seconds ---" % (time.time() - start_time))
+    print('*********************************************************')
+
+if __name__ == "__main__":
+    if sys.argv[1] == 'selftest':
+        selftest(*[int(a) for a in sys.argv[2:4]])
+    else:
+        main()
@@ -1,84 +1,93 @@
 import datetime
 import time
 from esa_snappy import ProductIO, HashMap, GPF, ProductUtils,jpy
-import os, gc
+import os, gc, shutil
 from shapely import wkt
 import geopandas as gpd
 import json
 from esa_snappy import GPF
 import sys
+import s1_graph
+import scene_cache
+
+# Full-scene products written before the scene cache, reused instead of preprocessing again
+PROCESSED_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_Image_rev'
+
+def hashmap(params):
+    parameters = HashMap()
+    for key, value in params.items():
+        parameters.put(key, value)
+    return parameters
 
 def do_apply_orbit_file(source):
     print('\tApply orbit file...')
-    parameters = HashMap()
-    parameters.put('Apply-Orbit-File', True)
-    parameters.put('orbitType', 'Sentinel Precise (Auto Download)')
-    parameters.put('continueOnFail', True)
-    output = GPF.createProduct('Apply-Orbit-File', parameters, source)
+    output = GPF.createProduct('Apply-Orbit-File', hashmap(s1_graph.apply_orbit_file_parameters(s1_graph.DOPREPMOSAIC['orbit_type'])), source)
     return output
 
 def do_thermal_noise_removal(source):
     print('\tThermal noise removal...')
-    parameters = HashMap()
-    parameters.put('removeThermalNoise', True)
-    output = GPF.createProduct('ThermalNoiseRemoval', parameters, source)
+    output = GPF.createProduct('ThermalNoiseRemoval', hashmap(s1_graph.thermal_noise_removal_parameters()), source)
     return output
 
 def do_remove_grd_border_noise(source):
     print('\tRemove GRD border noise...')
-    parameters = HashMap()
-    parameters.put('Remove-GRD-Border-Noise', True)
-    parameters.put('trimThreshold', 0.5)
-    output = GPF.createProduct('Remove-GRD-Border-Noise', parameters, source)
+    output = GPF.createProduct('Remove-GRD-Border-Noise', hashmap(s1_graph.remove_grd_border_noise_parameters()), source)
     return output
 
 def do_calibration(source, polarization, pols):
     print('\tCalibration...')
-    parameters = HashMap()
-    parameters.put('outputBetaBand', False)
-    parameters.put('outputGammaBand', False)
-    if polarization == 'DH':
-        parameters.put('sourceBands', 'Intensity_HH,Intensity_HV')
-    elif polarization == 'DV':
-        parameters.put('sourceBands', 'Intensity_VH,Intensity_VV')
-    elif polarization == 'SH' or polarization == 'HH':
-        parameters.put('sourceBands', 'Intensity_HH')
-    elif polarization == 'SV':
-        parameters.put('sourceBands', 'Intensity_VV')
-    else:
-        print("different polarization!")
-    parameters.put('selectedPolarisations', pols)
-    parameters.put('outputImageScaleInDb', False)
-    output = GPF.createProduct("Calibration", parameters, source)
+    output = GPF.createProduct("Calibration", hashmap(s1_graph.calibration_parameters(polarization, pols)), source)
+    return output
+
+def do_subset(source, region):
+    print('\tSubset to AOI...')
+    output = GPF.createProduct('Subset', hashmap(s1_graph.subset_parameters(region)), source)
     return output
 
 def do_speckle_filtering(source):
     print('\tSpeckle filtering...')
-    parameters = HashMap()
-    parameters.put('filter', 'Refined Lee')
-    output = GPF.createProduct('Speckle-Filter', parameters, source)
+    output = GPF.createProduct('Speckle-Filter', hashmap(s1_graph.speckle_filtering_parameters()), source)
     return output
 
 def do_terrain_correction(source, downsample):
     print('\tTerrain correction...')
-    parameters = HashMap()
-    parameters.put('demName', 'Copernicus 30m Global DEM')
-    parameters.put('mapProjection', 'EPSG:3857')
-    parameters.put('imgResamplingMethod', 'BILINEAR_INTERPOLATION')
-    parameters.put('saveProjectedLocalIncidenceAngle', False)
-    parameters.put('saveSelectedSourceBand', True)
-    if downsample == 1:
-        parameters.put('pixelSpacingInMeter', 20.0)
-    output = GPF.createProduct('Terrain-Correction', parameters, source)
+    parameters = s1_graph.terrain_correction_parameters(downsample, s1_graph.DOPREPMOSAIC['map_projection'], s1_graph.DOPREPMOSAIC['resampling'])
+    output = GPF.createProduct('Terrain-Correction', hashmap(parameters), source)
     return output
 
 def lineartodb(source):
     print('\tLinear to DB Conversion...')
-    parameters = HashMap()
-    output = GPF.createProduct('LinearToFromdB', parameters, source)
+    output = GPF.createProduct('LinearToFromdB', hashmap(s1_graph.lineartodb_parameters()), source)
     return output
 
-def preprocessing(image_in):
+def preprocessing_gpt(image_in, image_out, parallelism=None, cache_size=None, region=None):
+    # Same chain as preprocessing_snappy, run as one SNAP graph through gpt
+    print("--------------------------------------------")
+    print('Preprocessing Begin (gpt)')
+    seconds=s1_graph.process_gpt(image_in, image_out, 'BEAM-DIMAP', s1_graph.DOPREPMOSAIC, parallelism, cache_size, region=region)
+    print("--- %s seconds ---" % seconds)
+    print('Finshed')
+    print("--------------------------------------------")
+
+def preprocessing(image_in, backend='snappy', parallelism=None, cache_size=None, region=None, quota_gb=scene_cache.QUOTA_GB, cache_root=scene_cache.CACHE_DIR, processed_dir=PROCESSED_DIR):
+    # Path (without .dim) of the preprocessed scene in the scene cache, computed on a miss.
+    # region: WKT (EPSG:4326) the scene is cut to after calibration, None keeps the full scene.
+    # quota_gb=None: no cache eviction here (01_mosaicscheduler evicts itself)
+    # On a miss a full-scene product already in processed_dir is linked into the cache instead.
+    def produce(image_out):
+        existing = f'{processed_dir}/{scene_cache.scene_id(image_in)}'
+        if region is None and os.path.exists(existing + '.dim') and os.path.isdir(existing + '.data'):
+            print('Seeding cache from', existing + '.dim')
+            scene_cache.link_product(existing, 'BEAM-DIMAP', image_out)
+        elif backend == 'gpt':
+            preprocessing_gpt(image_in, image_out, parallelism, cache_size, region)
+        else:
+            preprocessing_snappy(image_in, image_out, region)
+    steps=scene_cache.scene_steps(image_in, s1_graph.DOPREPMOSAIC, region)
+    base, produced=scene_cache.fetch(image_in, steps, 'BEAM-DIMAP', produce, root=cache_root, quota_gb=quota_gb)
+    return base
+
+def preprocessing_snappy(image_in, image_out, region=None):
     print("--------------------------------------------")
     print('Preprocessing Begin')
     gc.enable()
@@ -88,23 +97,13 @@ def preprocessing(image_in):
     loopstarttime=str(datetime.datetime.now())
     print('Start time:', loopstarttime)
     start_time = time.time()
-    filename=image_in.split('/')[-1].split('_')
-    image_out=image_in.replace('01_Raw_Image','02_Processed_Image_rev').replace('.zip','')
-    polarization=filename[3][2:]
-    if polarization == 'DV':
-        pols = 'VH,VV'
-    elif polarization == 'DH':
-        pols = 'HH,HV'
-    elif polarization == 'SH' or polarization == 'HH':
-        pols = 'HH'
-    elif polarization == 'SV':
-        pols = 'VV'
-    else:
-        print("Polarization error!")
+    polarization, pols = s1_graph.scene_polarization(image_in)
     applyorbit = do_apply_orbit_file(sentinel_1)
     thermaremoved = do_thermal_noise_removal(applyorbit)
     grdborder = do_remove_grd_border_noise(thermaremoved)
     calibrated = do_calibration(grdborder, polarization, pols)
+    if region is not None:
+        calibrated = do_subset(calibrated, region)
     down_speckled=do_speckle_filtering(calibrated)
     down_corrected=do_terrain_correction(down_speckled,1)
     convert=lineartodb(down_corrected)
@@ -129,7 +128,12 @@ def create_folder_if_not_exist(folder_path):
     else:
         print(f"Folder '{folder_path}' already exists.")
 
-def mosaicing(list_sources,bound,wkt_bounds,outflnm):
+def mosaicing(list_sources,bound,wkt_bounds,outflnm,opened=None):
+    # list_sources: preprocessed products without the .dim extension.
+    # opened: optional {path: Product} kept by the caller across mosaics; products found there
+    # are reused, new ones are added and none of them are disposed here.
+    # The product is written in a hidden folder next to outflnm and moved into place when
+    # complete (.data first, .dim last), so outflnm.dim only exists for a finished mosaic.
     print('==========================================================')
     print('Mosaicking Process Begin')
     loopstarttime=str(datetime.datetime.now())
@@ -153,7 +157,12 @@ def mosaicing(list_sources,bound,wkt_bounds,outflnm):
         parameters.put('eastBound',bound[2])
     
         for i in range(len(list_sources)):
-            p=ProductIO.readProduct('/data/ksa/01_Image_Acquisition/02_Processed_Image_rev/'+list_sources[i]+'.dim')
+            if opened is not None and list_sources[i] in opened:
+                p=opened[list_sources[i]]
+            else:
+                p=ProductIO.readProduct(list_sources[i]+'.dim')
+                if opened is not None:
+                    opened[list_sources[i]]=p
             products[i]=p
         if len(list_sources)>0:
             band_names = products[0].getBandNames()
@@ -169,10 +178,25 @@ def mosaicing(list_sources,bound,wkt_bounds,outflnm):
         parameters.put('geoRegion', wkt_bounds)
         output = GPF.createProduct('Subset', parameters, output)
 
-        ProductIO.writeProduct(output, outflnm, 'BEAM-DIMAP')
-        for i in range(len(list_sources)):
-            products[i].dispose()
-            products[i].closeIO()
+        folder, name = os.path.split(outflnm)
+        tmp = f'{folder}/.{name}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        try:
+            ProductIO.writeProduct(output, f'{tmp}/{name}', 'BEAM-DIMAP')
+            # The .dim refers to its band files as {name}.data/..., so both keep their name
+            if os.path.lexists(outflnm + '.dim'):
+                os.remove(outflnm + '.dim')
+            shutil.rmtree(outflnm + '.data', ignore_errors=True)
+            if os.path.isdir(f'{tmp}/{name}.data'):
+                os.replace(f'{tmp}/{name}.data', outflnm + '.data')
+            os.replace(f'{tmp}/{name}.dim', outflnm + '.dim')
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if opened is None:
+            for i in range(len(list_sources)):
+                products[i].dispose()
+                products[i].closeIO()
         del output
     else:
         print('Encounter missing acquisition!!!')
@@ -180,7 +204,8 @@ def mosaicing(list_sources,bound,wkt_bounds,outflnm):
     print("Finished")
     print('==========================================================')
 
-def run_mosaic(dict_mosaic):
+def run_mosaic(dict_mosaic, backend='snappy', parallelism=None, cache_size=None, aoi=None):
+    # aoi: {scene: WKT} from s1_graph.scene_aoi; scenes are then preprocessed as subsets
     print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
     print('PREPROCESSING FOLLOWED BY MOSAICKING FOR ID:',dict_mosaic['id'])
     create_folder_if_not_exist('/data/ksa/01_Image_Acquisition/02_Processed_mosaic/'+dict_mosaic['id'])
@@ -194,23 +219,35 @@ def run_mosaic(dict_mosaic):
         print('PERIODE ',start_periode,'-',end_periode)
         outflnm='/data/ksa/01_Image_Acquisition/02_Processed_mosaic/'+dict_mosaic['id']+'/'+start_periode.replace('-','')+'_'+end_periode.replace('-','')
         list_sources= period_dict[i]['image_asf']
+        list_products=[]
         for j in list_sources:
-            if not os.path.exists('/data/ksa/01_Image_Acquisition/02_Processed_Image_rev/'+j+'.dim'):
-                preprocessing('/data/ksa/01_Image_Acquisition/01_Raw_Image/'+j+'.zip')
-        mosaicing(list_sources,total_bounds,wkt_bounds,outflnm)
+            region=None if aoi is None else aoi.get(j)
+            list_products.append(preprocessing('/data/ksa/01_Image_Acquisition/01_Raw_Image/'+j+'.zip', backend, parallelism, cache_size, region))
+        mosaicing(list_products,total_bounds,wkt_bounds,outflnm)
         #break
     print('FINISHED')
     print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')  
 
 def main():
     kdprov=sys.argv[1]
+    backend=sys.argv[2] if len(sys.argv)>2 else 'snappy'
+    # '-' keeps the gpt default for q / cache
+    parallelism=sys.argv[3] if len(sys.argv)>3 and sys.argv[3]!='-' else None
+    cache_size=sys.argv[4] if len(sys.argv)>4 and sys.argv[4]!='-' else None
+    subset=len(sys.argv)>5 and sys.argv[5]=='subset'
     metadata='/data/ksa/01_Image_Acquisition/05_Json_Coverage/32_coverage_ASF.json'
     with open(metadata,'r') as f:
         dt_prov=json.load(f)
+    aoi=None
+    if subset:
+        with open('/data/ksa/01_Image_Acquisition/04_Json_Raw_Download/'+kdprov+'_metadata_ASF.json','r') as f:
+            footprints=s1_graph.scene_footprints(json.load(f))
+        aoi=s1_graph.scene_aoi(dt_prov, footprints)
+        print('Scenes subset to AOI:',len(aoi))
     for i in range(0,len(dt_prov)):
         print('*********************************************************')
         print('Preprocessing followed by mosaic begin for PROV:',kdprov)
-        run_mosaic(dt_prov[i])
+        run_mosaic(dt_prov[i], backend, parallelism, cache_size, aoi)
         print('*********************************************************')
         
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+import importlib
+import importlib.util
+import multiprocessing as mp
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from shapely import wkt
+import os, json, sys, time
+import s1_graph
+import scene_cache
+import cog_export
+
+RAW_DIR = '/data/ksa/01_Image_Acquisition/01_Raw_Image'
+MOSAIC_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_mosaic'
+COVERAGE_DIR = '/data/ksa/01_Image_Acquisition/05_Json_Coverage'
+METADATA_DIR = '/data/ksa/01_Image_Acquisition/04_Json_Raw_Download'
+
+############################################
+# Plan: scene -> (tile, period) dependencies from the coverage json
+def build_plan(coverage, aoi=None, mosaic_dir=MOSAIC_DIR, cache_root=scene_cache.CACHE_DIR):
+    # Mosaics are ordered by period then tile, so neighbouring tiles of one period (which share
+    # scenes) are built one after another. Mosaics already on disk are left out, and so are
+    # scenes only they needed. mosaicing moves the .dim into place only once the mosaic is
+    # complete, so its presence marks a finished mosaic.
+    mosaics = []
+    for dict_mosaic in coverage:
+        geometry = wkt.loads(dict_mosaic['geometry'])
+        for periode in dict_mosaic['periode']:
+            start_periode, end_periode = periode['start_periode'], periode['end_periode']
+            outflnm = f"{mosaic_dir}/{dict_mosaic['id']}/{start_periode.replace('-','')}_{end_periode.replace('-','')}"
+            mosaics.append({'id': dict_mosaic['id'], 'start_periode': start_periode, 'end_periode': end_periode,
+                            'outflnm': outflnm, 'bound': list(geometry.bounds), 'wkt': geometry.wkt,
+                            'scenes': list(periode['image_asf']), 'done': os.path.exists(outflnm + '.dim')})
+    mosaics.sort(key=lambda m: (m['start_periode'], m['id']))
+    scenes = OrderedDict()
+    for i, m in enumerate(mosaics):
+        if m['done']:
+            continue
+        for scene in m['scenes']:
+            if scene not in scenes:
+                region = None if aoi is None else aoi.get(scene)
+                steps = scene_cache.scene_steps(scene, s1_graph.DOPREPMOSAIC, region)
+                scenes[scene] = {'region': region, 'mosaics': [],
+                                 'cached': scene_cache.contains(scene, steps, 'BEAM-DIMAP', cache_root)}
+            scenes[scene]['mosaics'].append(i)
+    return {'mosaics': mosaics, 'scenes': scenes}
+
+def print_plan(plan, n_workers, scene_minutes=15, mosaic_minutes=5):
+    mosaics = plan['mosaics']
+    scenes = plan['scenes']
+    todo = [m for m in mosaics if not m['done']]
+    missing = [s for s, v in scenes.items() if not v['cached']]
+    shared = sum(1 for v in scenes.values() if len(v['mosaics']) > 1)
+    refs = sum(len(v['mosaics']) for v in scenes.values())
+    print('Mosaics:', len(mosaics), 'done:', len(mosaics) - len(todo), 'to build:', len(todo))
+    print('Scenes needed:', len(scenes), 'cached:', len(scenes) - len(missing), 'to preprocess:', len(missing))
+    print('Scene references:', refs, 'shared scenes:', shared, '(each scene is preprocessed once)')
+    print('Empty mosaics (no acquisition):', sum(1 for m in todo if len(m['scenes']) == 0))
+    minutes = len(missing) * scene_minutes + len(todo) * mosaic_minutes
+    print('Estimated work: %.1f h serial, %.1f h on %s workers' % (minutes / 60, minutes / 60 / n_workers, n_workers))
+    for m in todo:
+        print('\t', m['start_periode'], m['id'], len(m['scenes']), 'scenes,', sum(1 for s in m['scenes'] if not scenes[s]['cached']), 'to preprocess')
+
+############################################
+# Worker side: one spawned process = one JVM
+MOSAIC = None
+OPENED = OrderedDict()
+
+def init_worker(heap, snappy_module):
+    # esa_snappy reads _JAVA_OPTIONS when its JVM starts, so this must run before the import
+    global MOSAIC
+    os.environ['_JAVA_OPTIONS'] = f'-Xmx{heap}'
+    if snappy_module != 'esa_snappy':
+        sys.modules['esa_snappy'] = importlib.import_module(snappy_module)
+    spec = importlib.util.spec_from_file_location('doprepmosaic', os.path.join(os.path.dirname(os.path.abspath(__file__)), '01_doprepmosaic.py'))
+    MOSAIC = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(MOSAIC)
+
+def preprocess_task(scene, region, backend, parallelism, cache_size, raw_dir, cache_root):
+    start_time = time.time()
+    # The scheduler evicts from the cache, it knows which products running mosaics still need
+    base = MOSAIC.preprocessing(f'{raw_dir}/{scene}.zip', backend, parallelism, cache_size, region, quota_gb=None, cache_root=cache_root)
+    return base, time.time() - start_time
+
+def mosaic_task(mosaic, products, keep_open, cog=False):
+    # Products stay open in this worker (up to keep_open) for the next mosaics that use them.
+    # With cog the finished mosaic is also exported as a Cloud-optimized GeoTIFF.
+    start_time = time.time()
+    os.makedirs(os.path.dirname(mosaic['outflnm']), exist_ok=True)
+    for path in products:
+        if path in OPENED:
+            OPENED.move_to_end(path)
+    MOSAIC.mosaicing(products, mosaic['bound'], mosaic['wkt'], mosaic['outflnm'], OPENED)
+    while len(OPENED) > keep_open:
+        _, product = OPENED.popitem(last=False)
+        product.dispose()
+        product.closeIO()
+    if cog and os.path.exists(mosaic['outflnm'] + '.dim'):
+        cog_export.export_cog(mosaic['outflnm'] + '.dim')
+    return time.time() - start_time
+
+############################################
+# Scheduler side
+def run_plan(plan, n_workers=4, heap='16G', backend='snappy', parallelism=None, cache_size=None,
+             snappy_module='esa_snappy', raw_dir=RAW_DIR, keep_open=8, cog=False, max_attempts=3,
+             quota_gb=scene_cache.QUOTA_GB, cache_root=scene_cache.CACHE_DIR):
+    # At most n_workers tasks are in flight. A free slot takes a mosaic whose scenes are all
+    # preprocessed before it takes the next scene, so mosaics start as soon as possible.
+    # After every scene the cache is evicted down to quota_gb, keeping the products of mosaics
+    # not finished yet. When a worker dies the pool breaks: it is replaced and the tasks that
+    # were in flight are queued again, each up to max_attempts times (as in 01_doprepfarm).
+    mosaics = plan['mosaics']
+    scenes = plan['scenes']
+    waiting = {i: set(m['scenes']) for i, m in enumerate(mosaics) if not m['done']}
+    products = {}
+    failed_scenes = set()
+    scene_queue = list(scenes)
+    ready = [i for i, s in waiting.items() if len(s) == 0]
+    for i in ready:
+        del waiting[i]
+    report = {}
+    attempts = Counter()
+    running = {}
+    ctx = mp.get_context('spawn')
+
+    def new_pool():
+        return ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=init_worker, initargs=(heap, snappy_module))
+
+    def submit(kind, key):
+        if kind == 'mosaic':
+            paths = [products[s] for s in mosaics[key]['scenes']]
+            return pool.submit(mosaic_task, mosaics[key], paths, keep_open, cog)
+        return pool.submit(preprocess_task, key, scenes[key]['region'], backend, parallelism, cache_size, raw_dir, cache_root)
+
+    def requeue(kind, key):
+        if kind == 'mosaic':
+            ready.insert(0, key)
+        else:
+            scene_queue.insert(0, key)
+
+    def fail(kind, key, error):
+        print(f'{kind} {key} failed: {error}')
+        report[(kind, key)] = {'status': 'failed', 'error': error}
+        if kind == 'scene':
+            failed_scenes.add(key)
+            for i in scenes[key]['mosaics']:
+                if waiting.pop(i, None) is not None:
+                    report[('mosaic', i)] = {'status': 'skipped', 'error': f'scene {key} failed'}
+
+    def lost(kind, key, error):
+        # Task of a broken pool: again on the next pool until max_attempts
+        attempts[(kind, key)] += 1
+        if attempts[(kind, key)] < max_attempts:
+            print(f'{kind} {key} lost with its worker ({attempts[(kind, key)]}), queued again')
+            requeue(kind, key)
+        else:
+            fail(kind, key, error)
+
+    def in_use():
+        # Cache entries of every scene a waiting, ready or running mosaic reads
+        open_mosaics = set(waiting) | set(ready) | {key for kind, key in running.values() if kind == 'mosaic'}
+        return {scene_cache.entry_key(products[s], cache_root) for i in open_mosaics for s in mosaics[i]['scenes'] if s in products}
+
+    pool = new_pool()
+    try:
+        while scene_queue or ready or running:
+            broken = False
+            while len(running) < n_workers and (ready or scene_queue):
+                kind, key = ('mosaic', ready.pop(0)) if ready else ('scene', scene_queue.pop(0))
+                try:
+                    running[submit(kind, key)] = (kind, key)
+                except BrokenProcessPool:
+                    requeue(kind, key)
+                    broken = True
+                    break
+            done = set() if broken else wait(running, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                kind, key = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    lost(kind, key, repr(e))
+                    broken = True
+                    continue
+                except Exception as e:
+                    fail(kind, key, repr(e))
+                    continue
+                if kind == 'scene':
+                    products[key], seconds = result
+                    for i in scenes[key]['mosaics']:
+                        if i in waiting:
+                            waiting[i].discard(key)
+                            if len(waiting[i]) == 0:
+                                del waiting[i]
+                                ready.append(i)
+                    if quota_gb is not None:
+                        scene_cache.evict(quota_gb, cache_root, keep=in_use())
+                else:
+                    seconds = result
+                report[(kind, key)] = {'status': 'done', 'seconds': seconds}
+                name = key if kind == 'scene' else f"{mosaics[key]['id']} {mosaics[key]['start_periode']}"
+                print(f'{kind} {name} done --- {seconds:.1f} seconds ---')
+            if broken:
+                # Every task still in the broken pool is lost with it
+                print('Worker pool broken, starting a new one')
+                for kind, key in list(running.values()):
+                    lost(kind, key, 'worker pool broken')
+                running.clear()
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = new_pool()
+    finally:
+        pool.shutdown()
+    return report
+
+def main():
+    # python 01_mosaicscheduler.py <kdprov> [workers] [backend] [dryrun] [subset] [cog]
+    kdprov=sys.argv[1]
+    n_workers=int(sys.argv[2]) if len(sys.argv)>2 else 4
+    backend=sys.argv[3] if len(sys.argv)>3 else 'snappy'
+    flags=sys.argv[4:]
+    dryrun='dryrun' in flags
+    subset='subset' in flags
+    cog='cog' in flags
+    with open(f'{COVERAGE_DIR}/{kdprov}_coverage_ASF.json','r') as f:
+        coverage=json.load(f)
+    aoi=None
+    if subset:
+        with open(f'{METADATA_DIR}/{kdprov}_metadata_ASF.json','r') as f:
+            aoi=s1_graph.scene_aoi(coverage, s1_graph.scene_footprints(json.load(f)))
+    print('*********************************************************')
+    print('Mosaic plan for PROV:',kdprov)
+    plan=build_plan(coverage, aoi)
+    print_plan(plan, n_workers)
+    if not dryrun:
+        start_time=time.time()
+        report=run_plan(plan, n_workers=n_workers, backend=backend, cog=cog)
+        print('Failed:',[k for k,v in report.items() if v['status']!='done'])
+        print("--- %s seconds ---" % (time.time() - start_time))
+    print('*********************************************************')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+import os, sys, time
+
+# BEAM-DIMAP mosaic -> Cloud-optimized GeoTIFF, one band per polarization, without SNAP.
+# Band rasters are read from the ENVI files in the .data folder; CRS, geotransform and no-data
+# come from the .dim header. The COG is internally tiled, compressed and has overviews, so
+# sampling can read a window around each point instead of the whole raster.
+
+MOSAIC_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_mosaic'
+COG_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_mosaic_cog'
+BLOCKSIZE = 512
+
+def read_dimap(dim_path):
+    # Band names (in band index order), no-data values, CRS and affine transform of a .dim product
+    root = ET.parse(dim_path).getroot()
+    bands = []
+    for info in root.iter('Spectral_Band_Info'):
+        nodata = None
+        if (info.findtext('NO_DATA_VALUE_USED') or '').strip().lower() == 'true':
+            nodata = float(info.findtext('NO_DATA_VALUE'))
+        bands.append((int(info.findtext('BAND_INDEX')), info.findtext('BAND_NAME').strip(), nodata))
+    bands.sort()
+    crs = None
+    wkt = root.findtext('Coordinate_Reference_System/WKT')
+    if wkt:
+        crs = CRS.from_wkt(wkt.strip())
+    transform = None
+    matrix = root.findtext('Geoposition/IMAGE_TO_MODEL_TRANSFORM')
+    if matrix:
+        # java.awt.geom.AffineTransform flat matrix: m00, m10, m01, m11, m02, m12
+        m00, m10, m01, m11, m02, m12 = [float(v) for v in matrix.split(',')]
+        transform = Affine(m00, m01, m02, m10, m11, m12)
+    return [b[1] for b in bands], [b[2] for b in bands], crs, transform
+
+def cog_path(dim_path, mosaic_dir=MOSAIC_DIR, cog_dir=COG_DIR):
+    # .../02_Processed_mosaic/48MXU/20230101_20230112.dim -> .../02_Processed_mosaic_cog/48MXU/20230101_20230112.tif
+    return os.path.join(cog_dir, os.path.relpath(dim_path, mosaic_dir)).replace('.dim', '.tif')
+
+def export_cog(dim_path, output=None, compress='DEFLATE', blocksize=BLOCKSIZE, resampling='AVERAGE'):
+    # Bands are copied block by block into a tiled GTiff next to the output, which the GDAL
+    # COG driver then rewrites with overviews; the final file appears with a rename.
+    start_time = time.time()
+    if output is None:
+        output = cog_path(dim_path)
+    band_names, nodata, crs, transform = read_dimap(dim_path)
+    data_dir = dim_path.replace('.dim', '.data')
+    sources = [rasterio.open(os.path.join(data_dir, band + '.img')) for band in band_names]
+    try:
+        first = sources[0]
+        if crs is None:
+            crs = first.crs
+        if transform is None:
+            transform = first.transform
+        fill = next((v for v in nodata if v is not None), None)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        staging = f'{output}.{os.getpid()}.staging.tif'
+        tmp = f'{output}.{os.getpid()}.tmp'
+        profile = {'driver': 'GTiff', 'width': first.width, 'height': first.height, 'count': len(sources),
+                   'dtype': 'float32', 'crs': crs, 'transform': transform, 'nodata': fill,
+                   'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize, 'BIGTIFF': 'IF_SAFER'}
+        with rasterio.open(staging, 'w', **profile) as dst:
+            for i, (src, name, value) in enumerate(zip(sources, band_names, nodata), start=1):
+                dst.set_band_description(i, name)
+                for _, window in dst.block_windows(1):
+                    block = src.read(1, window=window).astype(np.float32)
+                    if value is not None and fill is not None and value != fill:
+                        block[block == value] = fill
+                    dst.write(block, i, window=window)
+        rasterio.shutil.copy(staging, tmp, driver='COG', COMPRESS=compress, PREDICTOR='FLOATING_POINT',
+                             BLOCKSIZE=blocksize, OVERVIEW_RESAMPLING=resampling, BIGTIFF='IF_SAFER')
+        os.replace(tmp, output)
+        os.remove(staging)
+    finally:
+        for src in sources:
+            src.close()
+    print('COG', output, "--- %s seconds ---" % (time.time() - start_time))
+    return output
+
+def export_all(mosaic_dir=MOSAIC_DIR, cog_dir=COG_DIR, max_workers=4, overwrite=False):
+    # Every .dim under mosaic_dir/<MGRS>/ without a COG yet
+    todo = []
+    for dim_path in sorted(glob(f'{mosaic_dir}/*/*.dim')):
+        output = cog_path(dim_path, mosaic_dir, cog_dir)
+        if overwrite or not os.path.exists(output):
+            todo.append((dim_path, output))
+    print('Mosaics to export:', len(todo))
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(export_cog, dim_path, output) for dim_path, output in todo]
+        return [f.result() for f in futures]
+
+def check_cog(path):
+    # Layout summary of an exported file
+    with rasterio.open(path) as src:
+        return {'crs': src.crs.to_string() if src.crs else None, 'size': (src.width, src.height),
+                'bands': list(src.descriptions), 'blocks': src.block_shapes[0], 'compression': str(src.compression),
+                'overviews': src.overviews(1), 'layout': src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT')}
+
+def main():
+    # python cog_export.py [mosaic_dir] [max_workers]
+    mosaic_dir=sys.argv[1] if len(sys.argv)>1 else MOSAIC_DIR
+    max_workers=int(sys.argv[2]) if len(sys.argv)>2 else 4
+    print('*********************************************************')
+    start_time=time.time()
+    export_all(mosaic_dir, max_workers=max_workers)
+    print("--- %s seconds ---" % (time.time() - start_time))
+    print('*********************************************************')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+from shapely import wkt
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+# Parameters of the Sentinel-1 GRD chain as plain dicts, shared by the esa_snappy path
+# (01_doprep.py / 01_doprepmosaic.py turn them into a HashMap) and the gpt graph path.
+# Nothing here imports SNAP.
+
+# Settings that differ between the two preprocessing scripts
+DOPREP = {'orbit_type': None, 'map_projection': None, 'resampling': 'BICUBIC_INTERPOLATION'}
+DOPREPMOSAIC = {'orbit_type': 'Sentinel Precise (Auto Download)', 'map_projection': 'EPSG:3857', 'resampling': 'BILINEAR_INTERPOLATION'}
+FORMAT_EXTENSION = {'GeoTIFF': '.tif', 'GeoTIFF-BigTIFF': '.tif', 'BEAM-DIMAP': '.dim'}
+
+def scene_polarization(filename):
+    # e.g. S1A_IW_GRDH_1SDV_... -> ('DV', 'VH,VV')
+    polarization=filename.split('/')[-1].split('_')[3][2:]
+    if polarization == 'DV':
+        pols = 'VH,VV'
+    elif polarization == 'DH':
+        pols = 'HH,HV'
+    elif polarization == 'SH' or polarization == 'HH':
+        pols = 'HH'
+    elif polarization == 'SV':
+        pols = 'VV'
+    else:
+        print("Polarization error!")
+        pols = None
+    return polarization, pols
+
+def apply_orbit_file_parameters(orbit_type=None):
+    parameters = {'Apply-Orbit-File': True}
+    if orbit_type is not None:
+        parameters['orbitType'] = orbit_type
+        parameters['continueOnFail'] = True
+    return parameters
+
+def thermal_noise_removal_parameters():
+    return {'removeThermalNoise': True}
+
+def remove_grd_border_noise_parameters():
+    #'borderLimit': 500
+    return {'Remove-GRD-Border-Noise': True, 'trimThreshold': 0.5}
+
+def calibration_parameters(polarization, pols):
+    #'outputSigmaBand': False
+    parameters = {'outputBetaBand': False, 'outputGammaBand': False}
+    if polarization == 'DH':
+        parameters['sourceBands'] = 'Intensity_HH,Intensity_HV'
+    elif polarization == 'DV':
+        parameters['sourceBands'] = 'Intensity_VH,Intensity_VV'
+    elif polarization == 'SH' or polarization == 'HH':
+        parameters['sourceBands'] = 'Intensity_HH'
+    elif polarization == 'SV':
+        parameters['sourceBands'] = 'Intensity_VV'
+    else:
+        print("different polarization!")
+    parameters['selectedPolarisations'] = pols
+    parameters['outputImageScaleInDb'] = False
+    return parameters
+
+def speckle_filtering_parameters():
+    #'filterSizeX': 3, 'filterSizeY': 3
+    return {'filter': 'Refined Lee'}
+
+def terrain_correction_parameters(downsample, map_projection=None, resampling='BICUBIC_INTERPOLATION'):
+    parameters = {'demName': 'Copernicus 30m Global DEM'}
+    if map_projection is not None:
+        parameters['mapProjection'] = map_projection
+    parameters['imgResamplingMethod'] = resampling
+    parameters['saveProjectedLocalIncidenceAngle'] = False
+    parameters['saveSelectedSourceBand'] = True
+    if downsample == 1:
+        parameters['pixelSpacingInMeter'] = 20.0
+    return parameters
+
+def lineartodb_parameters():
+    return {}
+
+def subset_parameters(region):
+    # Metadata must be copied or Terrain-Correction cannot geocode the subset
+    return {'geoRegion': region, 'copyMetadata': True}
+
+def scene_footprints(metadata):
+    # ASF search GeoJSON -> {scene name: footprint polygon}
+    footprints = {}
+    for feature in metadata['features']:
+        properties = feature['properties']
+        name = properties.get('sceneName') or properties['fileID'].split('-')[0]
+        footprints[name] = shape(feature['geometry'])
+    return footprints
+
+def scene_aoi(coverage, footprints=None, buffer_deg=0.02):
+    # Union of every tile (buffered, EPSG:4326) that uses a scene in any period, clipped to
+    # the scene footprint when known -> {scene name: WKT}
+    tiles = {}
+    for dict_mosaic in coverage:
+        geometry = wkt.loads(dict_mosaic['geometry']).buffer(buffer_deg, join_style='mitre')
+        for periode in dict_mosaic['periode']:
+            for scene in periode['image_asf']:
+                tiles.setdefault(scene, []).append(geometry)
+    aoi = {}
+    for scene, geometries in tiles.items():
+        region = unary_union(geometries)
+        if footprints is not None and scene in footprints:
+            region = region.intersection(footprints[scene])
+        if not region.is_empty:
+            aoi[scene] = region.wkt
+    return aoi
+
+def grd_steps(polarization, pols, orbit_type=None, map_projection=None, resampling='BICUBIC_INTERPOLATION', downsample=1, region=None):
+    # (operator, parameters) in processing order. With a region the scene is cut after
+    # Calibration, so Speckle-Filter and Terrain-Correction only see the AOI; border noise
+    # removal still runs on the full swath edges.
+    steps = [
+        ('Apply-Orbit-File', apply_orbit_file_parameters(orbit_type)),
+        ('ThermalNoiseRemoval', thermal_noise_removal_parameters()),
+        ('Remove-GRD-Border-Noise', remove_grd_border_noise_parameters()),
+        ('Calibration', calibration_parameters(polarization, pols)),
+    ]
+    if region is not None:
+        steps.append(('Subset', subset_parameters(region)))
+    steps += [
+        ('Speckle-Filter', speckle_filtering_parameters()),
+        ('Terrain-Correction', terrain_correction_parameters(downsample, map_projection, resampling)),
+        ('LinearToFromdB', lineartodb_parameters()),
+    ]
+    return steps
+
+def format_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def graph_xml(input, output, steps, format_name='GeoTIFF'):
+    # SNAP graph Read -> steps -> Write. Parameters named after the operator itself (the
+    # 'Apply-Orbit-File': True style flags) are not operator parameters and are left out.
+    graph = ET.Element('graph', id='Graph')
+    ET.SubElement(graph, 'version').text = '1.0'
+    nodes = [('Read', 'Read', {'file': input})] + [(op, op, params) for op, params in steps] + \
+            [('Write', 'Write', {'file': output, 'formatName': format_name})]
+    previous = None
+    for node_id, operator, params in nodes:
+        node = ET.SubElement(graph, 'node', id=node_id)
+        ET.SubElement(node, 'operator').text = operator
+        sources = ET.SubElement(node, 'sources')
+        if previous is not None:
+            ET.SubElement(sources, 'sourceProduct', refid=previous)
+        parameters = ET.SubElement(node, 'parameters', {'class': 'com.bc.ceres.binding.dom.XppDomElement'})
+        for key, value in params.items():
+            if key != operator and value is not None:
+                ET.SubElement(parameters, key).text = format_value(value)
+        previous = node_id
+    ET.indent(graph)
+    return ET.tostring(graph, encoding='unicode')
+
+def run_gpt(graph_path, parallelism=None, cache_size=None, gpt='gpt'):
+    # parallelism -> gpt -q, cache_size (e.g. '8G') -> gpt -c
+    cmd = [gpt, graph_path]
+    if parallelism is not None:
+        cmd += ['-q', str(parallelism)]
+    if cache_size is not None:
+        cmd += ['-c', str(cache_size)]
+    print('\t' + ' '.join(cmd))
+    start_time = time.time()
+    subprocess.run(cmd, check=True)
+    return time.time() - start_time
+
+def process_gpt(input, output, format_name='GeoTIFF', variant=DOPREP, parallelism=None, cache_size=None, gpt='gpt', region=None):
+    # Whole chain for one scene as a single gpt call; output is given without extension as for
+    # ProductIO.writeProduct, and the graph is kept next to it
+    polarization, pols = scene_polarization(input)
+    xml = graph_xml(input, output + FORMAT_EXTENSION.get(format_name, ''), grd_steps(polarization, pols, region=region, **variant), format_name)
+    graph_path = output + '_graph.xml'
+    with open(graph_path, 'w') as f:
+        f.write(xml)
+    return run_gpt(graph_path, parallelism, cache_size, gpt)
@@ -0,0 +1,206 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+import s1_graph
+
+# Content-addressed store of preprocessed scenes shared by 01_doprep.py and 01_doprepmosaic.py.
+# A product lives in {CACHE_DIR}/{scene}/{hash}/ where hash covers every step parameter and the
+# output format, so a change in the chain gives a new entry instead of reusing an old result.
+# index.json keeps size, last use and raw zip of each entry; the least recently used entries are
+# removed once the cache is above the quota. Entries whose raw zip is gone are the only copy of
+# that product and are never evicted. Products published to an older consumer path (e.g.
+# 02_Processed_Image) are hard links, so they survive the eviction of their entry.
+
+CACHE_DIR = '/data/ksa/01_Image_Acquisition/03_Scene_Cache'
+QUOTA_GB = 2000
+
+def scene_id(filename):
+    # fileID, raw zip or product path -> S1A_IW_GRDH_1SDV_...
+    return os.path.basename(filename).split('-')[0].replace('.zip', '')
+
+def scene_steps(filename, variant=s1_graph.DOPREP, region=None):
+    polarization, pols = s1_graph.scene_polarization(filename)
+    return s1_graph.grd_steps(polarization, pols, region=region, **variant)
+
+def parameter_hash(steps, format_name):
+    payload = json.dumps({'steps': steps, 'format': format_name}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def entry_base(scene, phash, root=CACHE_DIR):
+    # Product path without extension, as given to ProductIO.writeProduct
+    return f'{root}/{scene}/{phash}/{scene}'
+
+def entry_key(base, root=CACHE_DIR):
+    # Index key ({scene}/{hash}) of a cached product path
+    return os.path.dirname(os.path.relpath(base, root))
+
+def folder_size(path):
+    total = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(folder, name))
+    return total
+
+@contextmanager
+def locked(root=CACHE_DIR):
+    # Farm workers share the index, so every read-modify-write holds this lock
+    os.makedirs(root, exist_ok=True)
+    with open(f'{root}/index.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def load_index(root=CACHE_DIR):
+    path = f'{root}/index.json'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_index(index, root=CACHE_DIR):
+    path = f'{root}/index.json'
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, path)
+
+def lookup(scene, steps, format_name, root=CACHE_DIR):
+    # Base path of a cached product, or None. Entries whose files are gone are dropped.
+    key = f'{scene}/{parameter_hash(steps, format_name)}'
+    with locked(root):
+        index = load_index(root)
+        entry = index.get(key)
+        if entry is None:
+            return None
+        base = f"{root}/{entry['base']}"
+        if not os.path.exists(base + s1_graph.FORMAT_EXTENSION.get(format_name, '')):
+            del index[key]
+            save_index(index, root)
+            return None
+        entry['last_used'] = time.time()
+        save_index(index, root)
+    return base
+
+def contains(scene, steps, format_name, root=CACHE_DIR):
+    # Index check only, without touching last use (used for planning)
+    return f'{scene}/{parameter_hash(steps, format_name)}' in load_index(root)
+
+def evictable(entry):
+    # Only entries that can be recomputed: raw zip still there. Entries written before the raw
+    # was recorded are kept, their raw cannot be checked, and so are entries protected when
+    # publish still made symlinks to them.
+    return not entry.get('protected', False) and entry.get('raw') is not None and os.path.exists(entry['raw'])
+
+def evict(quota_gb=QUOTA_GB, root=CACHE_DIR, keep=()):
+    # Remove least recently used evictable entries until the cache fits in quota_gb
+    with locked(root):
+        index = load_index(root)
+        total = sum(e['bytes'] for e in index.values())
+        removed = []
+        for key, entry in sorted(index.items(), key=lambda kv: kv[1]['last_used']):
+            if total <= quota_gb * 1024**3:
+                break
+            if key in keep or not evictable(entry):
+                continue
+            shutil.rmtree(os.path.dirname(f"{root}/{entry['base']}"), ignore_errors=True)
+            total -= entry['bytes']
+            del index[key]
+            removed.append(key)
+        save_index(index, root)
+    for key in removed:
+        print('Evicted', key)
+    if total > quota_gb * 1024**3:
+        print('Cache above quota: %.2f GB held by entries in use or without raw' % (total / 1024**3))
+    return removed
+
+def fetch(filename, steps, format_name, produce, root=CACHE_DIR, quota_gb=QUOTA_GB):
+    # Cached product for (scene, steps, format), running produce(output_base) on a miss.
+    # The product is written into a temporary folder and renamed into place, so a crashed
+    # run never leaves a partial entry. Returns (base path, True if it was produced now).
+    # quota_gb=None leaves eviction to the caller (e.g. a scheduler that knows what is in use).
+    scene = scene_id(filename)
+    base = lookup(scene, steps, format_name, root)
+    if base is not None:
+        print('Cache hit:', base)
+        return base, False
+    phash = parameter_hash(steps, format_name)
+    final = os.path.dirname(entry_base(scene, phash, root))
+    tmp = f'{final}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        produce(f'{tmp}/{scene}')
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(tmp, final)
+    key = f'{scene}/{phash}'
+    now = time.time()
+    with locked(root):
+        index = load_index(root)
+        index[key] = {'scene': scene, 'hash': phash, 'format': format_name, 'steps': steps,
+                      'base': os.path.relpath(entry_base(scene, phash, root), root), 'raw': os.path.abspath(filename),
+                      'bytes': folder_size(final), 'created': now, 'last_used': now}
+        save_index(index, root)
+    if quota_gb is not None:
+        evict(quota_gb, root, keep=(key,))
+    return entry_base(scene, phash, root), True
+
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # Other filesystem: no hard link possible
+        shutil.copy2(source, target)
+
+def link_files(source, target):
+    # Hard link a file, or every file of a folder, from source to target (replacing target)
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    elif os.path.lexists(target):
+        os.remove(target)
+    if not os.path.isdir(source):
+        link_file(source, target)
+        return
+    for folder, _, names in os.walk(source):
+        dest = os.path.join(target, os.path.relpath(folder, source))
+        os.makedirs(dest, exist_ok=True)
+        for name in names:
+            link_file(os.path.join(folder, name), os.path.join(dest, name))
+
+def link_product(base, format_name, output):
+    # Link product base (without extension, plus its .data folder for BEAM-DIMAP) to output
+    ext = s1_graph.FORMAT_EXTENSION.get(format_name, '')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    link_files(base + ext, output + ext)
+    if format_name == 'BEAM-DIMAP':
+        link_files(base + '.data', output + '.data')
+
+def publish(base, format_name, output, root=CACHE_DIR):
+    # Hard link a cached product to the path older consumers read (output without extension).
+    # The links share the entry's data without pinning it: evicting the entry leaves them intact.
+    link_product(base, format_name, output)
+
+def stats(root=CACHE_DIR):
+    index = load_index(root)
+    total = sum(e['bytes'] for e in index.values())
+    print('Entries:', len(index), 'Scenes:', len({e['scene'] for e in index.values()}), 'Size: %.2f GB' % (total / 1024**3))
+    for fmt in sorted({e['format'] for e in index.values()}):
+        n = sum(1 for e in index.values() if e['format'] == fmt)
+        print('\t', fmt, n)
+    return index
+
+if __name__ == "__main__":
+    # python scene_cache.py stats | evict [quota_gb]
+    if sys.argv[1] == 'stats':
+        stats()
+    elif sys.argv[1] == 'evict':
+        evict(float(sys.argv[2]) if len(sys.argv) > 2 else QUOTA_GB)
@@ -0,0 +1,70 @@
+import os
+import time
+
+# Stand-in for esa_snappy used to exercise the preprocessing orchestration without SNAP.
+# GPF.createProduct only records the operator chain and ProductIO.writeProduct writes a small
+# text file where SNAP would write the product. SNAPPY_STUB_SECONDS adds a delay per scene
+# and SNAPPY_STUB_FAIL makes writeProduct fail for outputs containing that substring.
+
+FORMAT_EXTENSION = {'GeoTIFF': '.tif', 'GeoTIFF-BigTIFF': '.tif', 'BEAM-DIMAP': '.dim'}
+
+class HashMap(dict):
+    def put(self, key, value):
+        self[key] = value
+
+class Product:
+    def __init__(self, name, chain=()):
+        self.name = name
+        self.chain = list(chain)
+
+    def getBandNames(self):
+        return ['Sigma0_VH_db', 'Sigma0_VV_db']
+
+    def dispose(self):
+        pass
+
+    def closeIO(self):
+        pass
+
+    def __repr__(self):
+        return f'StubProduct({self.name})'
+
+class ProductIO:
+    @staticmethod
+    def readProduct(path):
+        return Product(path)
+
+    @staticmethod
+    def writeProduct(product, path, fmt):
+        fail = os.environ.get('SNAPPY_STUB_FAIL')
+        if fail and fail in path:
+            raise RuntimeError(f'Stub failure for {path}')
+        time.sleep(float(os.environ.get('SNAPPY_STUB_SECONDS', 0)))
+        with open(path + FORMAT_EXTENSION.get(fmt, ''), 'w') as f:
+            f.write('\n'.join([product.name] + product.chain))
+
+class GPF:
+    @staticmethod
+    def createProduct(operator, parameters, source):
+        sources = source if isinstance(source, (list, tuple)) else [source]
+        chain = [c for s in sources for c in getattr(s, 'chain', [])]
+        return Product(getattr(sources[0], 'name', operator), chain + [f'{operator} {dict(parameters)}'])
+
+class ProductUtils:
+    pass
+
+class Variable:
+    def __init__(self, name, expression):
+        self.name = name
+        self.expression = expression
+
+class jpy:
+    @staticmethod
+    def get_type(name):
+        if name.endswith('MosaicOp$Variable'):
+            return Variable
+        raise RuntimeError(f'Java type {name} is not available in the stub')
+
+    @staticmethod
+    def array(name, size):
+        return [None] * size
@@ -0,0 +1,237 @@
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# On-disk (point x period x polarization) cube of one MGRS tile. The period axis is split in
+# chunks of chunk_periods (30 = one year of prepare_dates()); every chunk is a float32 memmap of
+# shape (points, chunk_periods, polarizations), so a point's series is contiguous within a chunk
+# and a period across all points is one strided read. index.json keeps the idpoint order and the
+# period axis. New periods go into free slots of the last chunk or into a new chunk file, so
+# nothing already written is rewritten. Cells never written read as 0 (missing, as in the
+# imputation input).
+
+CUBE_ROOT = '/data/ksa/03_Data_Cube'
+SAMPLING_DIR = '/data/ksa/03_Sampling/data'
+TRAINING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '06_Training_Preprocessing')
+POLARIZATIONS = ['VH', 'VV']
+COLUMNS = {'VH': 'Sigma0_VH_db', 'VV': 'Sigma0_VV_db'}
+
+def training_module(filename, name):
+    # Module of 06_Training_Preprocessing (which imports its siblings by plain name)
+    if TRAINING_DIR not in sys.path:
+        sys.path.append(TRAINING_DIR)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(TRAINING_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def prepare_dates():
+    # Period axis of the training pipeline, from 06_Training_Preprocessing/01_WhittakerPolars.py
+    return training_module('01_WhittakerPolars.py', 'whittaker_polars').prepare_dates()
+
+def cube_path(kdprov, mgrs, root=CUBE_ROOT, dataset='sampling'):
+    # dataset: 'sampling' (raw backscatter) or 'imputation' (Whittaker output)
+    return f'{root}/{dataset}/{kdprov}/{mgrs}'
+
+class DataCube:
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}/index.json', 'r') as f:
+            self.index = json.load(f)
+        self.idpoint = pd.Index(self.index['idpoint'])
+        self.periods = list(self.index['periods'])
+        self.period_pos = {p: i for i, p in enumerate(self.periods)}
+        self.chunk_periods = self.index['chunk_periods']
+        self.polarizations = self.index['polarizations']
+        self.dtype = np.dtype(self.index['dtype'])
+        self._chunks = {}
+
+    @classmethod
+    def create(cls, path, idpoint, periods=None, chunk_periods=30, polarizations=POLARIZATIONS, dtype='float32'):
+        if periods is None:
+            periods = prepare_dates()
+        idpoint = pd.Index(idpoint)
+        if not idpoint.is_unique:
+            raise ValueError('idpoint must be unique')
+        os.makedirs(path, exist_ok=True)
+        index = {'idpoint': idpoint.tolist(), 'periods': [], 'chunk_periods': chunk_periods,
+                 'polarizations': list(polarizations), 'dtype': np.dtype(dtype).name}
+        save_index(path, index)
+        cube = cls(path)
+        cube.append_periods(periods)
+        return cube
+
+    @property
+    def shape(self):
+        return (len(self.idpoint), len(self.periods), len(self.polarizations))
+
+    def chunk(self, k):
+        # Memmap of chunk k, created (zero filled, sparse on disk) on first use
+        if k not in self._chunks:
+            file = f'{self.path}/chunk_{k:03d}.dat'
+            shape = (len(self.idpoint), self.chunk_periods, len(self.polarizations))
+            mode = 'r+' if os.path.exists(file) else 'w+'
+            self._chunks[k] = np.memmap(file, dtype=self.dtype, mode=mode, shape=shape)
+        return self._chunks[k]
+
+    def append_periods(self, periods):
+        new = [p for p in periods if p not in self.period_pos]
+        for p in new:
+            self.period_pos[p] = len(self.periods)
+            self.periods.append(p)
+        for k in range((len(self.periods) + self.chunk_periods - 1) // self.chunk_periods):
+            self.chunk(k)
+        self.index['periods'] = self.periods
+        save_index(self.path, self.index)
+        return new
+
+    def rows(self, idpoint):
+        rows = self.idpoint.get_indexer(idpoint)
+        if (rows < 0).any():
+            raise KeyError(f'Unknown idpoint: {list(pd.Index(idpoint)[rows < 0][:5])}')
+        return rows
+
+    def series(self, idpoint):
+        # (periods, polarizations) of one point
+        row = self.idpoint.get_loc(idpoint)
+        n = len(self.periods)
+        return np.concatenate([self.chunk(k)[row, :min(self.chunk_periods, n - k * self.chunk_periods)]
+                               for k in range((n + self.chunk_periods - 1) // self.chunk_periods)])
+
+    def period(self, periode):
+        # (points, polarizations) of one period
+        k, slot = divmod(self.period_pos[periode], self.chunk_periods)
+        return np.asarray(self.chunk(k)[:, slot])
+
+    def read(self, idpoint=None, periods=None):
+        # (points, periods, polarizations) block; None takes the whole axis
+        rows = slice(None) if idpoint is None else self.rows(idpoint)
+        pos = np.arange(len(self.periods)) if periods is None else np.array([self.period_pos[p] for p in periods])
+        n_rows = len(self.idpoint) if idpoint is None else len(rows)
+        out = np.empty((n_rows, len(pos), len(self.polarizations)), dtype=self.dtype)
+        for k in np.unique(pos // self.chunk_periods):
+            sel = np.flatnonzero(pos // self.chunk_periods == k)
+            out[:, sel] = self.chunk(k)[rows][:, pos[sel] % self.chunk_periods]
+        return out
+
+    def write_period(self, periode, values, idpoint=None):
+        # values: (points, polarizations) for all points or for the idpoint given
+        if periode not in self.period_pos:
+            self.append_periods([periode])
+        k, slot = divmod(self.period_pos[periode], self.chunk_periods)
+        rows = slice(None) if idpoint is None else self.rows(idpoint)
+        self.chunk(k)[rows, slot] = values
+
+    def write_long(self, df):
+        # Long table (idpoint, periode, Sigma0_VH_db, Sigma0_VV_db) into the cube
+        self.append_periods(sorted(set(df['periode']) - set(self.period_pos)))
+        rows = self.rows(df['idpoint'])
+        pos = df['periode'].map(self.period_pos).to_numpy()
+        values = df[[COLUMNS[p] for p in self.polarizations]].to_numpy(dtype=self.dtype)
+        for k in np.unique(pos // self.chunk_periods):
+            sel = np.flatnonzero(pos // self.chunk_periods == k)
+            self.chunk(k)[rows[sel], pos[sel] % self.chunk_periods] = values[sel]
+
+    def to_long(self):
+        data = self.read()
+        n_points, n_periods, _ = data.shape
+        df = pd.DataFrame({'idpoint': np.repeat(self.idpoint.to_numpy(), n_periods),
+                           'periode': np.tile(np.array(self.periods), n_points)})
+        for i, p in enumerate(self.polarizations):
+            df[COLUMNS[p]] = data[:, :, i].ravel()
+        return df
+
+    def flush(self):
+        for mm in self._chunks.values():
+            mm.flush()
+
+def save_index(path, index):
+    tmp = f'{path}/index.json.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, f'{path}/index.json')
+
+def open_cube(kdprov, mgrs, root=CUBE_ROOT, dataset='sampling'):
+    return DataCube(cube_path(kdprov, mgrs, root, dataset))
+
+def load_long(path, df, list_date):
+    cube = DataCube(path) if os.path.exists(f'{path}/index.json') else DataCube.create(path, df['idpoint'].unique(), list_date)
+    cube.write_long(df)
+    cube.flush()
+    return cube
+
+def build_from_sampling(kdprov, root=CUBE_ROOT, sampling_dir=SAMPLING_DIR):
+    # One cube per sampling_{MGRS}.pkl of the province (01_sampling.py output)
+    print('=================================================')
+    print('Build data cube for Province:', kdprov)
+    list_date = prepare_dates()
+    for i in sorted(os.listdir(f'{sampling_dir}/{kdprov}')):
+        if not i.startswith('sampling_') or not i.endswith('.pkl'):
+            continue
+        mgrs = i.replace('sampling_', '').replace('.pkl', '')
+        start_time = time.time()
+        df = pd.read_pickle(f'{sampling_dir}/{kdprov}/{i}')
+        cube = load_long(cube_path(kdprov, mgrs, root, 'sampling'), df, list_date)
+        print(mgrs, 'shape:', cube.shape, "--- %s seconds ---" % (time.time() - start_time))
+    print('=================================================')
+
+def build_from_imputation(kdprov, root=CUBE_ROOT):
+    # One cube per MGRS partition of the imputation dataset, holding the imputed series
+    print('=================================================')
+    print('Build imputed data cube for Province:', kdprov)
+    storage = training_module('storage.py', 'storage')
+    list_date = prepare_dates()
+    for mgrs in storage.partition_values('imputation', 'MGRS', province=kdprov):
+        start_time = time.time()
+        df = storage.read_dataset('imputation', columns=['idpoint', 'periode', 'Sigma0_VH_db_imputation', 'Sigma0_VV_db_imputation'],
+                                  province=kdprov, MGRS=mgrs).to_pandas()
+        df = df.rename(columns={'Sigma0_VH_db_imputation': 'Sigma0_VH_db', 'Sigma0_VV_db_imputation': 'Sigma0_VV_db'})
+        cube = load_long(cube_path(kdprov, mgrs, root, 'imputation'), df, list_date)
+        print(mgrs, 'shape:', cube.shape, "--- %s seconds ---" % (time.time() - start_time))
+    print('=================================================')
+
+def benchmark(n_points=200000, n_periods=90, chunk_periods=30):
+    # Slicing times against the same data held as a long pandas table
+    rng = np.random.default_rng(0)
+    idpoint = [f'P{i:07d}' for i in range(n_points)]
+    periods = [f'P{j:03d}' for j in range(n_periods)]
+    with tempfile.TemporaryDirectory() as folder:
+        cube = DataCube.create(folder, idpoint, periods[:n_periods - 1], chunk_periods)
+        for p in periods[:n_periods - 1]:
+            cube.write_period(p, rng.normal(-15, 3, (n_points, 2)).astype(np.float32))
+        start_time = time.time()
+        cube.write_period(periods[-1], rng.normal(-15, 3, (n_points, 2)).astype(np.float32))
+        print('Append period --- %.4f seconds ---' % (time.time() - start_time))
+        df = cube.to_long()
+        sample = rng.choice(idpoint, 1000, replace=False)
+        start_time = time.time()
+        for j in sample:
+            cube.series(j)
+        print('Cube series x1000 --- %.4f seconds ---' % (time.time() - start_time))
+        start_time = time.time()
+        for j in sample[:20]:
+            df.loc[df.idpoint == j]
+        print('Long table series x20 --- %.4f seconds ---' % (time.time() - start_time))
+        start_time = time.time()
+        cube.period(periods[45])
+        print('Cube period --- %.4f seconds ---' % (time.time() - start_time))
+        start_time = time.time()
+        df.loc[df.periode == periods[45]]
+        print('Long table period --- %.4f seconds ---' % (time.time() - start_time))
+        same = np.array_equal(cube.series(idpoint[123]), df.loc[df.idpoint == idpoint[123], ['Sigma0_VH_db', 'Sigma0_VV_db']].to_numpy())
+        print('Series identical:', same, 'Shape:', cube.shape, 'Chunks:', len(cube._chunks))
+
+if __name__ == "__main__":
+    # python data_cube.py build <kdprov> [sampling|imputation] | benchmark [n_points]
+    if sys.argv[1] == 'build':
+        if len(sys.argv) > 3 and sys.argv[3] == 'imputation':
+            build_from_imputation(sys.argv[2])
+        else:
+            build_from_sampling(sys.argv[2])
+    elif sys.argv[1] == 'benchmark':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
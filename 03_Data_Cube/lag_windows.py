@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import polars as pl
+from numpy.lib.stride_tricks import sliding_window_view
+import data_cube
+
+# Lag windows VH_n..VH_0 / VV_n..VV_0 of labelled KSA observations, taken from a tile cube.
+# VH_0 is the period of the observation and VH_k the period k steps before it, as in the wide
+# tables of 05_Sampling/02 Reformat Data.ipynb. Windows are a sliding_window_view over the cube
+# block and only the labelled (point, period) windows are gathered, straight into one float32
+# tensor (samples, polarizations, n_lags + 1) in time order (VH_n first, VH_0 last). Lags before
+# the start of the period axis are NaN.
+
+LABEL_PATH = '/data/raw/processed/relabelled_data_ksa.csv'
+BRIDGING_PATH = '/data/ksa/03_Sampling/bridging.xlsx'
+OUTPUT_DIR = '/data/ksa/04_Data_Preprocessing'
+RECODE = {'V1': '1.0', 'V2': '2.0', 'G': '3.0', 'H': '4.0', 'PL': '5.0', 'P': '99.0', 'NP': '6.0', 'NV': '7.0', 'BL': '0.0'}
+META = ['idpoint', 'idsubsegment', 'idsegment', 'nth', 'periode', 'observation', 'class', 'MGRS']
+
+def year_ids(periods):
+    # prepare_dates periods -> 'YYYY_NN' with NN the position of the period in its year
+    # (generate_date_pairs calendar, id_per_image of bridging.xlsx)
+    years = pd.Series([p[:4] for p in periods])
+    return (years + '_' + (years.groupby(years).cumcount() + 1).astype(str).str.zfill(2)).tolist()
+
+def load_labels(label_path=LABEL_PATH, bridging=None):
+    # Relabelled KSA observations with the 'YYYY_NN' period they fall in; P (99.0) is dropped
+    if bridging is None:
+        bridging = pd.read_excel(BRIDGING_PATH, dtype='object').query('is_kabisat == 0')
+    df_label = pd.read_csv(label_path, dtype='object') if isinstance(label_path, str) else label_path.copy()
+    df_label = df_label.merge(bridging[['obs_in_a_year', 'id_per_image']].astype(str), how='inner',
+                              left_on=df_label['bulan'].astype(str), right_on='obs_in_a_year')
+    df_label['periode'] = '20' + df_label.tahun.astype(str) + '_' + df_label.id_per_image.astype(str).str.zfill(2)
+    df_label['observation'] = df_label['class'].replace(RECODE)
+    df_label = df_label.loc[df_label.observation != '99.0']
+    # The CSV has its own nth (written by parallel_relabeling): select before renaming bulan to nth
+    return df_label[['id_x', 'bulan', 'periode', 'observation', 'class']].rename(columns={'id_x': 'idsubsegment', 'bulan': 'nth'})
+
+def build_windows(cube, df_label, n_lags=30, mgrs=None):
+    # (tensor, metadata) of every (point of a labelled subsegment, labelled period) in the cube
+    data = cube.read()
+    points = pd.DataFrame({'idpoint': cube.idpoint, 'row': np.arange(len(cube.idpoint))})
+    points['idsubsegment'] = points.idpoint.str[:-3]
+    pos = pd.Series(np.arange(len(cube.periods)), index=year_ids(cube.periods))
+    meta = points.merge(df_label, on='idsubsegment', how='inner')
+    meta = meta.loc[meta.periode.isin(pos.index)].reset_index(drop=True)
+    rows = meta['row'].to_numpy()
+    end = pos.loc[meta.periode].to_numpy()
+
+    tensor = np.full((len(meta), data.shape[2], n_lags + 1), np.nan, dtype=np.float32)
+    full = end >= n_lags
+    if data.shape[1] > n_lags:
+        windows = sliding_window_view(data, n_lags + 1, axis=1)  # (points, starts, polarizations, n_lags + 1)
+        tensor[full] = windows[rows[full], end[full] - n_lags]
+    part = np.flatnonzero(~full)
+    if len(part):
+        # Labels in the first n_lags periods: the same view over a NaN-padded head of the series
+        m = min(n_lags, data.shape[1])
+        head = np.full((len(part), 2 * n_lags, data.shape[2]), np.nan, dtype=np.float32)
+        head[:, n_lags:n_lags + m] = data[rows[part], :m]
+        tensor[part] = sliding_window_view(head, n_lags + 1, axis=1)[np.arange(len(part)), end[part]]
+
+    meta['idsegment'] = meta.idsubsegment.str[:-2]
+    meta['MGRS'] = mgrs
+    return tensor, meta[META]
+
+def to_wide(tensor, meta, polarizations=('VH', 'VV')):
+    # Wide table as in the training pickles: metadata + VH_n..VH_0 (+ VV_n..VV_0)
+    n_lags = tensor.shape[2] - 1
+    wide = [meta.reset_index(drop=True)]
+    for i, pol in enumerate(polarizations):
+        wide.append(pd.DataFrame(tensor[:, i], columns=[f'{pol}_{k}' for k in range(n_lags, -1, -1)]))
+    return pd.concat(wide, axis=1)
+
+def write_windows(tensor, meta, output):
+    # output without extension -> output.npy (float32 tensor) + output.parquet (metadata rows)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    np.save(f'{output}.{os.getpid()}.tmp.npy', tensor)
+    os.replace(f'{output}.{os.getpid()}.tmp.npy', f'{output}.npy')
+    pl.from_pandas(meta).write_parquet(f'{output}.{os.getpid()}.tmp')
+    os.replace(f'{output}.{os.getpid()}.tmp', f'{output}.parquet')
+
+def read_windows(output, mmap=True):
+    return np.load(f'{output}.npy', mmap_mode='r' if mmap else None), pd.read_parquet(f'{output}.parquet')
+
+def main(kdprov, dataset='imputation', n_lags=30, root=data_cube.CUBE_ROOT):
+    print('=================================================')
+    print('Lag windows for Province:', kdprov, 'cube:', dataset, 'lags:', n_lags)
+    df_label = load_labels()
+    folder = f'{root}/{dataset}/{kdprov}'
+    for mgrs in sorted(os.listdir(folder)):
+        start_time = time.time()
+        cube = data_cube.DataCube(f'{folder}/{mgrs}')
+        tensor, meta = build_windows(cube, df_label, n_lags, mgrs)
+        write_windows(tensor, meta, f'{OUTPUT_DIR}/{kdprov}/03_lag_windows/{dataset}/{mgrs}')
+        print(mgrs, 'samples:', tensor.shape[0], "--- %s seconds ---" % (time.time() - start_time))
+    print('=================================================')
+
+############################################
+# Benchmark against the notebook route (pivot per tile, slice 31 columns per label period)
+def notebook_route(df_values, df_label, df_bridging_citra, band, n_lags=30):
+    periods = sorted(df_values.periode.unique())
+    year_id_ = year_ids(periods)
+    df_all_wide = pd.DataFrame(columns=['idpoint'] + year_id_)
+    df_values = df_values.copy()
+    df_values['periode_start'] = df_values.periode.str[4:8]
+    df_values['periode_end'] = df_values.periode.str[-4:]
+    df_values = df_values.merge(df_bridging_citra, on=['periode_start', 'periode_end'])
+    df_values['year_id_per_image'] = df_values.periode.str[:4] + '_' + df_values.id_per_image.astype('str').str.zfill(2)
+    df_wide = df_values.sort_values('year_id_per_image').pivot(index='idpoint', columns='year_id_per_image', values=band).reset_index()
+    df_wide = pd.concat([df_all_wide, df_wide], axis=0)
+    df_wide['idsubsegmen'] = df_wide.idpoint.str[:-3]
+    df_full = df_wide[['idpoint', 'idsubsegmen']].merge(df_label, how='left', left_on='idsubsegmen', right_on='idsubsegment')
+    names = [f'{band}_{k}' for k in range(n_lags, -1, -1)]
+    df_wide_full = []
+    for yi in df_label.periode.unique():
+        if yi not in year_id_:
+            continue
+        ind = df_wide.columns.to_list().index(yi) + 1
+        if ind - (n_lags + 1) < 1:
+            continue
+        df_tmp = df_full.loc[df_full.periode == yi]
+        df_wide_tmp = pd.concat([df_wide.iloc[:, 0:1], df_wide.iloc[:, ind - (n_lags + 1):ind]], axis=1)
+        df_wide_tmp.columns = ['idpoint'] + names
+        df_wide_full.append(df_tmp.merge(df_wide_tmp, how='left', on='idpoint'))
+    return pd.concat(df_wide_full, axis=0)
+
+def synthetic_inputs(n_subsegments=2000, points_per_subsegment=10, seed=0):
+    rng = np.random.default_rng(seed)
+    periods = data_cube.prepare_dates()
+    subsegments = [f'32{i:07d}A1' for i in range(n_subsegments)]
+    idpoint = [f'{s}#{j:02d}' for s in subsegments for j in range(points_per_subsegment)]
+    values = rng.normal(-15, 3, (len(idpoint), len(periods), 2)).astype(np.float32)
+    # One label per subsegment per month over 2021-2023, month m falling in period round(2.5 m)
+    bridging = pd.DataFrame({'obs_in_a_year': np.arange(1, 13), 'id_per_image': np.round(np.arange(1, 13) * 2.5).astype(int)})
+    df_label = pd.DataFrame({'id_x': np.repeat(subsegments, 36), 'tahun': np.tile(np.repeat(['21', '22', '23'], 12), n_subsegments),
+                             'bulan': np.tile(np.arange(1, 13), 3 * n_subsegments).astype(str),
+                             'obs': '1', 'class': rng.choice(list(RECODE), 36 * n_subsegments),
+                             'nth': np.tile(np.arange(36), n_subsegments).astype(str)})
+    bridging_citra = pd.DataFrame({'periode_start': [p[4:8] for p in periods[:30]], 'periode_end': [p[13:17] for p in periods[:30]],
+                                   'id_per_image': np.arange(1, 31)})
+    return idpoint, periods, values, df_label, bridging, bridging_citra
+
+def benchmark(n_subsegments=2000, points_per_subsegment=10, n_lags=30):
+    idpoint, periods, values, df_label, bridging, bridging_citra = synthetic_inputs(n_subsegments, points_per_subsegment)
+    labels = load_labels(df_label, bridging)
+    print('Points:', len(idpoint), 'Periods:', len(periods), 'Labels:', labels.shape[0])
+    with tempfile.TemporaryDirectory() as folder:
+        cube = data_cube.DataCube.create(folder, idpoint, periods)
+        for j, p in enumerate(periods):
+            cube.write_period(p, values[:, j])
+        start_time = time.time()
+        tensor, meta = build_windows(cube, labels, n_lags, '48MXU')
+        cube_seconds = time.time() - start_time
+        write_windows(tensor, meta, f'{folder}/windows/48MXU')
+        written = read_windows(f'{folder}/windows/48MXU', mmap=False)
+        print('Written and read back identical:', np.array_equal(written[0], tensor, equal_nan=True) and written[1].equals(meta))
+    df_values = pd.DataFrame({'idpoint': np.repeat(idpoint, len(periods)), 'periode': np.tile(periods, len(idpoint)),
+                              'VH': values[:, :, 0].ravel(), 'VV': values[:, :, 1].ravel()})
+    start_time = time.time()
+    wide_vh = notebook_route(df_values, labels, bridging_citra, 'VH', n_lags)
+    notebook_seconds = time.time() - start_time
+    print('Notebook route (VH only) --- %s seconds ---' % notebook_seconds)
+    print('Cube windows (VH and VV) --- %s seconds ---' % cube_seconds)
+    wide = to_wide(tensor, meta)
+    keys = ['idpoint', 'periode']
+    lags = [f'VH_{k}' for k in range(n_lags, -1, -1)]
+    compare = wide.loc[wide[lags].notna().all(axis=1)].merge(wide_vh[keys + lags], on=keys, suffixes=('', '_nb'))
+    same = all(np.array_equal(compare[c].to_numpy(dtype=np.float32), compare[c + '_nb'].to_numpy(dtype=np.float32)) for c in lags)
+    print('Samples with full history cube/notebook:', compare.shape[0], '/', wide_vh.shape[0], 'identical:', same)
+    print('Tensor:', tensor.shape, tensor.dtype, '%.1f MB' % (tensor.nbytes / 1e6))
+
+if __name__ == "__main__":
+    # python lag_windows.py <kdprov> [sampling|imputation] [n_lags] | benchmark [n_subsegments]
+    if sys.argv[1] == 'benchmark':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'imputation', int(sys.argv[3]) if len(sys.argv) > 3 else 30)
@@ -1,5 +1,8 @@
 import pandas as pd
+import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
+import time
 
 
 conditions = {
@@ -16,6 +19,26 @@ def relabel_data(sub_data, id_col, nth_col, obs_col):
     for obs_value, class_value in conditions.items():
         sub_data.loc[sub_data[obs_col] == obs_value, 'class'] = class_value
 
+    # One row per (id, nth), first occurrence as in the row-wise lookup, sorted once so the
+    # previous/next nth of the same id is the neighbouring row
+    first = sub_data[[id_col, nth_col, obs_col]].drop_duplicates([id_col, nth_col]).sort_values([id_col, nth_col], kind='stable')
+    has_prev = first[id_col].eq(first[id_col].shift(1)) & first[nth_col].eq(first[nth_col].shift(1) + 1)
+    has_next = first[id_col].eq(first[id_col].shift(-1)) & first[nth_col].eq(first[nth_col].shift(-1) - 1)
+    first['prev_is_4'] = has_prev & first[obs_col].shift(1).eq(4)
+    first['next_is_5'] = has_next & first[obs_col].shift(-1).eq(5)
+    neighbours = sub_data[[id_col, nth_col]].merge(first[[id_col, nth_col, 'prev_is_4', 'next_is_5']], how='left', on=[id_col, nth_col])
+
+    is_4 = (sub_data[obs_col] == 4).to_numpy()
+    is_5 = (sub_data[obs_col] == 5).to_numpy()
+    sub_data.loc[is_4, 'class'] = np.where(neighbours['prev_is_4'].to_numpy()[is_4], 'BL', 'H')
+    sub_data.loc[is_5, 'class'] = np.where(neighbours['next_is_5'].to_numpy()[is_5], 'BL', 'PL')
+    return sub_data
+
+def relabel_data_rowwise(sub_data, id_col, nth_col, obs_col):
+    # Original iterrows implementation, kept as the reference for benchmark_relabeling
+    for obs_value, class_value in conditions.items():
+        sub_data.loc[sub_data[obs_col] == obs_value, 'class'] = class_value
+
     for idx, row in sub_data[sub_data[obs_col] == 4].iterrows():
         curr_nth = row[nth_col]
         curr_idx = row[id_col]
@@ -45,9 +68,90 @@ def batch_data(data, id_col, batch_size):
         batch_ids = unique_ids[i:i + batch_size]
         yield data[data[id_col].isin(batch_ids)]
 
+# Labels returned by workers as int8 codes; -1 leaves the row's class untouched
+LABELS = list(conditions.values()) + ['BL', 'H', 'PL']
+SHARED = {}
+
+def share_array(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def attach_shared(specs):
+    # Pool initializer: map the parent's sorted id/nth/obs arrays without copying them
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        SHARED[key] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+def relabel_range(start, stop):
+    sub_data = pd.DataFrame({key: SHARED[key][1][start:stop] for key in ['id', 'nth', 'obs']})
+    labels = relabel_data(sub_data, 'id', 'nth', 'obs')['class']
+    return start, pd.Categorical(labels, categories=LABELS).codes.astype(np.int8)
+
 def parallel_relabeling(data, id_col='id_x', nth_col='nth', obs_col='obs', batch_size=1000):
-    
+    # Sort once by id and hand workers [start, stop) ranges over shared memory covering
+    # batch_size ids each; workers send back only int8 label codes
+    id_codes, _ = pd.factorize(data[id_col])
+    order = np.argsort(id_codes, kind='stable')
+    keep = data[obs_col].isin(list(conditions) + [4, 5]).to_numpy()
+    arrays = {
+        'id': id_codes[order].astype(np.int64),
+        'nth': data[nth_col].to_numpy(dtype=np.float64)[order],
+        'obs': np.where(keep, data[obs_col].where(keep, -1).to_numpy(), -1).astype(np.int16)[order]
+    }
+    id_starts = np.flatnonzero(np.r_[True, arrays['id'][1:] != arrays['id'][:-1]])
+    bounds = np.r_[id_starts[::batch_size], len(order)]
+    ranges = [(int(bounds[i]), int(bounds[i + 1])) for i in range(len(bounds) - 1)]
+
+    shared = {key: share_array(arr) for key, arr in arrays.items()}
+    codes = np.full(len(order), -1, dtype=np.int8)
+    try:
+        with mp.Pool(mp.cpu_count(), initializer=attach_shared, initargs=({k: v[1] for k, v in shared.items()},)) as pool:
+            for start, batch_codes in pool.starmap(relabel_range, ranges):
+                codes[start:start + len(batch_codes)] = batch_codes
+    finally:
+        for shm, _ in shared.values():
+            shm.close()
+            shm.unlink()
+
+    result = data.copy()
+    codes_original = np.empty_like(codes)
+    codes_original[order] = codes
+    labelled = codes_original >= 0
+    result.loc[labelled, 'class'] = np.array(LABELS, dtype=object)[codes_original[labelled]]
+    return result
+
+def synthetic_ksa(n_ids, n_nth=24, seed=1234):
+    # KSA-like table: n_ids subsegments observed n_nth times, with runs of obs 4 and 5
+    rng = np.random.default_rng(seed)
+    codes = np.array(list(conditions) + [4, 5])
+    obs = rng.choice(codes, n_ids * n_nth)
+    repeat = rng.random(n_ids * n_nth) < 0.4
+    obs[1:][repeat[1:]] = obs[:-1][repeat[1:]]
+    return pd.DataFrame({
+        'id_x': np.repeat(np.array([f'{i:09d}' for i in range(n_ids)]), n_nth),
+        'nth': np.tile(np.arange(1, n_nth + 1), n_ids),
+        'obs': obs
+    })
+
+def benchmark_relabeling(n_ids=100000, n_ids_pool=5000, n_nth=24):
+    # Vectorized relabel_data on one core over the whole table vs. the row-wise version on
+    # the multiprocessing pool over the first n_ids_pool ids (the pool is too slow for all of it)
+    data = synthetic_ksa(n_ids, n_nth)
+    print('Rows:', data.shape[0])
+    start_time = time.time()
+    vectorized = relabel_data(data.copy(), 'id_x', 'nth', 'obs')
+    seconds = time.time() - start_time
+    print(f'Vectorized (1 core) --- {seconds:.2f} seconds --- {data.shape[0] / seconds:,.0f} rows/s')
+
+    subset = data[data['id_x'].isin(data['id_x'].unique()[:n_ids_pool])]
+    start_time = time.time()
     with mp.Pool(mp.cpu_count()) as pool:
-        batches = batch_data(data, id_col, batch_size)
-        results = pool.starmap(process_batch, [(batch, id_col, nth_col, obs_col) for batch in batches])
-    return pd.concat(results)
\ No newline at end of file
+        results = pool.starmap(relabel_data_rowwise, [(batch, 'id_x', 'nth', 'obs') for batch in batch_data(subset, 'id_x', 1000)])
+    rowwise = pd.concat(results)
+    seconds = time.time() - start_time
+    print(f'Row-wise ({mp.cpu_count()} cores) --- {seconds:.2f} seconds --- {subset.shape[0] / seconds:,.0f} rows/s')
+    print('Identical labels:', vectorized.loc[rowwise.index, 'class'].astype(object).equals(rowwise['class'].astype(object)))
+
+if __name__ == "__main__":
+    benchmark_relabeling()
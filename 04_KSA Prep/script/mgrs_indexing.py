@@ -0,0 +1,40 @@
+import pandas as pd
+import geopandas as gpd
+import numpy as np
+import shapely
+import time
+
+
+def assign_mgrs(df_points, mgrs, x_col='long', y_col='lat', tile_col='MGRS', columns=None):
+    # Points are built in one vectorized call and matched to tiles through an STRtree.
+    # A point on a shared tile border intersects several tiles; the smallest tile_col wins,
+    # so the assignment does not depend on row order. Points outside every tile are dropped.
+    if columns is None:
+        columns = [c for c in mgrs.columns if c != mgrs.geometry.name]
+    points = shapely.points(df_points[x_col].to_numpy(dtype=float), df_points[y_col].to_numpy(dtype=float))
+    tree = shapely.STRtree(mgrs.geometry.values)
+    idx_point, idx_tile = tree.query(points, predicate='intersects')
+
+    tile_id = mgrs[tile_col].to_numpy()[idx_tile]
+    order = np.lexsort((tile_id, idx_point))
+    idx_point, idx_tile = idx_point[order], idx_tile[order]
+    first = np.r_[True, idx_point[1:] != idx_point[:-1]]
+    idx_point, idx_tile = idx_point[first], idx_tile[first]
+
+    result = df_points.iloc[idx_point].reset_index(drop=True)
+    tiles = mgrs[columns].iloc[idx_tile].reset_index(drop=True)
+    return pd.concat([result.drop(columns=[c for c in columns if c in result.columns]), tiles], axis=1)
+
+
+def benchmark_assignment(df_points, mgrs, x_col='long', y_col='lat', tile_col='MGRS'):
+    # assign_mgrs against the previous overlay + drop_duplicates route of main.ipynb
+    print('Points:', df_points.shape[0], 'Tiles:', mgrs.shape[0])
+    start_time = time.time()
+    gdf_points = gpd.GeoDataFrame(df_points, geometry=gpd.points_from_xy(df_points[x_col], df_points[y_col]), crs=mgrs.crs)
+    overlay = gpd.overlay(gdf_points, mgrs, how='intersection').drop_duplicates(subset='geometry')
+    print("Overlay --- %s seconds ---" % (time.time() - start_time))
+    start_time = time.time()
+    assigned = assign_mgrs(df_points, mgrs, x_col, y_col, tile_col)
+    print("STRtree --- %s seconds ---" % (time.time() - start_time))
+    print('Assigned points overlay/STRtree:', overlay.shape[0], '/', assigned.shape[0])
+    return overlay, assigned
@@ -0,0 +1,269 @@
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine, rowcol
+from rasterio.windows import Window
+from pyproj import Transformer
+import os, sys, time, tempfile, math
+
+# Point sampling of the mosaic time stack of one MGRS tile. Points are projected to the mosaic
+# grid once and sorted by raster block; every period then reads only the blocks holding points,
+# from the COG (rasterio windows) or from the memory-mapped ENVI bands of the BEAM-DIMAP mosaic.
+# The result is the long table of 01 Get Pixel Value.ipynb (idpoint, MGRS, Sigma0_VH_db,
+# Sigma0_VV_db, periode) that 06_Training_Preprocessing/01_WhittakerPolars.py reads.
+
+MOSAIC_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_mosaic'
+COG_DIR = '/data/ksa/01_Image_Acquisition/02_Processed_mosaic_cog'
+OUTPUT_DIR = '/data/ksa/03_Sampling/data'
+BANDS = ['Sigma0_VH_db', 'Sigma0_VV_db']
+ENVI_DTYPE = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2', 13: 'u4'}
+
+############################################
+# Inputs
+def load_points(path, kdprov):
+    # Cloned points of a province with the idpoint of 01 Get Pixel Value.ipynb
+    df_ksa = pd.read_csv(path)
+    df_ksa['idprov'] = df_ksa.idsegmen.astype('str').str[:2]
+    df_ksa = df_ksa.loc[df_ksa.idprov == kdprov].copy()
+    df_ksa['index'] = [x.zfill(2) for x in df_ksa['index'].astype('str')]
+    df_ksa['idpoint'] = df_ksa.idsegmen.astype('str') + df_ksa.idsubsegmen.astype('str') + '#' + df_ksa['index']
+    return df_ksa[['idpoint', 'MGRS', 'lat', 'long']].reset_index(drop=True)
+
+def list_mosaics(mgrs, source='cog', mosaic_dir=MOSAIC_DIR, cog_dir=COG_DIR):
+    # {periode: path}, periode as in prepare_dates (e.g. 20230501_20230512)
+    folder, ext = (cog_dir, '.tif') if source == 'cog' else (mosaic_dir, '.dim')
+    return {os.path.basename(p)[:-len(ext)]: p for p in sorted(glob(f'{folder}/{mgrs}/*{ext}'))}
+
+############################################
+# Raster access
+def read_envi_header(path):
+    header = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                header[key.strip()] = value.strip()
+    return header
+
+def dimap_grid(dim_path):
+    # CRS, transform, band no-data and band files of a BEAM-DIMAP product
+    root = ET.parse(dim_path).getroot()
+    m00, m10, m01, m11, m02, m12 = [float(v) for v in root.findtext('Geoposition/IMAGE_TO_MODEL_TRANSFORM').split(',')]
+    nodata = {}
+    for info in root.iter('Spectral_Band_Info'):
+        if (info.findtext('NO_DATA_VALUE_USED') or '').strip().lower() == 'true':
+            nodata[info.findtext('BAND_NAME').strip()] = float(info.findtext('NO_DATA_VALUE'))
+    return CRS.from_wkt(root.findtext('Coordinate_Reference_System/WKT').strip()), Affine(m00, m01, m02, m10, m11, m12), nodata
+
+def open_dimap_band(dim_path, band):
+    # ENVI band of a DIMAP product as a read-only memmap (SNAP writes big-endian)
+    img = os.path.join(dim_path.replace('.dim', '.data'), band + '.img')
+    header = read_envi_header(img.replace('.img', '.hdr'))
+    dtype = np.dtype(ENVI_DTYPE[int(header['data type'])]).newbyteorder('>' if header.get('byte order', '0') == '1' else '<')
+    shape = (int(header['lines']), int(header['samples']))
+    return np.memmap(img, dtype=dtype, mode='r', offset=int(header.get('header offset', 0)), shape=shape)
+
+def raster_grid(path):
+    # (crs, transform, height, width, block height, block width)
+    if path.endswith('.dim'):
+        crs, transform, _ = dimap_grid(path)
+        height, width = open_dimap_band(path, BANDS[0]).shape
+        return crs, transform, height, width, 512, 512
+    with rasterio.open(path) as src:
+        bh, bw = src.block_shapes[0]
+        return src.crs, src.transform, src.height, src.width, bh, bw
+
+############################################
+# Pixel index of the points, computed once per tile
+def pixel_index(lat, long, grid):
+    # Row/col of each point (same truncation as SNAP getPixelPos + int), the points inside the
+    # raster, and their order sorted by block so each block is visited once
+    crs, transform, height, width, bh, bw = grid
+    x, y = Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(np.asarray(long, dtype=float), np.asarray(lat, dtype=float))
+    col, row = ~transform * (x, y)
+    row, col = np.floor(row).astype(np.int64), np.floor(col).astype(np.int64)
+    inside = np.flatnonzero((row >= 0) & (row < height) & (col >= 0) & (col < width))
+    row, col = row[inside], col[inside]
+    block = (row // bh) * ((width + bw - 1) // bw) + col // bw
+    order = np.lexsort((col, row, block))
+    return {'inside': inside[order], 'row': row[order], 'col': col[order], 'block': block[order]}
+
+def sample_cog(path, index, grid):
+    crs, transform, height, width, bh, bw = grid
+    values = np.zeros((len(index['row']), len(BANDS)), dtype=np.float32)
+    starts = np.flatnonzero(np.r_[True, index['block'][1:] != index['block'][:-1]])
+    stops = np.r_[starts[1:], len(index['row'])]
+    with rasterio.open(path) as src:
+        bands = [list(src.descriptions).index(b) + 1 if b in src.descriptions else i + 1 for i, b in enumerate(BANDS)]
+        nodata = src.nodata
+        for start, stop in zip(starts, stops):
+            r0 = (index['row'][start] // bh) * bh
+            c0 = (index['col'][start] // bw) * bw
+            window = Window(c0, r0, min(bw, width - c0), min(bh, height - r0))
+            data = src.read(bands, window=window)
+            values[start:stop] = data[:, index['row'][start:stop] - r0, index['col'][start:stop] - c0].T
+    if nodata is not None:
+        values[values == nodata] = 0
+    return values
+
+def sample_dimap(path, index, grid):
+    # Points are sorted by block, so the memmap pages are touched in file order
+    _, _, nodata = dimap_grid(path)
+    values = np.zeros((len(index['row']), len(BANDS)), dtype=np.float32)
+    for i, band in enumerate(BANDS):
+        values[:, i] = open_dimap_band(path, band)[index['row'], index['col']]
+        if band in nodata:
+            values[values[:, i] == nodata[band], i] = 0
+    return values
+
+def sample_period(path, index, grid, lat, long):
+    # Values (n inside, 2) for one period, 0 where there is no data as in the imputation input.
+    # A mosaic on a different grid than the tile reference gets its own pixel index.
+    own = raster_grid(path)
+    if own[:4] != grid[:4]:
+        index, grid = pixel_index(lat, long, own), own
+    values = sample_dimap(path, index, grid) if path.endswith('.dim') else sample_cog(path, index, grid)
+    values[~np.isfinite(values)] = 0
+    return index['inside'], values
+
+############################################
+# Tile driver
+def sample_tile(points, mosaics, max_workers=4):
+    # points: idpoint, lat, long of one tile; mosaics: {periode: path}. Periods run in parallel.
+    lat, long = points['lat'].to_numpy(dtype=float), points['long'].to_numpy(dtype=float)
+    periods = sorted(mosaics)
+    grid = raster_grid(mosaics[periods[0]])
+    index = pixel_index(lat, long, grid)
+    with ProcessPoolExecutor(max_workers) as pool:
+        results = list(pool.map(sample_period, [mosaics[p] for p in periods], [index] * len(periods),
+                                [grid] * len(periods), [lat] * len(periods), [long] * len(periods)))
+    idpoint = points['idpoint'].to_numpy()
+    parts = []
+    for periode, (inside, values) in zip(periods, results):
+        parts.append(pd.DataFrame({'idpoint': idpoint[inside], 'Sigma0_VH_db': values[:, 0],
+                                   'Sigma0_VV_db': values[:, 1], 'periode': periode}))
+    df_result = pd.concat(parts, ignore_index=True)
+    df_result.insert(1, 'MGRS', points['MGRS'].iloc[0] if 'MGRS' in points.columns else None)
+    return df_result[['idpoint', 'MGRS', 'Sigma0_VH_db', 'Sigma0_VV_db', 'periode']]
+
+def reference_sample(points, mosaics):
+    # Whole-raster read and per-point lookup, i.e. what the notebook did with readPixels. Pixel
+    # coordinates come from rasterio's own index / rowcol for each point, not from pixel_index.
+    parts = []
+    for periode in sorted(mosaics):
+        path = mosaics[periode]
+        if path.endswith('.dim'):
+            crs, transform, nodata = dimap_grid(path)
+            full = [np.array(open_dimap_band(path, b), dtype=np.float32) for b in BANDS]
+            full = [np.where(f == nodata.get(b, np.nan), 0, f) for f, b in zip(full, BANDS)]
+            index = lambda x, y: rowcol(transform, x, y, op=math.floor)
+        else:
+            with rasterio.open(path) as src:
+                crs = src.crs
+                full = [np.where(a == src.nodata, 0, a) if src.nodata is not None else a for a in src.read().astype(np.float32)]
+                index = lambda x, y, src=src: src.index(x, y, op=math.floor)
+        height, width = full[0].shape
+        to_crs = Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+        rows = []
+        for idpoint, lat, long in zip(points['idpoint'], points['lat'], points['long']):
+            row, col = index(*to_crs.transform(long, lat))
+            if 0 <= row < height and 0 <= col < width:
+                rows.append((idpoint, full[0][row, col], full[1][row, col]))
+        part = pd.DataFrame(rows, columns=['idpoint', 'Sigma0_VH_db', 'Sigma0_VV_db'])
+        part['Sigma0_VH_db'] = part['Sigma0_VH_db'].astype(np.float32)
+        part['Sigma0_VV_db'] = part['Sigma0_VV_db'].astype(np.float32)
+        part['periode'] = periode
+        parts.append(part)
+    return pd.concat(parts, ignore_index=True)
+
+def main(kdprov, points_path, source='cog', max_workers=4):
+    print('=================================================')
+    print('Sampling for Province:', kdprov, 'source:', source)
+    df_points = load_points(points_path, kdprov)
+    os.makedirs(f'{OUTPUT_DIR}/{kdprov}', exist_ok=True)
+    for mgrs, points in df_points.groupby('MGRS'):
+        output = f'{OUTPUT_DIR}/{kdprov}/sampling_{mgrs}.pkl'
+        mosaics = list_mosaics(mgrs, source)
+        if os.path.exists(output):
+            print(mgrs, 'has been sampled. Skip it')
+            continue
+        if len(mosaics) == 0:
+            print(mgrs + ' not available')
+            continue
+        print('-------------------------------------------------')
+        print(mgrs, 'points:', points.shape[0], 'periods:', len(mosaics))
+        start_time = time.time()
+        df_result = sample_tile(points.reset_index(drop=True), mosaics, max_workers)
+        tmp = f'{output}.{os.getpid()}.tmp'
+        df_result.to_pickle(tmp)
+        os.replace(tmp, output)
+        print('Rows:', df_result.shape[0])
+        print("--- %s seconds ---" % (time.time() - start_time))
+    print('=================================================')
+
+############################################
+# Synthetic fixture: offline check of the engine against reference_sample
+def synthetic_mosaics(folder, mgrs='48MXU', n_periods=4, width=1500, height=1100, pixel=20.0,
+                      x0=11688546.53, y0=-556597.45, nodata=0.0, seed=0):
+    # One BEAM-DIMAP (big-endian ENVI bands, as SNAP writes them) and one tiled GTiff per period
+    # with random dB values and a no-data corner, plus random points in and around the tile
+    rng = np.random.default_rng(seed)
+    crs = CRS.from_epsg(3857)
+    transform = Affine(pixel, 0, x0, 0, -pixel, y0)
+    for p in range(n_periods):
+        periode = f'2023{p + 1:02d}01_2023{p + 1:02d}12'
+        arrays = [rng.normal(-18 + 6 * i, 2, (height, width)).astype(np.float32) for i in range(len(BANDS))]
+        for a in arrays:
+            a[:50, :80] = nodata
+        base = f'{folder}/mosaic/{mgrs}/{periode}'
+        os.makedirs(base + '.data', exist_ok=True)
+        infos = ''
+        for i, (band, a) in enumerate(zip(BANDS, arrays)):
+            a.astype('>f4').tofile(f'{base}.data/{band}.img')
+            with open(f'{base}.data/{band}.hdr', 'w') as f:
+                f.write(f'ENVI\nsamples = {width}\nlines = {height}\nbands = 1\nheader offset = 0\nfile type = ENVI Standard\n'
+                        f'data type = 4\ninterleave = bsq\nbyte order = 1\nband names = {{ {band} }}\n')
+            infos += (f'<Spectral_Band_Info><BAND_INDEX>{i}</BAND_INDEX><BAND_NAME>{band}</BAND_NAME>'
+                      f'<NO_DATA_VALUE_USED>true</NO_DATA_VALUE_USED><NO_DATA_VALUE>{nodata}</NO_DATA_VALUE></Spectral_Band_Info>')
+        with open(base + '.dim', 'w') as f:
+            f.write(f'<?xml version="1.0" encoding="ISO-8859-1"?>\n<Dimap_Document><Coordinate_Reference_System><WKT>{crs.to_wkt()}</WKT>'
+                    f'</Coordinate_Reference_System><Geoposition><IMAGE_TO_MODEL_TRANSFORM>{pixel},0.0,0.0,{-pixel},{x0},{y0}'
+                    f'</IMAGE_TO_MODEL_TRANSFORM></Geoposition><Image_Interpretation>{infos}</Image_Interpretation></Dimap_Document>')
+        os.makedirs(f'{folder}/cog/{mgrs}', exist_ok=True)
+        with rasterio.open(f'{folder}/cog/{mgrs}/{periode}.tif', 'w', driver='GTiff', width=width, height=height, count=len(BANDS),
+                           dtype='float32', crs=crs, transform=transform, nodata=nodata, tiled=True, blockxsize=256,
+                           blockysize=256, compress='deflate') as dst:
+            for i, (band, a) in enumerate(zip(BANDS, arrays), start=1):
+                dst.write(a, i)
+                dst.set_band_description(i, band)
+    # Points over the tile plus a 5% margin outside it
+    to_lonlat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+    n_points = 20000
+    x = x0 + rng.uniform(-0.05, 1.05, n_points) * width * pixel
+    y = y0 - rng.uniform(-0.05, 1.05, n_points) * height * pixel
+    long, lat = to_lonlat.transform(x, y)
+    return pd.DataFrame({'idpoint': [f'P{i:06d}' for i in range(n_points)], 'MGRS': mgrs, 'lat': lat, 'long': long})
+
+def self_check(max_workers=2):
+    with tempfile.TemporaryDirectory() as folder:
+        points = synthetic_mosaics(folder)
+        for source in ['dim', 'cog']:
+            mosaics = list_mosaics('48MXU', source, f'{folder}/mosaic', f'{folder}/cog')
+            start_time = time.time()
+            result = sample_tile(points, mosaics, max_workers)
+            seconds = time.time() - start_time
+            expected = reference_sample(points, mosaics)
+            keys = ['periode', 'idpoint']
+            same = result.drop(columns='MGRS').sort_values(keys).reset_index(drop=True).equals(expected.sort_values(keys).reset_index(drop=True))
+            print(f'{source}: rows {result.shape[0]} of {points.shape[0] * len(mosaics)}, identical to reference: {same} --- {seconds:.2f} seconds ---')
+
+if __name__ == "__main__":
+    # python 01_sampling.py <kdprov> <points.csv> [cog|dim] [max_workers] | selfcheck
+    if sys.argv[1] == 'selfcheck':
+        self_check()
+    else:
+        main(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else 'cog', int(sys.argv[4]) if len(sys.argv) > 4 else 4)
@@ -1,13 +1,18 @@
 import pickle
 import polars as pl
+import pandas as pd
 from datetime import datetime, timedelta
 import numpy as np
 from whittaker_eilers import WhittakerSmoother
+from scipy.linalg import cholesky_banded, cho_solve_banded, LinAlgError
 from glob import glob
 from tqdm import tqdm
 import concurrent.futures
 import os
 import sys
+import time
+import json
+import storage
 
 def generate_date_pairs(year):
     start_date = datetime(year, 1, 1)
@@ -59,42 +64,290 @@ def process_idpoint(j, dt_pkl, list_date, mgrs_map):
         ])
     return temp2
     
-def main(kdprov):
+def whittaker_bands(data_length, lmbda=1, order=2):
+    # Upper banded form of lmbda * D'D, the part of the Whittaker system shared by every point
+    d = np.diff(np.eye(data_length), order, axis=0)
+    penalty = lmbda * (d.T @ d)
+    bands = np.zeros((order + 1, data_length))
+    for k in range(order + 1):
+        bands[order - k, k:] = np.diagonal(penalty, k)
+    return bands
+
+def smooth_matrix(values, weights, lmbda=1, order=2):
+    # Smooth every row of values (points x periods) at once. Rows sharing the same weight
+    # pattern share one banded Cholesky factorization and are solved as a multi-column RHS.
+    n_points, data_length = weights.shape
+    bands = whittaker_bands(data_length, lmbda, order)
+    smoothed = [np.zeros((n_points, data_length)) for _ in values]
+    patterns, inverse = np.unique(weights, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for k, w in enumerate(patterns):
+        rows = np.flatnonzero(inverse == k)
+        rhs = np.concatenate([w * v[rows] for v in values]).T
+        solved = None
+        # Fewer than `order` observations leave the system (near) singular without cholesky_banded
+        # always raising: those patterns go to the per-series smoother, as in process_idpoint
+        if w.sum() >= order:
+            system = bands.copy()
+            system[order] += w
+            try:
+                solved = cho_solve_banded((cholesky_banded(system), False), rhs).T
+            except LinAlgError:
+                pass
+        if solved is None:
+            whittaker_smoother = WhittakerSmoother(lmbda=lmbda, order=order, data_length=data_length, weights=w)
+            solved = np.array([whittaker_smoother.smooth(r) for r in rhs.T])
+        for i in range(len(values)):
+            smoothed[i][rows] = solved[i * len(rows):(i + 1) * len(rows)]
+    return smoothed
+
+def process_tile(dt_pkl, list_date, mgrs_map):
+    # Batched equivalent of running process_idpoint for every idpoint of the tile
+    list_idpoint = dt_pkl['idpoint'].unique(maintain_order=True)
+    n_points, n_periods = len(list_idpoint), len(list_date)
+    u = dt_pkl.select(['idpoint', 'periode', 'Sigma0_VH_db', 'Sigma0_VV_db']).join(
+        pl.DataFrame({'periode': list_date, 'col': np.arange(n_periods)}), on='periode', how='inner').join(
+        pl.DataFrame({'idpoint': list_idpoint, 'row': np.arange(n_points)}), on='idpoint', how='inner').fill_null(0)
+    rows, cols = u['row'].to_numpy(), u['col'].to_numpy()
+    vh = np.zeros((n_points, n_periods))
+    vv = np.zeros((n_points, n_periods))
+    vh[rows, cols] = u['Sigma0_VH_db'].to_numpy()
+    vv[rows, cols] = u['Sigma0_VV_db'].to_numpy()
+    weight = (vh != 0).astype(np.int8)
+    vh_interp, vv_interp = smooth_matrix([vh, vv], weight)
+    return pl.DataFrame({
+        'periode': np.tile(np.array(list_date), n_points),
+        'Sigma0_VH_db': vh.ravel(),
+        'Sigma0_VV_db': vv.ravel(),
+        'idpoint': list_idpoint.gather(np.repeat(np.arange(n_points), n_periods)),
+        'MGRS': [mgrs_map] * (n_points * n_periods),
+        'weight': weight.ravel(),
+        'Sigma0_VH_db_interp': vh_interp.ravel(),
+        'Sigma0_VV_db_interp': vv_interp.ravel()
+    })
+
+def process_threaded(dt_pkl, list_date, mgrs_map, num_workers=40):
+    list_idpoint = dt_pkl['idpoint'].unique().to_list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = list(tqdm(executor.map(process_idpoint, list_idpoint, [dt_pkl]*len(list_idpoint), [list_date]*len(list_idpoint), [mgrs_map]*len(list_idpoint)), total=len(list_idpoint)))
+    return pl.concat(results)
+
+def synthetic_sampling(n_points=2000, seed=1234):
+    # Sampling-like frame (observed periods only) where some points have 1, 2 or 3 observations.
+    # WhittakerSmoother cannot solve a single observation in the first 3 periods (neither path can),
+    # so sparse points are drawn after them.
+    rng = np.random.default_rng(seed)
+    list_date = prepare_dates()
+    frames = []
+    for i in range(n_points):
+        k = [1, 2, 3][i % 3] if i % 10 < 3 else int(rng.integers(4, len(list_date)))
+        periode = np.sort(rng.choice(np.arange(3 if k < 3 else 0, len(list_date)), k, replace=False))
+        frames.append(pl.DataFrame({'idpoint': [f'{i // 9}#{i % 9 + 1}'] * k, 'periode': np.array(list_date)[periode],
+                                    'Sigma0_VH_db': rng.normal(-15, 2, k), 'Sigma0_VV_db': rng.normal(-8, 2, k)}))
+    return pl.concat(frames)
+
+def compare_paths(dt_pkl, list_date, mgrs, tolerance=1e-6):
+    # Threaded (per-point WhittakerSmoother) vs batched smoothing on the same tile
+    print('Idpoint:', dt_pkl['idpoint'].n_unique(), 'Rows:', dt_pkl.shape[0])
+    start_time = time.time()
+    threaded = process_threaded(dt_pkl, list_date, mgrs)
+    print("Thread  --- %s seconds ---" % (time.time() - start_time))
+    start_time = time.time()
+    batched = process_tile(dt_pkl, list_date, mgrs)
+    print("Batch   --- %s seconds ---" % (time.time() - start_time))
+    compare = threaded.join(batched, on=['idpoint', 'periode'], how='inner', suffix='_batch')
+    print('Rows compared:', compare.shape[0], '/', threaded.shape[0])
+    assert compare.shape[0] == threaded.shape[0] == batched.shape[0]
+    for col in ['Sigma0_VH_db_interp', 'Sigma0_VV_db_interp']:
+        diff = (compare[col] - compare[col + '_batch']).abs().max()
+        print(col, 'max abs diff:', diff)
+        assert diff <= tolerance, f'{col} differs from the threaded path by {diff}'
+
+def benchmark(ls_pickle=None):
+    # A sampling pickle when given, and always a synthetic tile with sparse-observation points
+    list_date = prepare_dates()
+    if ls_pickle is not None:
+        print('Benchmark for:', ls_pickle)
+        compare_paths(do_preparation(ls_pickle), list_date, os.path.basename(ls_pickle).replace('.pkl', '').replace('sampling_', ''))
+    print('Benchmark for: synthetic tile with 1-3 observation points')
+    compare_paths(synthetic_sampling(), list_date, '48MXU')
+
+def write_parquet_atomic(lf, output):
+    # Stream to a file next to the target and rename, so an interrupted run never leaves a truncated output
+    tmp = f'{output}.{os.getpid()}.tmp'
+    lf.sink_parquet(tmp)
+    os.replace(tmp, output)
+
+def compile_imputation(temp):
+    # Observed values where weight > 0, Whittaker interpolation elsewhere
+    return temp.lazy().with_columns([
+        pl.when(pl.col('weight') > 0).then(pl.col('Sigma0_VH_db')).otherwise(pl.col('Sigma0_VH_db_interp')).alias('Sigma0_VH_db_imputation'),
+        pl.when(pl.col('weight') > 0).then(pl.col('Sigma0_VV_db')).otherwise(pl.col('Sigma0_VV_db_interp')).alias('Sigma0_VV_db_imputation')
+    ]).select(['periode', 'idpoint', 'MGRS', 'weight', 'Sigma0_VH_db_imputation', 'Sigma0_VV_db_imputation'])
+
+def compile_imputation_pandas(temp):
+    # Previous compile step, kept for benchmark_compile
+    temp=temp.to_pandas()
+    temp['Sigma0_VH_db_imputation']=temp.apply(lambda y: y['Sigma0_VH_db'] if y['weight']>0 else y['Sigma0_VH_db_interp'], axis=1)
+    temp['Sigma0_VV_db_imputation']=temp.apply(lambda y: y['Sigma0_VV_db'] if y['weight']>0 else y['Sigma0_VV_db_interp'], axis=1)
+    return temp[['periode', 'idpoint', 'MGRS', 'weight', 'Sigma0_VH_db_imputation','Sigma0_VV_db_imputation']]
+
+def synthetic_imputed(n_points, n_periods, seed=1234):
+    # Shape of the frame produced by process_tile, with about 20% missing acquisitions.
+    # n_periods is at most len(prepare_dates())
+    rng = np.random.default_rng(seed)
+    n = n_points * n_periods
+    weight = (rng.random(n) > 0.2).astype(np.int8)
+    vh = rng.normal(-15, 2, n)
+    vv = rng.normal(-8, 2, n)
+    return pl.DataFrame({
+        'periode': np.tile(np.array(prepare_dates()[:n_periods]), n_points),
+        'Sigma0_VH_db': vh * weight,
+        'Sigma0_VV_db': vv * weight,
+        'idpoint': np.repeat(np.array([f'{i // 9}#{i % 9 + 1}' for i in range(n_points)]), n_periods),
+        'MGRS': ['48MXU'] * n,
+        'weight': weight,
+        'Sigma0_VH_db_interp': vh + rng.normal(0, 0.5, n),
+        'Sigma0_VV_db_interp': vv + rng.normal(0, 0.5, n)
+    })
+
+def profile_compile(path, n_points, n_periods, output):
+    import resource
+    temp = synthetic_imputed(n_points, n_periods)
+    start_time = time.time()
+    if path == 'pandas':
+        with open(output, 'wb') as file:
+            pickle.dump(compile_imputation_pandas(temp), file)
+    else:
+        write_parquet_atomic(compile_imputation(temp), output)
+    seconds = time.time() - start_time
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, os.path.getsize(output) / 1024**2
+
+def benchmark_compile(n_points=200000, n_periods=None):
+    import tempfile
+    n_periods = n_periods or len(prepare_dates())
+    print('Benchmark compile for', n_points, 'idpoint x', n_periods, 'periode')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for path, output in [('pandas', f'{tmpdir}/out.pkl'), ('polars', f'{tmpdir}/out.parquet')]:
+            # Separate process per path so peak RSS is not shared between them
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                seconds, peak_mb, size_mb = executor.submit(profile_compile, path, n_points, n_periods, output).result()
+            print(f'{path:7s} --- {seconds:.2f} seconds --- peak RSS {peak_mb:.0f} MB --- output {size_mb:.0f} MB')
+        same = pl.read_parquet(f'{tmpdir}/out.parquet').to_pandas().equals(pd.read_pickle(f'{tmpdir}/out.pkl').reset_index(drop=True))
+        print('Identical output:', same)
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(manifest, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+def is_tile_done(kdprov, mgrs, entry):
+    if not storage.dataset_exists('imputation', province=kdprov, MGRS=mgrs):
+        return False
+    if entry is not None:
+        return entry['status'] == 'done'
+    # Output from a run before the manifest existed: only trust it if every parquet footer is readable
+    try:
+        for i in glob(f"{storage.partition_path('imputation', province=kdprov, MGRS=mgrs)}/*/*.parquet"):
+            pl.read_parquet_schema(i)
+        return True
+    except Exception:
+        return False
+
+def pool_size(pickle_prov, mem_factor=10):
+    # One process per core, capped by available memory assuming a tile needs
+    # about mem_factor times its pickle size while being imputed
+    n_cpu = os.cpu_count() or 1
+    largest = max(os.path.getsize(i) for i in pickle_prov)
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return n_cpu
+    return max(1, min(n_cpu, available // max(1, largest * mem_factor)))
+
+def impute_tile(ls_pickle, kdprov, list_date, mode='batch', num_workers=40):
+    mgrs = os.path.basename(ls_pickle).replace('.pkl', '').replace('sampling_', '')
+    start_time = time.time()
+    try:
+        dt_pkl = do_preparation(ls_pickle)
+        if mode == 'thread':
+            temp = process_threaded(dt_pkl, list_date, mgrs, num_workers)
+        else:
+            temp = process_tile(dt_pkl, list_date, mgrs)
+        storage.write_dataset(compile_imputation(temp).collect(), 'imputation', province=kdprov, MGRS=mgrs)
+        return {'status': 'done', 'seconds': time.time() - start_time, 'input_rows': dt_pkl.shape[0],
+                'output_rows': temp.shape[0], 'idpoint': int(dt_pkl['idpoint'].n_unique())}
+    except Exception as e:
+        return {'status': 'failed', 'seconds': time.time() - start_time, 'error': repr(e)}
+
+def main(kdprov, mode='batch', max_workers=None):
     print('=================================================')
     print('Begin Imputation for Province: ', kdprov)
+    print('Mode:', mode)
     pickle_prov = glob(f'/data/ksa/03_Sampling/data/{kdprov}/*.pkl')
     print('Found:', len(pickle_prov), 'data')
     list_date = prepare_dates()
-    num_workers = 40  # Adjust this based on your system's capability
-    
+    output_dir = f'/data/ksa/04_Data_Preprocessing/{kdprov}/01_imputation'
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = f'{output_dir}/manifest.json'
+    manifest = load_manifest(manifest_path)
+
+    todo = {}
     for i in pickle_prov:
         mgrs = os.path.basename(i).replace('.pkl', '').replace('sampling_', '')
-        output = f'/data/ksa/04_Data_Preprocessing/{kdprov}/01_imputation/{mgrs}_imputed_data.pkl'
-        print('-------------------------------------------------------')
-        if os.path.exists(output):
-            print(f'File {output} has been created')
-            print('Skip it')
+        output = storage.partition_path('imputation', province=kdprov, MGRS=mgrs)
+        if is_tile_done(kdprov, mgrs, manifest.get(mgrs)):
+            print(f'Output {output} has been created. Skip it')
+            manifest.setdefault(mgrs, {'status': 'done', 'input': i, 'output': output})
         else:
-            print('Start for:', i)
-            temp = pl.DataFrame()
-            dt_pkl = do_preparation(i)
-            list_idpoint = dt_pkl['idpoint'].unique().to_list()
-            temp_list = [temp]
-            
-            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-                results = list(tqdm(executor.map(process_idpoint, list_idpoint, [dt_pkl]*len(list_idpoint), [list_date]*len(list_idpoint), [mgrs]*len(list_idpoint)), total=len(list_idpoint)))
-            
-            temp = pl.concat([temp] + results)
-            print('Finish Imputation. Follow the results by compiling data.')
-            temp=temp.to_pandas()
-            temp['Sigma0_VH_db_imputation']=temp.apply(lambda y: y['Sigma0_VH_db'] if y['weight']>0 else y['Sigma0_VH_db_interp'], axis=1)
-            temp['Sigma0_VV_db_imputation']=temp.apply(lambda y: y['Sigma0_VV_db'] if y['weight']>0 else y['Sigma0_VV_db_interp'], axis=1)
-            with open(output, 'wb') as file:
-                pickle.dump(temp[['periode', 'idpoint', 'MGRS', 'weight', 'Sigma0_VH_db_imputation','Sigma0_VV_db_imputation']], file) 
-        print('-------------------------------------------------------')
+            todo[mgrs] = (i, output)
+    save_manifest(manifest, manifest_path)
+    if len(todo) == 0:
+        print('Finish')
+        print('=================================================')
+        return
+
+    if max_workers is None:
+        max_workers = pool_size([i for i, _ in todo.values()])
+    # In thread mode every process already runs its own thread pool
+    num_workers = 40 if max_workers == 1 else max(1, (os.cpu_count() or 1) // max_workers)
+    print('Tiles to process:', len(todo), 'with', max_workers, 'processes')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for mgrs, (i, output) in todo.items():
+            manifest[mgrs] = {'status': 'running', 'input': i, 'output': output}
+            futures[executor.submit(impute_tile, i, kdprov, list_date, mode, num_workers)] = mgrs
+        save_manifest(manifest, manifest_path)
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            mgrs = futures[future]
+            try:
+                manifest[mgrs].update(future.result())
+            except Exception as e:
+                # Worker died (BrokenProcessPool fails every tile still in the pool) or the result
+                # could not be returned: record it and go on, the next run resumes from the manifest
+                manifest[mgrs].update({'status': 'failed', 'seconds': 0.0, 'error': repr(e)})
+            save_manifest(manifest, manifest_path)
+            print('-------------------------------------------------------')
+            print(mgrs, manifest[mgrs]['status'], "--- %s seconds ---" % manifest[mgrs]['seconds'])
+    failed = [mgrs for mgrs in todo if manifest[mgrs]['status'] != 'done']
+    print('Failed:', failed)
     print('Finish')
     print('=================================================')
 
 if __name__ == "__main__":
-    kdprov = sys.argv[1]
-    main(kdprov)
+    if sys.argv[1] == 'benchmark':
+        benchmark(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif sys.argv[1] == 'benchmark_compile':
+        benchmark_compile(*[int(i) for i in sys.argv[2:4]])
+    else:
+        kdprov = sys.argv[1]
+        mode = sys.argv[2] if len(sys.argv) > 2 else 'batch'
+        max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        main(kdprov, mode, max_workers)
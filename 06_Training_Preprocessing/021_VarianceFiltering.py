@@ -0,0 +1,186 @@
+import polars as pl
+import pandas as pd
+from tqdm import tqdm
+import time
+import json
+import os
+import sys
+import storage
+from quantile_sketch import TDigest
+
+BANDS = {'Sigma0_VH_db_imputation': 'Sigma0VH', 'Sigma0_VV_db_imputation': 'Sigma0VV'}
+QUANTILES = {'p5': .05, 'p10': .1, 'p20': .2, 'p30': .3}
+
+def partial_variance(lf):
+    # Per (periode, idsubsegment) count, mean and sum of squared deviations of one tile,
+    # enough to merge tiles later without keeping their rows
+    lf = lf.with_columns(pl.col('idpoint').str.split('#').list.first().alias('idsubsegment'))
+    aggs = []
+    for col, name in BANDS.items():
+        aggs.extend([
+            pl.col(col).count().alias(f'{name}_n'),
+            pl.col(col).mean().alias(f'{name}_mean'),
+            ((pl.col(col) - pl.col(col).mean()) ** 2).sum().alias(f'{name}_m2')
+        ])
+    return lf.group_by(['periode', 'idsubsegment']).agg(aggs)
+
+def merge_variance(partials):
+    # Combine partial aggregates (Chan et al.) and return the sample variance (ddof=1),
+    # the same value as a group_by var() over all rows at once
+    aggs = []
+    for name in BANDS.values():
+        n, mean = pl.col(f'{name}_n'), pl.col(f'{name}_mean')
+        total_mean = (n * mean).sum() / n.sum()
+        aggs.extend([
+            n.sum().alias(f'{name}_n'),
+            (pl.col(f'{name}_m2').sum() + (n * (mean - total_mean) ** 2).sum()).alias(f'{name}_m2')
+        ])
+    merged = pl.concat(partials).group_by(['periode', 'idsubsegment']).agg(aggs)
+    return merged.select(['periode', 'idsubsegment'] + [
+        pl.when(pl.col(f'{name}_n') > 1).then(pl.col(f'{name}_m2') / (pl.col(f'{name}_n') - 1)).alias(f'{name}_variance')
+        for name in BANDS.values()
+    ])
+
+def compute_variance(kdprov):
+    # Peak memory is one tile plus the (periode, idsubsegment) partials collected so far
+    list_mgrs = storage.partition_values('imputation', 'MGRS', province=kdprov)
+    print('Found:', len(list_mgrs), 'MGRS')
+    partials = []
+    for mgrs in tqdm(list_mgrs):
+        lf = storage.scan_dataset('imputation', columns=['periode', 'idpoint'] + list(BANDS),
+                                  province=kdprov, MGRS=mgrs)
+        partials.append(partial_variance(lf).collect(engine='streaming'))
+    dt_var = merge_variance(partials)
+    return dt_var.with_columns(((pl.col('Sigma0VH_variance') / pl.col('Sigma0VV_variance')) / 2).alias('mean_var'))
+
+def attach_labels(dt_var):
+    bridging_ksa=pd.read_excel("/data/ksa/03_Sampling/bridging.xlsx", dtype='object')
+    df_label = pd.read_csv("/data/raw/processed/relabelled_data_ksa.csv",dtype='object')
+    df_label['idsubsegment']=df_label['id_x']
+    dt_var=dt_var.with_columns([
+        pl.col('periode').str.slice(4, 4).alias('periode_start'),
+        pl.col('periode').str.slice(2, 2).alias('tahun')
+    ]).sort(['idsubsegment','periode']).to_pandas()
+    dt_var=dt_var.merge(bridging_ksa.query('is_kabisat==0')[['periode_start','obs_in_a_year']])
+    dt_var['bulan']=dt_var['obs_in_a_year'].astype(str)
+    df_gab_var_class=dt_var[['periode','idsubsegment','mean_var','tahun','bulan']].merge(
+        df_label[['idsubsegment','tahun','bulan','obs']])
+    return df_gab_var_class.query('(tahun!="23") or (bulan not in ["11","10","12"])')
+
+def exact_quantiles(df_gab_var_class_test_train):
+    df_quantile=df_gab_var_class_test_train.groupby('obs')['mean_var'].quantile(list(QUANTILES.values())).unstack().reset_index()
+    df_quantile.columns=['obs']+list(QUANTILES)
+    return df_quantile
+
+def sketch_quantiles(sketches):
+    return pd.DataFrame([[obs]+list(sketch.quantile(list(QUANTILES.values()))) for obs, sketch in sketches.items()],
+                        columns=['obs']+list(QUANTILES))
+
+def flag_quantiles(df_gab_var_class_test_train, df_quantile):
+    df_full=df_gab_var_class_test_train.drop(columns=[c for c in df_gab_var_class_test_train.columns
+                                                      if c in QUANTILES or c.startswith('less_q')])
+    df_full=df_full.merge(df_quantile)
+    for name in QUANTILES:
+        df_full[f'less_q{name[1:]}']=df_full['mean_var']<df_full[name]
+    return df_full
+
+def sketch_path(kdprov):
+    return f'/data/ksa/04_Data_Preprocessing/{kdprov}/02_variance_filtering/quantile_sketch.json'
+
+def load_sketch_state(kdprov):
+    # Per-obs t-digests of mean_var and the periode already ingested per MGRS
+    if os.path.exists(sketch_path(kdprov)):
+        with open(sketch_path(kdprov), 'r') as f:
+            state = json.load(f)
+        return {obs: TDigest.from_dict(d) for obs, d in state['sketch'].items()}, state['ingested']
+    return {}, {}
+
+def save_sketch_state(kdprov, sketches, ingested):
+    path = sketch_path(kdprov)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'sketch': {obs: s.to_dict() for obs, s in sketches.items()}, 'ingested': ingested}, f)
+    os.replace(f'{path}.tmp', path)
+
+def update_sketches(sketches, df_gab_var_class_test_train):
+    for obs, values in df_gab_var_class_test_train.groupby('obs')['mean_var']:
+        sketches.setdefault(obs, TDigest()).update(values.to_numpy())
+    return sketches
+
+def ingested_periode(kdprov):
+    return {mgrs: storage.scan_dataset('imputation', columns=['periode'], province=kdprov, MGRS=mgrs)
+                         .unique().collect()['periode'].sort().to_list()
+            for mgrs in storage.partition_values('imputation', 'MGRS', province=kdprov)}
+
+def write_variance(df_full, kdprov):
+    # Never replace the table with an empty one
+    if df_full.shape[0] == 0:
+        raise ValueError(f'Empty variance filtering table for {kdprov}, not written')
+    storage.write_dataset(df_full, 'variance_filtering', province=kdprov)
+
+def incremental(kdprov):
+    # Only (MGRS, periode) not yet ingested are read from the imputation dataset. Their
+    # mean_var is added to the per-obs sketches and appended to the existing table, then
+    # every row's less_q* flags are refreshed against the updated thresholds. Subsegments
+    # split across MGRS keep the variance of the tile that arrived first until a full run.
+    if not os.path.exists(sketch_path(kdprov)) and storage.dataset_exists('variance_filtering', province=kdprov):
+        # Table without sketch state (e.g. right after migrate_pickles): rebuild both exactly
+        print('No sketch state for the existing table, running full')
+        return full(kdprov)
+    sketches, ingested = load_sketch_state(kdprov)
+    partials = {}
+    for mgrs in storage.partition_values('imputation', 'MGRS', province=kdprov):
+        done = ingested.get(mgrs, [])
+        lf = storage.scan_dataset('imputation', columns=['periode', 'idpoint'] + list(BANDS),
+                                  filters=~pl.col('periode').is_in(done), province=kdprov, MGRS=mgrs)
+        partial = partial_variance(lf).collect(engine='streaming')
+        if partial.shape[0] > 0:
+            partials[mgrs] = partial
+            print(mgrs, 'new periode:', partial['periode'].n_unique())
+    if len(partials) == 0:
+        print('Nothing new to ingest')
+        return None
+    dt_var = merge_variance(list(partials.values())).with_columns(
+        ((pl.col('Sigma0VH_variance') / pl.col('Sigma0VV_variance')) / 2).alias('mean_var'))
+    df_new = attach_labels(dt_var)
+    if storage.dataset_exists('variance_filtering', province=kdprov):
+        df_old = storage.read_dataset('variance_filtering', province=kdprov).to_pandas()
+        df_new = df_new.merge(df_old[['periode', 'idsubsegment']], how='left', indicator=True).query('_merge=="left_only"').drop(columns='_merge')
+        df_all = pd.concat([df_old, df_new], ignore_index=True)
+    else:
+        df_all = df_new
+    sketches = update_sketches(sketches, df_new)
+    for mgrs, partial in partials.items():
+        ingested[mgrs] = sorted(set(ingested.get(mgrs, [])) | set(partial['periode'].to_list()))
+    df_full = flag_quantiles(df_all, sketch_quantiles(sketches))
+    write_variance(df_full, kdprov)
+    save_sketch_state(kdprov, sketches, ingested)
+    return df_full
+
+def full(kdprov):
+    # Exact run over the whole province; also rebuilds the sketch state for later incremental runs
+    dt_var = compute_variance(kdprov)
+    print('Variance computed for', dt_var.shape[0], 'periode x idsubsegment')
+    df_gab_var_class_test_train = attach_labels(dt_var)
+    df_full = flag_quantiles(df_gab_var_class_test_train, exact_quantiles(df_gab_var_class_test_train))
+    write_variance(df_full, kdprov)
+    save_sketch_state(kdprov, update_sketches({}, df_gab_var_class_test_train), ingested_periode(kdprov))
+    return df_full
+
+def main(kdprov, mode='full'):
+    print('=================================================')
+    print('Begin Variance Filtering for Province: ', kdprov)
+    print('Mode:', mode)
+    start_time = time.time()
+    df_full = incremental(kdprov) if mode == 'incremental' else full(kdprov)
+    if df_full is not None:
+        for q in ['less_q5', 'less_q10', 'less_q20', 'less_q30']:
+            print(pd.pivot_table(df_full,index='obs',columns=[q],values='idsubsegment',aggfunc='count').reset_index())
+    print("--- %s seconds ---" % (time.time() - start_time))
+    print('Finish')
+    print('=================================================')
+
+if __name__ == "__main__":
+    kdprov = sys.argv[1]
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'full'
+    main(kdprov, mode)
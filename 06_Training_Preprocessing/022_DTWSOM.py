@@ -9,58 +9,85 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import sys
-def standardize_array(arr,axs):
-    # Calculate mean and std along the second axis (axis=1)
-    mean = np.mean(arr, axis=axs, keepdims=True)
-    std = np.std(arr, axis=axs, keepdims=True)
-    standardized_arr = (arr - mean) / std
-    return standardized_arr
+import time
+import storage
+import dtw_bmu
+from dtw_bmu import standardize_array
+import som_batch
 
-def som_run(kdprov):
-    print('===============================================')
-    print('READ THE DATA')
-    df_variabce=pd.read_pickle(f'/data/ksa/04_Data_Preprocessing/{kdprov}/02_variance_filtering/variance_filtering.pkl')
-    df_training_vh=pd.read_pickle(f'/data/ksa/04_Data_Preprocessing/training-test/{kdprov}/training_imputation_{kdprov}_VH.pkl')
-    df_training_vv=pd.read_pickle(f'/data/ksa/04_Data_Preprocessing/training-test/{kdprov}/training_imputation_{kdprov}_VV.pkl')
-    df_training_vh=pl.from_pandas(df_training_vh)
-    df_training_vv=pl.from_pandas(df_training_vv)
-    df_training_vv_var=df_training_vv.filter((pl.col("idsubsegment").is_in(df_variabce.idsubsegment)))
-    df_training_vh_var=df_training_vh.filter((pl.col("idsubsegment").is_in(df_variabce.idsubsegment)))
-    df_inner = df_training_vv_var.join(df_training_vh_var, on=['idpoint','idsubsegment','idsegment','nth',
-                                                           'periode','observation','class','MGRS'], how="inner")
-    df_select=df_inner.select(['idpoint','nth','MGRS',
-                               'periode','idsubsegment', 'VV_10', 'VV_9', 'VV_8', 'VV_7', 'VV_6', 'VV_5', 'VV_4', 'VV_3', 'VV_2', 'VV_1',
-                               'VV_0', 'VH_10', 'VH_9', 'VH_8', 'VH_7', 'VH_6', 'VH_5','VH_4', 'VH_3', 'VH_2', 'VH_1', 'VH_0'])
-    bridging_date=pd.read_excel("/data/ksa/03_Sampling/bridging.xlsx", dtype='object', sheet_name="periode_to_date")
-    df_variabce['periode_start']=df_variabce['periode'].apply(lambda y: y.split('_')[0][4:])
-    df_variabce['periode_end']=df_variabce['periode'].apply(lambda y: y.split('_')[1][4:])
-    df_variabce['tahun']=df_variabce['periode'].apply(lambda y: y[:4])
-    df_variabce=df_variabce.merge(bridging_date.query('is_kabisat==0')[['periode_start','periode_end','id_per_image']])
-    df_variabce['periode_y']=df_variabce.apply(lambda y: str(y.tahun)+'_'+str(y.id_per_image).zfill(2),axis=1)
-    df_variabce['periode_x']=df_variabce['periode']
-    df_variabce['periode']=df_variabce['periode_y']
-    print('FILTERING USING VARIANCE FILTERING')
-    df_10_variance=df_variabce.query('less_q10==True')
+BRIDGING_PATH = '/data/ksa/03_Sampling/bridging.xlsx'
+KEYS = ['idpoint','idsubsegment','idsegment','nth','periode','observation','class','MGRS']
+GROUP = ['idsubsegment','periode','obs']
+VV = [f'VV_{i}' for i in range(0,11)]
+VH = [f'VH_{i}' for i in range(0,11)]
+
+def read_bridging(bridging=None):
+    if bridging is None:
+        bridging = pd.read_excel(BRIDGING_PATH, dtype='object', sheet_name="periode_to_date").query('is_kabisat==0')
+    return pl.from_pandas(bridging[['periode_start','periode_end','id_per_image']].astype(str))
+
+def q10_pipeline(kdprov, bridging, root=storage.DATA_ROOT):
+    # Lazy: variance-filtered (q10) idsubsegment x periode ('YYYY_NN' as in the training windows) with obs
+    return (storage.scan_dataset('variance_filtering', root=root, province=kdprov)
+            .filter(pl.col('less_q10') == True)
+            .with_columns(periode_start=pl.col('periode').str.split('_').list.get(0).str.slice(4),
+                          periode_end=pl.col('periode').str.split('_').list.get(1).str.slice(4),
+                          tahun=pl.col('periode').str.slice(0, 4))
+            .join(bridging.lazy(), on=['periode_start','periode_end'], how='inner')
+            .select('idsubsegment', (pl.col('tahun') + '_' + pl.col('id_per_image').str.zfill(2)).alias('periode'), 'obs')
+            .drop_nulls()
+            .unique())
+
+def training_pipeline(kdprov, bridging, root=storage.DATA_ROOT):
+    # Lazy: VV/VH training windows (lag 0..10) of every point in the q10 selection, with obs
+    vv = storage.scan_dataset('training', columns=KEYS+VV, root=root, province=kdprov, polarization='VV')
+    vh = storage.scan_dataset('training', columns=KEYS+VH, root=root, province=kdprov, polarization='VH')
+    return (vv.join(vh, on=KEYS, how='inner')
+            .join(q10_pipeline(kdprov, bridging, root), on=['idsubsegment','periode'], how='inner'))
+
+def median_pipeline(kdprov, bridging, root=storage.DATA_ROOT):
+    # Lazy: median window per (idsubsegment, periode, obs)
+    return (training_pipeline(kdprov, bridging, root)
+            .group_by(GROUP)
+            .agg([pl.col(c).median() for c in VV+VH])
+            .sort(GROUP))
+
+def prepare_dtw(kdprov, standardize=True, bridging=None, root=storage.DATA_ROOT):
+    # Contiguous float32 (n, 2, 11) array (band 0 VV, band 1 VH, lag 0 first) of a 30% per-obs sample of the medians
+    start_time = time.time()
+    bridging = read_bridging(bridging)
     print('PREPARING DATA FOR DTW')
-    data_for_dtw=df_select.join(pl.from_dataframe(df_10_variance[['periode','idsubsegment','obs']]),
-               on=['idsubsegment','periode'],how='inner').to_pandas()
-    data_for_dtw_drop=data_for_dtw.drop(columns=['MGRS'],axis=1)
-    vv_median=data_for_dtw_drop.groupby(['idsubsegment','periode','obs'])[[f'VV_{i}' for i in range(0,11)]].agg('median').reset_index()
-    vh_median=data_for_dtw_drop.groupby(['idsubsegment','periode','obs'])[[f'VH_{i}' for i in range(0,11)]].agg('median').reset_index()
-    gab_median=vv_median.merge(vh_median)
-    gab_median.obs.value_counts()
+    gab_median = median_pipeline(kdprov, bridging, root).collect(engine='streaming').to_pandas()
     gab_median_frac=gab_median.groupby('obs').sample(frac=0.3,random_state=1234)
     print('CREATING ARRAY FOR DTW')
-    np_dtw=np.zeros((gab_median_frac.shape[0],2,11))
-    np_dtw[:,0,:]=gab_median_frac.iloc[:,:][[f'VV_{i}' for i in range(0,11)]].to_numpy()
-    np_dtw[:,1,:]=gab_median_frac.iloc[:,:][[f'VH_{i}' for i in range(0,11)]].to_numpy()
-    print('NORMALIZE')
-    np_dtw_std=standardize_array(np_dtw,2)
+    np_dtw=np.stack([gab_median_frac[VV].to_numpy(dtype=np.float64), gab_median_frac[VH].to_numpy(dtype=np.float64)], axis=1)
+    finite=np.isfinite(np_dtw).all(axis=(1,2))
+    if not finite.all():
+        print('Dropped samples with missing medians:', int((~finite).sum()))
+        np_dtw=np_dtw[finite]
+    if standardize:
+        print('NORMALIZE')
+        np_dtw=standardize_array(np_dtw,2)
+    np_dtw=np.ascontiguousarray(np_dtw, dtype=np.float32)
+    print('Samples:', np_dtw.shape, "--- %s seconds ---" % (time.time() - start_time))
+    return np_dtw
+
+def som_run(kdprov, engine='pruned', n_workers=4, standardize=True):
+    # engine: 'pruned' (dtw_bmu lower-bound BMU search, same BMUs), 'dtwsom' (som.train_batch) or
+    # 'batch' (som_batch: 100 epochs over all samples on n_workers processes, checkpointed / resumable)
+    print('===============================================')
+    np_dtw = prepare_dtw(kdprov, standardize)
     print('RUN SOM WITH DTW DISTANCE BASED')
     som=dtwsom.MultiDtwSom(20,20, np_dtw.shape[2], bands = np_dtw.shape[1], w=[.5,.5], sigma=1, learning_rate=0.3,
                    random_seed=42,gl_const="sakoe_chiba", scr=60)
     som.random_weights_init(np_dtw)
-    som.train_batch(np_dtw, 100, verbose=True)
+    if engine == 'pruned':
+        dtw_bmu.train_batch(som, np_dtw, 100, verbose=True)
+    elif engine == 'batch':
+        som_batch.train(som, np_dtw, 100, n_workers, checkpoint=f'/data/ksa/04_Data_Preprocessing/training-test/{kdprov}/som_checkpoint.npz',
+                        standardize=standardize)
+    else:
+        som.train_batch(np_dtw, 100, verbose=True)
     print('EXPORT THE RESULTS')
     with open(f'//data/ksa/04_Data_Preprocessing/training-test/{kdprov}/som_training_yy.pkl','wb') as file:
         pickle.dump(som,file)
@@ -68,9 +95,14 @@ def som_run(kdprov):
     print('===============================================')
     
 
-def main(kdprov):
-    som_run(kdprov)
+def main(kdprov, engine='pruned', n_workers=4, standardize=True):
+    som_run(kdprov, engine, n_workers, standardize)
 
 if __name__ == "__main__":
-    kdprov = sys.argv[1]
-    main(kdprov)
+    # python 022_DTWSOM.py <kdprov> [pruned|dtwsom|batch] [workers] [std|raw] | benchmark <kdprov>
+    if sys.argv[1] == 'benchmark':
+        dtw_bmu.benchmark(prepare_dtw(sys.argv[2]))
+    else:
+        kdprov = sys.argv[1]
+        main(kdprov, sys.argv[2] if len(sys.argv) > 2 else 'pruned', int(sys.argv[3]) if len(sys.argv) > 3 else 4,
+             not (len(sys.argv) > 4 and sys.argv[4] == 'raw'))
@@ -0,0 +1,256 @@
+import sys
+import time
+import math
+import numpy as np
+from numba import njit, prange
+from tqdm import tqdm
+import dtwsom
+
+# Best-matching-unit search for dtwsom.MultiDtwSom with lower-bound pruning. The activation of
+# neuron j for a sample x (bands, length) is sum_b w_b * dtw(x_b, W_jb) with tslearn's DTW
+# (square root of the accumulated squared cost inside the Sakoe-Chiba band). For every sample the
+# per-band lower bounds max(LB_Kim, LB_Keogh(x, env W_j), LB_Keogh(W_j, env x)) give a bound on
+# every neuron; neurons are visited by increasing bound and exact banded DTW stops as soon as the
+# bound exceeds the best distance found. The DTW recurrence does the same float64 operations as
+# tslearn and ties go to the lowest flat neuron index (argmin of the activation map), so the BMU
+# is the one som.winner returns. Exact DTW is abandoned as soon as a row of the cost matrix shows the
+# neuron cannot beat the best. Inputs must be finite (tslearn drops NaN, this does not).
+
+MARGIN = 1e-9  # relative slack so a bound equal to the best distance up to rounding is still evaluated
+
+@njit(cache=True)
+def dtw_cost(x, y, radius, acc, limit=np.inf):
+    # Accumulated squared cost of tslearn's DTW (equal lengths, band |i - j| <= radius); acc: (m + 1, m + 1)
+    # buffer. Every path crosses every row, so once a whole row costs more than limit the result is inf.
+    m = x.shape[0]
+    acc[:, :] = np.inf
+    acc[0, 0] = 0.0
+    for i in range(m):
+        row = np.inf
+        for j in range(max(0, i - radius), min(m, i + radius + 1)):
+            diff = x[i] - y[j]
+            acc[i + 1, j + 1] = diff * diff + min(acc[i, j + 1], acc[i + 1, j], acc[i, j])
+            row = min(row, acc[i + 1, j + 1])
+        if row > limit:
+            return np.inf
+    return acc[m, m]
+
+@njit(cache=True)
+def envelope(X, radius):
+    # Lower / upper envelope of every (series, band) over the band window
+    n, bands, m = X.shape
+    lower = np.empty_like(X)
+    upper = np.empty_like(X)
+    for s in range(n):
+        for b in range(bands):
+            for i in range(m):
+                lo = X[s, b, max(0, i - radius)]
+                hi = lo
+                for j in range(max(0, i - radius) + 1, min(m, i + radius + 1)):
+                    lo = min(lo, X[s, b, j])
+                    hi = max(hi, X[s, b, j])
+                lower[s, b, i] = lo
+                upper[s, b, i] = hi
+    return lower, upper
+
+@njit(cache=True)
+def lb_keogh(x, lower, upper):
+    total = 0.0
+    for i in range(x.shape[0]):
+        if x[i] > upper[i]:
+            total += (x[i] - upper[i]) ** 2
+        elif x[i] < lower[i]:
+            total += (x[i] - lower[i]) ** 2
+    return total
+
+@njit(cache=True)
+def lb_kim(x, y):
+    # The warping path always holds the first and the last cell
+    m = x.shape[0]
+    first = (x[0] - y[0]) ** 2
+    if m == 1:
+        return first
+    return first + (x[m - 1] - y[m - 1]) ** 2
+
+@njit(parallel=True, cache=True)
+def search(X, W, w, radius, prune):
+    # X: (n, bands, m) samples, W: (k, bands, m) neurons -> BMU flat index, distance, exact DTWs done
+    n, bands, m = X.shape
+    k = W.shape[0]
+    w_lower, w_upper = envelope(W, radius)
+    x_lower, x_upper = envelope(X, radius)
+    bmu = np.empty(n, dtype=np.int64)
+    dist = np.empty(n, dtype=np.float64)
+    evaluated = np.zeros(n, dtype=np.int64)
+    for s in prange(n):
+        acc = np.empty((m + 1, m + 1))
+        band_bound = np.zeros((k, bands))
+        bound = np.zeros(k)
+        if prune:
+            for j in range(k):
+                for b in range(bands):
+                    lb = max(lb_kim(X[s, b], W[j, b]), lb_keogh(X[s, b], w_lower[j, b], w_upper[j, b]),
+                             lb_keogh(W[j, b], x_lower[s, b], x_upper[s, b]))
+                    band_bound[j, b] = w[b] * math.sqrt(lb)
+                    bound[j] += band_bound[j, b]
+        order = np.argsort(bound)
+        best = np.inf
+        best_j = -1
+        for j in order:
+            if bound[j] > best * (1.0 + MARGIN):
+                break
+            d = 0.0
+            rest = bound[j]
+            for b in range(bands):
+                rest -= band_bound[j, b]
+                # Squared cost above which this band alone puts the neuron past the best
+                budget = best * (1.0 + MARGIN) - d - max(rest, 0.0)
+                limit = np.inf
+                if prune and best < np.inf and w[b] > 0:
+                    limit = (budget / w[b]) ** 2 * (1.0 + MARGIN) if budget >= 0 else -1.0
+                cost = dtw_cost(X[s, b], W[j, b], radius, acc, limit)
+                if cost == np.inf:
+                    d = np.inf
+                    break
+                d += w[b] * math.sqrt(cost)
+            evaluated[s] += 1
+            if d < best or (d == best and j < best_j):
+                best = d
+                best_j = j
+        bmu[s] = best_j
+        dist[s] = best
+    return bmu, dist, evaluated
+
+@njit(cache=True)
+def band_distances(X, W, bmu, radius):
+    # (n, bands) DTW of every sample to its BMU, per band
+    n, bands, m = X.shape
+    out = np.empty((n, bands))
+    acc = np.empty((m + 1, m + 1))
+    for s in range(n):
+        for b in range(bands):
+            out[s, b] = math.sqrt(dtw_cost(X[s, b], W[bmu[s], b], radius, acc))
+    return out
+
+############################################
+# MultiDtwSom glue
+def standardize_array(arr,axs):
+    # Calculate mean and std along the second axis (axis=1)
+    mean = np.mean(arr, axis=axs, keepdims=True)
+    std = np.std(arr, axis=axs, keepdims=True)
+    # Constant series have std 0: they become all zeros instead of NaN
+    std[std == 0] = 1
+    standardized_arr = (arr - mean) / std
+    return standardized_arr
+
+def som_weights(som):
+    # list of bands x (x, y, m) -> (x * y, bands, m), neurons in activation-map (flat) order
+    W = np.asarray(som._weights, dtype=np.float64)
+    return np.ascontiguousarray(W.transpose(1, 2, 0, 3).reshape(-1, W.shape[0], W.shape[3]))
+
+def som_radius(som, m):
+    if som.gl_const is None:
+        return m - 1
+    if som.gl_const == 'sakoe_chiba':
+        return int(min(som.scr, m - 1))
+    raise ValueError(f'Unsupported global constraint: {som.gl_const}')
+
+def as_samples(data):
+    X = np.ascontiguousarray(data, dtype=np.float64)
+    if X.ndim == 2:
+        X = X[None]
+    if not np.isfinite(X).all():
+        raise ValueError('Samples must be finite')
+    return X
+
+def bmu(som, data, prune=True):
+    # (flat BMU index, weighted DTW distance, exact DTWs evaluated) per sample of data (n, bands, m)
+    X = as_samples(data)
+    return search(X, som_weights(som), np.asarray(som._w, dtype=np.float64), som_radius(som, X.shape[2]), prune)
+
+def winner(som, x):
+    # Same (i, j) as som.winner(x)
+    index, _, _ = bmu(som, x)
+    return np.unravel_index(index[0], som._activation_map.shape)
+
+def quantization_error(som, data):
+    # Same value as som.quantization_error(data): mean per-band DTW to the BMU
+    X = as_samples(data)
+    W = som_weights(som)
+    radius = som_radius(som, X.shape[2])
+    index, _, _ = search(X, W, np.asarray(som._w, dtype=np.float64), radius, True)
+    return band_distances(X, W, index, radius).sum() / (X.shape[0] * X.shape[1])
+
+def train_batch(som, data, num_iteration, verbose=False):
+    # som.train_batch with the pruned BMU search (same sample order, same updates)
+    som._check_iteration_number(num_iteration)
+    som._check_input_len(data)
+    iterations = tqdm(range(num_iteration)) if verbose else range(num_iteration)
+    for iteration in iterations:
+        idx = iteration % (len(data) - 1)
+        som.update(data[idx], winner(som, data[idx]), iteration, num_iteration)
+    if verbose:
+        print(' - quantization error:', quantization_error(som, data))
+    return som
+
+############################################
+# Benchmark against som.winner (tslearn DTW to all neurons)
+def new_som(data, random_seed=42):
+    # 022_DTWSOM settings
+    som = dtwsom.MultiDtwSom(20, 20, data.shape[2], bands=data.shape[1], w=[.5, .5], sigma=1, learning_rate=0.3,
+                             random_seed=random_seed, gl_const="sakoe_chiba", scr=60)
+    som.random_weights_init(data)
+    return som
+
+def synthetic_samples(n=5000, seed=0):
+    # Standardized two-band series of length 11 around a few seasonal shapes
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 2 * np.pi, 11)
+    shapes = np.stack([np.sin(t + p) for p in rng.uniform(0, 2 * np.pi, 8)])
+    X = shapes[rng.integers(0, 8, (n, 2))] + rng.normal(0, 0.3, (n, 2, 11))
+    return (X - X.mean(axis=2, keepdims=True)) / X.std(axis=2, keepdims=True)
+
+def compare(som, data, label):
+    # Brute force vs pruned search on one map: identical BMUs / distances, times, share of exact DTWs
+    start_time = time.time()
+    full, full_dist, _ = bmu(som, data, prune=False)
+    full_seconds = time.time() - start_time
+    start_time = time.time()
+    pruned, pruned_dist, evaluated = bmu(som, data)
+    pruned_seconds = time.time() - start_time
+    print(label, 'exact DTW, all neurons --- %s seconds ---' % full_seconds)
+    print(label, 'LB pruned --- %s seconds --- exact DTW started on %.1f%% of neurons'
+          % (pruned_seconds, 100 * evaluated.sum() / (len(data) * som._activation_map.size)))
+    return pruned, pruned_dist, np.array_equal(pruned, full) and np.array_equal(pruned_dist, full_dist)
+
+def benchmark(data=None, n_reference=200, n_train=30):
+    data = synthetic_samples() if data is None else np.asarray(data, dtype=np.float64)
+    som = new_som(data)
+    print('Samples:', data.shape, 'Neurons:', som._activation_map.size)
+    bmu(som, data[:2])  # compile
+    start_time = time.time()
+    reference = []
+    reference_dist = []
+    for x in data[:n_reference]:
+        reference.append(np.ravel_multi_index(som.winner(x), som._activation_map.shape))
+        reference_dist.append(som._activation_map.min())
+    print('som.winner, %s samples --- %s seconds --- (%.0f s extrapolated)'
+          % (n_reference, time.time() - start_time, (time.time() - start_time) * len(data) / n_reference))
+    pruned, pruned_dist, same = compare(som, data, 'Initial map:')
+    same = same and np.array_equal(pruned[:n_reference], reference) and np.array_equal(pruned_dist[:n_reference], reference_dist)
+    # Training both ways must leave identical weights
+    som_a, som_b = new_som(data), new_som(data)
+    som_a.train_batch(data, n_train)
+    start_time = time.time()
+    train_batch(som_b, data, n_train)
+    print('train_batch, %s iterations --- %s seconds ---' % (n_train, time.time() - start_time))
+    trained = np.array_equal(som_weights(som_a), som_weights(som_b))
+    _, _, same_trained = compare(som_a, data, 'Trained map:')
+    print('BMU and distance bit-identical to som.winner:', same and same_trained)
+    print('Weights after %s train_batch iterations identical:' % n_train, trained)
+    return same and same_trained and trained
+
+if __name__ == "__main__":
+    # python dtw_bmu.py benchmark [n_samples]
+    if sys.argv[1] == 'benchmark':
+        benchmark(synthetic_samples(int(sys.argv[2]) if len(sys.argv) > 2 else 5000))
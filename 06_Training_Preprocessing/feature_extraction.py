@@ -0,0 +1,143 @@
+import math
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# The 17 phenology features of 06_Feature Extraction.ipynb computed on an (n, 32) array whose
+# column k is VH_k (VH_0 = observation period, VH_k = k periods before). Everything is
+# vectorized over rows and computed in float32; large inputs (e.g. a memory-mapped lag-window
+# tensor) are processed in row chunks. Inputs are expected to be finite (imputed series).
+
+FEATURES = [f'F{i}' for i in range(1, 18)]
+N_LAGS = 32
+CYCLE = 10
+
+def features_block(X):
+    # X: (n, 32) float32 -> (n, 17) float32
+    X = np.asarray(X, dtype=np.float32)
+    out = np.empty((X.shape[0], len(FEATURES)), dtype=np.float32)
+    eps = np.float32(1e-10)
+    cycle = X[:, :CYCLE]
+    vh0 = X[:, 0]
+    # Growth phase: last 10 periods (one growth cycle)
+    out[:, 0] = vh0
+    out[:, 1] = cycle.min(axis=1)
+    out[:, 2] = cycle.max(axis=1)
+    out[:, 3] = cycle.argmin(axis=1)
+    out[:, 4] = cycle.argmax(axis=1)
+    # Annual: last 32 periods
+    out[:, 5] = X.min(axis=1)
+    out[:, 6] = X.max(axis=1)
+    out[:, 7] = out[:, 6] - out[:, 5]
+    # F9: strict peaks + valleys along VH_0..VH_31, halved
+    sign = np.sign(np.diff(X, axis=1))
+    turns = ((sign[:, :-1] > 0) & (sign[:, 1:] < 0)) | ((sign[:, :-1] < 0) & (sign[:, 1:] > 0))
+    out[:, 8] = turns.sum(axis=1) // 2
+    # Slopes and their angles
+    out[:, 9] = vh0 - X[:, 1] + eps
+    out[:, 11] = (vh0 - out[:, 1] + eps) / (out[:, 3] + eps)
+    out[:, 13] = (vh0 - out[:, 2] + eps) / (out[:, 4] + eps)
+    out[:, 15] = vh0 - X[:, 10] + eps
+    out[:, [10, 12, 14, 16]] = np.arctan(out[:, [9, 11, 13, 15]])
+    return out
+
+def extract_features_array(X, chunk_size=200000):
+    # (n, 32) -> (n, 17) float32, chunk_size rows at a time
+    out = np.empty((X.shape[0], len(FEATURES)), dtype=np.float32)
+    for start in range(0, X.shape[0], chunk_size):
+        out[start:start + chunk_size] = features_block(X[start:start + chunk_size])
+    return out
+
+def lag_matrix(data, prefix='VH', n_lags=N_LAGS):
+    # Wide table -> (n, 32) float32 in lag order, whatever the column order of the table
+    return data[[f'{prefix}_{k}' for k in range(n_lags)]].to_numpy(dtype=np.float32)
+
+def from_windows(tensor, polarization=0, n_lags=N_LAGS):
+    # lag_windows tensor (samples, polarizations, n + 1), time order VH_n..VH_0 -> (n, 32) lag-order view.
+    # The features need VH_0..VH_31: build the windows with lag_windows n_lags=31 (its default 30 gives 31).
+    if tensor.shape[2] < n_lags:
+        raise ValueError(f'Lag windows have {tensor.shape[2]} periods, {n_lags} needed (lag_windows n_lags={n_lags - 1})')
+    return tensor[:, polarization, ::-1][:, :n_lags]
+
+def extract_features(data, prefix='VH', chunk_size=200000):
+    # Drop-in for the notebook function: adds F1..F17 to the wide table
+    features = extract_features_array(lag_matrix(data, prefix), chunk_size)
+    data = data.copy()
+    for i, name in enumerate(FEATURES):
+        data[name] = features[:, i]
+    for name in ['F4', 'F5', 'F9']:
+        data[name] = data[name].astype(int)
+    return data
+
+############################################
+# Reference: the notebook definitions, row-wise
+def extract_features_reference(data):
+    data[f'F1'] = data[f'VH_0']
+    data[f'F2'] = data.loc[:, f'VH_0':f'VH_9'].min(axis=1)
+    data[f'F3'] = data.loc[:, f'VH_0':f'VH_9'].max(axis=1)
+    data[f'F4'] = data.loc[:, f'VH_0':f'VH_9'].idxmin(axis=1)
+    data[f'F4'] = data[f'F4'].str.extract(r'VH_(\d+)')[0].astype(int)
+    data[f'F5'] = data.loc[:, f'VH_0':f'VH_9'].idxmax(axis=1)
+    data[f'F5'] = data[f'F5'].str.extract(r'VH_(\d+)')[0].astype(int)
+    data[f'F6'] = data.loc[:, f'VH_0':f'VH_31'].min(axis=1)
+    data[f'F7'] = data.loc[:, f'VH_0':f'VH_31'].max(axis=1)
+    data[f'F8'] = data[f'F7'] - data[f'F6']
+
+    def get_n(gelombang):
+        jumlah_gelombang = 0
+        for i in range(1, (len(gelombang) - 1)):
+            if (gelombang.iloc[i - 1] < gelombang.iloc[i]) and (gelombang.iloc[i] > gelombang.iloc[i + 1]):
+                jumlah_gelombang += 1
+            elif (gelombang.iloc[i - 1] > gelombang.iloc[i]) and (gelombang.iloc[i] < gelombang.iloc[i + 1]):
+                jumlah_gelombang += 1
+        return math.floor(jumlah_gelombang/2)
+
+    data[f'F9'] = data.loc[:, f'VH_0':f'VH_31'].apply(get_n, axis=1)
+    data[f'F10']=data.apply(lambda y: (y[f'VH_0']-y[f'VH_1']+1e-10),axis=1)
+    data[f'F11']=data.apply(lambda y: math.atan(y[f'F10']),axis=1)
+    data[f'F12']=data.apply(lambda y: (y[f'VH_0']-y[f'F2']+1e-10)/(y[f'F4']+1e-10),axis=1)
+    data[f'F13']=data.apply(lambda y: math.atan(y[f'F12']),axis=1)
+    data[f'F14']=data.apply(lambda y: (y[f'VH_0']-y[f'F3']+1e-10)/(y[f'F5']+1e-10),axis=1)
+    data[f'F15']=data.apply(lambda y: math.atan(y[f'F14']),axis=1)
+    data[f'F16']=data.apply(lambda y: (y[f'VH_0']-y[f'VH_10']+1e-10),axis=1)
+    data[f'F17']=data.apply(lambda y: math.atan(y[f'F16']),axis=1)
+    return data
+
+def synthetic_lags(n, seed=0):
+    # VH-like series (dB) with repeated values so ties in argmin/argmax and flat F9 steps occur
+    rng = np.random.default_rng(seed)
+    X = rng.normal(-15, 3, (n, N_LAGS)).astype(np.float32)
+    X[rng.random((n, N_LAGS)) < 0.1] = np.float32(-15.0)
+    return X
+
+def check_equivalence(n=5000):
+    # Reference on the same float32 values (upcast), integer features exact, the rest close
+    X = synthetic_lags(n)
+    df = pd.DataFrame(X.astype(np.float64), columns=[f'VH_{k}' for k in range(N_LAGS)])
+    expected = extract_features_reference(df.copy())[FEATURES].to_numpy()
+    got = extract_features_array(X, chunk_size=1000)
+    exact = np.array_equal(got[:, [3, 4, 8]], expected[:, [3, 4, 8]])
+    close = np.allclose(got, expected, rtol=1e-5, atol=1e-5)
+    print('Rows:', n, 'F4/F5/F9 identical:', exact, 'all features within 1e-5:', close,
+          'max abs diff: %.2e' % np.abs(got - expected).max())
+    return exact and close
+
+def benchmark(n=1000000, n_reference=20000):
+    X = synthetic_lags(n)
+    start_time = time.time()
+    extract_features_array(X)
+    vector_seconds = time.time() - start_time
+    df = pd.DataFrame(X[:n_reference].astype(np.float64), columns=[f'VH_{k}' for k in range(N_LAGS)])
+    start_time = time.time()
+    extract_features_reference(df)
+    reference_seconds = time.time() - start_time
+    print('Vectorized, %s rows --- %s seconds ---' % (n, vector_seconds))
+    print('Notebook, %s rows --- %s seconds --- (%.0f s extrapolated to %s rows)' % (n_reference, reference_seconds, reference_seconds * n / n_reference, n))
+
+if __name__ == "__main__":
+    # python feature_extraction.py check [n] | benchmark [n]
+    if sys.argv[1] == 'check':
+        check_equivalence(int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
+    elif sys.argv[1] == 'benchmark':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
@@ -0,0 +1,70 @@
+import numpy as np
+
+class TDigest:
+    # Mergeable quantile sketch (t-digest with the k1 scale function). Values are kept as
+    # (mean, weight) centroids, small near the tails and large around the median, so low
+    # quantiles such as p5/p10 stay accurate with a few hundred centroids.
+    def __init__(self, delta=500):
+        self.delta = delta
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def _scale(self, q):
+        return self.delta / (2 * np.pi) * np.arcsin(2 * np.clip(q, 0, 1) - 1)
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        if total == 0:
+            return
+        # Centroids whose cumulative-weight midpoint falls in the same unit of k-space are merged
+        q_mid = (np.cumsum(weights) - weights / 2) / total
+        bins = np.floor(self._scale(q_mid) - self._scale(0)).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+        return self
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)
+        centers = np.cumsum(self.weights) - self.weights / 2
+        x = np.r_[0, centers, self.count]
+        y = np.r_[self.min, self.means, self.max]
+        return np.interp(np.asarray(q) * self.count, x, y)
+
+    def to_dict(self):
+        return {'delta': self.delta, 'means': self.means.tolist(), 'weights': self.weights.tolist(),
+                'min': float(self.min), 'max': float(self.max)}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['delta'])
+        sketch.means = np.asarray(d['means'], dtype=float)
+        sketch.weights = np.asarray(d['weights'], dtype=float)
+        sketch.min, sketch.max = d['min'], d['max']
+        return sketch
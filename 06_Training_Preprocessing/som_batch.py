@@ -0,0 +1,218 @@
+import hashlib
+import os
+import sys
+import time
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import numba
+from numba import njit
+import dtw_bmu
+
+# Batch training of a dtwsom.MultiDtwSom over several processes. Each epoch every sample gets its
+# BMU (dtw_bmu pruned search), is warped onto the BMU's time axis along the DTW path (values
+# matched to the same position averaged, as in DTW_update) and added to that neuron's sum. Shards
+# of samples are read from one shared-memory block; the per-neuron sums S and counts N of all shards
+# are reduced in the parent and spread with the map's neighborhood at sigma(t):
+#     target_j = sum_c h(j, c) S_c / sum_c h(j, c) N_c,   W_j <- W_j + eta(t) (target_j - W_j)
+# with sigma(t), eta(t) the som's decay function over the epochs (same grid, band weights, sigma and
+# learning-rate schedule as som.train_batch, one epoch = all samples). Shards have a fixed size and
+# are reduced in order, so the codebook does not depend on the number of workers. The codebook is
+# checkpointed every checkpoint_every epochs and a run with an existing checkpoint resumes from it,
+# only if the checkpoint was written for the same samples (fingerprint) and standardize flag. The
+# checkpoint is removed once the last epoch is done, so a finished run is never resumed.
+
+SHARD_SIZE = 2000
+
+@njit(cache=True)
+def warp_to(x, y, radius, acc):
+    # x averaged onto the time axis of y along the DTW path (backtracked on the accumulated cost)
+    m = x.shape[0]
+    dtw_bmu.dtw_cost(x, y, radius, acc)
+    total = np.zeros(m)
+    count = np.zeros(m)
+    i = m - 1
+    j = m - 1
+    while True:
+        total[j] += x[i]
+        count[j] += 1
+        if i == 0 and j == 0:
+            break
+        if i == 0:
+            j -= 1
+        elif j == 0:
+            i -= 1
+        elif acc[i, j] <= acc[i, j + 1] and acc[i, j] <= acc[i + 1, j]:
+            i -= 1
+            j -= 1
+        elif acc[i, j + 1] <= acc[i + 1, j]:
+            i -= 1
+        else:
+            j -= 1
+    return total / count
+
+@njit(cache=True)
+def accumulate(X, W, bmu, radius):
+    # Per-neuron sums of the warped samples and sample counts
+    k, bands, m = W.shape
+    S = np.zeros((k, bands, m))
+    N = np.zeros(k)
+    acc = np.empty((m + 1, m + 1))
+    for s in range(X.shape[0]):
+        c = bmu[s]
+        N[c] += 1
+        for b in range(bands):
+            S[c, b] += warp_to(X[s, b], W[c, b], radius, acc)
+    return S, N
+
+def shard_sums(X, W, w, radius):
+    bmu, dist, _ = dtw_bmu.search(X, W, w, radius, True)
+    S, N = accumulate(X, W, bmu, radius)
+    return S, N, dist.sum()
+
+############################################
+# Worker side: samples attached from shared memory once per process
+DATA = None
+SHM = None
+
+def init_worker(name, shape, dtype):
+    global DATA, SHM
+    numba.set_num_threads(1)
+    SHM = SharedMemory(name=name)
+    DATA = np.ndarray(shape, dtype=dtype, buffer=SHM.buf)
+
+def shard_task(start, stop, W, w, radius):
+    return shard_sums(DATA[start:stop], W, w, radius)
+
+############################################
+# Trainer side
+def neighborhood_matrix(som, sigma):
+    # H[c, j]: neighborhood weight of neuron j for BMU c
+    shape = som._activation_map.shape
+    return np.stack([som.neighborhood(np.unravel_index(c, shape), sigma).ravel() for c in range(som._activation_map.size)])
+
+def set_weights(som, W):
+    # (x * y, bands, m) codebook back into the som (list of bands x (x, y, m))
+    x, y = som._activation_map.shape
+    som._weights = [np.array(W[:, b].reshape(x, y, W.shape[2])) for b in range(W.shape[1])]
+
+def fingerprint(X):
+    # Samples the checkpoint belongs to: shape and content
+    return hashlib.sha256(repr(X.shape).encode() + np.ascontiguousarray(X).tobytes()).hexdigest()
+
+def save_checkpoint(path, W, epoch, num_epoch, data_fingerprint, standardize=None):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp, weights=W, epoch=epoch, num_epoch=num_epoch, fingerprint=data_fingerprint, standardize=str(standardize))
+    os.replace(tmp, path)
+
+def load_checkpoint(path, shape, num_epoch, data_fingerprint, standardize=None):
+    with np.load(path) as f:
+        W, epoch, saved_epochs = f['weights'], int(f['epoch']), int(f['num_epoch'])
+        saved = (str(f['fingerprint']), str(f['standardize'])) if 'fingerprint' in f.files else None
+    if W.shape != shape or saved_epochs != num_epoch:
+        raise ValueError(f'Checkpoint {path} is for codebook {W.shape} / {saved_epochs} epochs, not {shape} / {num_epoch}')
+    # A finished run is never resumed (train ignores it), whatever it was written for
+    if epoch < num_epoch and saved != (data_fingerprint, str(standardize)):
+        raise ValueError(f'Checkpoint {path} was written for other samples or standardize setting '
+                         f'(standardize {saved[1] if saved else "unknown"}, not {standardize}); remove it to start again')
+    return W, epoch
+
+def train(som, data, num_epoch=100, n_workers=4, checkpoint=None, checkpoint_every=5, stop_epoch=None, verbose=True,
+          standardize=None):
+    # stop_epoch: return after that epoch (checkpointed), e.g. to split a long run over several jobs.
+    # standardize: how data was prepared, only recorded in / checked against the checkpoint.
+    X = dtw_bmu.as_samples(data)
+    data_fingerprint = fingerprint(X)
+    W = dtw_bmu.som_weights(som)
+    w = np.asarray(som._w, dtype=np.float64)
+    radius = dtw_bmu.som_radius(som, X.shape[2])
+    start_epoch = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        W_saved, saved_epoch = load_checkpoint(checkpoint, W.shape, num_epoch, data_fingerprint, standardize)
+        if saved_epoch >= num_epoch:
+            print('Checkpoint', checkpoint, 'is from a finished run, start from epoch 0')
+        else:
+            W, start_epoch = W_saved, saved_epoch
+            print('Resume from', checkpoint, 'epoch', start_epoch)
+    stop_epoch = num_epoch if stop_epoch is None else min(stop_epoch, num_epoch)
+    bounds = [(a, min(a + SHARD_SIZE, len(X))) for a in range(0, len(X), SHARD_SIZE)]
+
+    shm = SharedMemory(create=True, size=X.nbytes)
+    pool = None
+    try:
+        np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+        if n_workers > 1:
+            pool = ProcessPoolExecutor(n_workers, mp_context=mp.get_context('spawn'), initializer=init_worker,
+                                       initargs=(shm.name, X.shape, X.dtype.str))
+        for epoch in range(start_epoch, stop_epoch):
+            start_time = time.time()
+            if pool is None:
+                results = [shard_sums(X[a:b], W, w, radius) for a, b in bounds]
+            else:
+                results = [f.result() for f in [pool.submit(shard_task, a, b, W, w, radius) for a, b in bounds]]
+            S = np.zeros_like(W)
+            N = np.zeros(len(W))
+            error = 0.0
+            for s, n, e in results:
+                S += s
+                N += n
+                error += e
+            eta = som._decay_function(som._learning_rate, epoch, num_epoch)
+            sig = som._decay_function(som._sigma, epoch, num_epoch)
+            H = neighborhood_matrix(som, sig)
+            weight = H.T @ N
+            target = (H.T @ S.reshape(len(W), -1)).reshape(W.shape)
+            update = weight > 1e-12
+            W[update] += eta * (target[update] / weight[update, None, None] - W[update])
+            if verbose:
+                print('Epoch', epoch + 1, '/', num_epoch, 'mean BMU distance: %.5f' % (error / len(X)),
+                      'neurons hit:', int((N > 0).sum()), "--- %s seconds ---" % (time.time() - start_time))
+            if checkpoint is not None and epoch + 1 < num_epoch and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == stop_epoch):
+                save_checkpoint(checkpoint, W, epoch + 1, num_epoch, data_fingerprint, standardize)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        shm.close()
+        shm.unlink()
+    set_weights(som, W)
+    if checkpoint is not None and stop_epoch == num_epoch and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return som
+
+############################################
+# Check: workers and resume do not change the codebook
+def benchmark(data=None, num_epoch=4, n_workers=4):
+    import tempfile
+    data = dtw_bmu.synthetic_samples() if data is None else data
+    print('Samples:', data.shape)
+    start_time = time.time()
+    single = train(dtw_bmu.new_som(data), data, num_epoch, n_workers=1, verbose=False)
+    print('1 worker --- %s seconds ---' % (time.time() - start_time))
+    start_time = time.time()
+    parallel = train(dtw_bmu.new_som(data), data, num_epoch, n_workers=n_workers, verbose=False)
+    print(n_workers, 'workers --- %s seconds ---' % (time.time() - start_time))
+    with tempfile.TemporaryDirectory() as folder:
+        checkpoint = f'{folder}/som_checkpoint.npz'
+        train(dtw_bmu.new_som(data), data, num_epoch, n_workers=n_workers, checkpoint=checkpoint,
+              checkpoint_every=1, stop_epoch=num_epoch // 2, verbose=False)
+        try:
+            train(dtw_bmu.new_som(data), data[::-1], num_epoch, n_workers=n_workers, checkpoint=checkpoint, verbose=False)
+            refused = False
+        except ValueError:
+            refused = True
+        resumed = train(dtw_bmu.new_som(data), data, num_epoch, n_workers=n_workers, checkpoint=checkpoint, verbose=False)
+        cleared = not os.path.exists(checkpoint)
+    print('Checkpoint refused for other samples:', refused, 'removed after the last epoch:', cleared)
+    W = dtw_bmu.som_weights(single)
+    same = np.array_equal(W, dtw_bmu.som_weights(parallel)) and np.array_equal(W, dtw_bmu.som_weights(resumed))
+    print('Codebook identical (1 worker / %s workers / interrupted + resumed):' % n_workers, same)
+    print('Mean BMU distance after %s epochs: %.5f' % (num_epoch, dtw_bmu.bmu(single, data)[1].mean()))
+    return same and refused and cleared
+
+if __name__ == "__main__":
+    # python som_batch.py benchmark [n_samples] [workers]
+    if sys.argv[1] == 'benchmark':
+        benchmark(dtw_bmu.synthetic_samples(int(sys.argv[2]) if len(sys.argv) > 2 else 5000),
+                  n_workers=int(sys.argv[3]) if len(sys.argv) > 3 else 4)
@@ -0,0 +1,204 @@
+import importlib.util
+import os
+import shutil
+import sys
+import time
+import pickle
+import numpy as np
+import pandas as pd
+import polars as pl
+import numba
+import dtw_bmu
+
+# Batch inference with a trained DTW SOM (som_training_yy.pkl of 022_DTWSOM). SomIndex keeps only
+# the codebook, band weights and Sakoe-Chiba radius; samples (VV_0..VV_10, VH_0..VH_10 columns,
+# standardized per series as in training unless standardize=False) get their BMU and weighted DTW
+# distance from the lower-bound-pruned search of dtw_bmu, chunk_size samples at a time with numba
+# threads across the samples of a chunk. stream() goes over a DataFrame, a pickle or a lazy
+# Parquet scan batch by batch, optionally writes the assigned rows as Parquet parts and returns
+# per-neuron class counts / purity, so a province never has to be in memory at once.
+
+OUTPUT_DIR = '/data/ksa/04_Data_Preprocessing/training-test'
+VV = [f'VV_{i}' for i in range(0, 11)]
+VH = [f'VH_{i}' for i in range(0, 11)]
+SOM_COLUMNS = ['som_neuron', 'som_row', 'som_col', 'som_rep2', 'som_distance']
+
+class SomIndex:
+    def __init__(self, weights, shape, w, radius, standardize=True, chunk_size=100000, n_threads=None):
+        # weights: (neurons, bands, length) in activation-map (flat) order
+        self.weights = np.ascontiguousarray(weights, dtype=np.float64)
+        self.shape = tuple(shape)
+        self.w = np.asarray(w, dtype=np.float64)
+        self.radius = int(radius)
+        self.standardize = standardize
+        self.chunk_size = chunk_size
+        if n_threads is not None:
+            numba.set_num_threads(n_threads)
+
+    @classmethod
+    def from_som(cls, som, **kwargs):
+        weights = dtw_bmu.som_weights(som)
+        return cls(weights, som._activation_map.shape, som._w, dtw_bmu.som_radius(som, weights.shape[2]), **kwargs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, 'rb') as file:
+            return cls.from_som(pickle.load(file), **kwargs)
+
+    @property
+    def labels(self):
+        # 'R{row}C{col}' of every neuron, as som_rep2 in 023_SOM_FILTERING
+        rows, cols = np.unravel_index(np.arange(len(self.weights)), self.shape)
+        return np.array([f'R{i}C{j}' for i, j in zip(rows, cols)])
+
+    def samples(self, df):
+        # (n, 2, 11) float64 array of a Polars frame: band 0 VV, band 1 VH, lag 0 first
+        X = np.stack([df.select(VV).to_numpy().astype(np.float64), df.select(VH).to_numpy().astype(np.float64)], axis=1)
+        if self.standardize:
+            X = dtw_bmu.standardize_array(X, 2)
+        return X
+
+    def query(self, X):
+        # BMU flat index and distance per sample; samples with missing values get -1 / NaN
+        neuron = np.full(len(X), -1, dtype=np.int64)
+        distance = np.full(len(X), np.nan)
+        for start in range(0, len(X), self.chunk_size):
+            chunk = np.ascontiguousarray(X[start:start + self.chunk_size], dtype=np.float64)
+            ok = np.isfinite(chunk).all(axis=(1, 2))
+            if ok.any():
+                index, dist, _ = dtw_bmu.search(np.ascontiguousarray(chunk[ok]), self.weights, self.w, self.radius, True)
+                neuron[start:start + len(chunk)][ok] = index
+                distance[start:start + len(chunk)][ok] = dist
+        return neuron, distance
+
+    def assign(self, df):
+        # df (Polars or pandas) + som_neuron, som_row, som_col, som_rep2, som_distance
+        if isinstance(df, pd.DataFrame):
+            df = pl.from_pandas(df)
+        neuron, distance = self.query(self.samples(df))
+        hit = neuron >= 0
+        rows, cols = np.unravel_index(np.where(hit, neuron, 0), self.shape)
+        return df.with_columns(pl.Series('som_neuron', neuron),
+                               pl.Series('som_row', np.where(hit, rows, -1)),
+                               pl.Series('som_col', np.where(hit, cols, -1)),
+                               pl.Series('som_rep2', np.where(hit, self.labels[np.where(hit, neuron, 0)], None)),
+                               pl.Series('som_distance', distance))
+
+    def stream(self, source, label='obs', output=None, keep=None, batch_rows=500000):
+        # Assign every batch of source; with output, assigned rows (keep columns + SOM columns) go to
+        # output/part-NNNNN.parquet. Parts are written to a fresh folder that replaces output at the
+        # end, so parts of an earlier run never mix in. Returns the per-neuron purity table.
+        counts = []
+        n_rows = 0
+        start_time = time.time()
+        if output is not None:
+            tmp = f'{output}.{os.getpid()}.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+        try:
+            for part, batch in enumerate(iter_batches(source, batch_rows)):
+                assigned = self.assign(batch)
+                n_rows += assigned.height
+                counts.append(assigned.filter(pl.col('som_neuron') >= 0)
+                              .group_by(['som_neuron', label])
+                              .agg(pl.len().alias('n'), pl.col('som_distance').sum().alias('distance')))
+                if output is not None:
+                    base = keep if keep is not None else [c for c in assigned.columns if c not in VV + VH]
+                    columns = [c for c in base if c not in SOM_COLUMNS] + SOM_COLUMNS
+                    assigned.select(columns).write_parquet(f'{tmp}/part-{part:05d}.parquet')
+                print('Batch', part, 'rows:', assigned.height, 'total:', n_rows,
+                      '--- %.0f rows/s ---' % (n_rows / (time.time() - start_time)))
+        except BaseException:
+            if output is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        if output is not None:
+            shutil.rmtree(output, ignore_errors=True)
+            os.replace(tmp, output)
+        if len(counts) == 0:
+            return None
+        counts = pl.concat(counts).group_by(['som_neuron', label]).agg(pl.col('n').sum(), pl.col('distance').sum())
+        return self.purity(counts.to_pandas(), label)
+
+    def purity(self, counts, label='obs'):
+        # counts: som_neuron, label, n, distance (sum) -> one row per neuron hit: share of every class,
+        # samples, mean distance, dominant class and its share (purity)
+        table = counts.pivot_table(index='som_neuron', columns=label, values='n', aggfunc='sum', fill_value=0)
+        n = table.sum(axis=1)
+        share = table.div(n, axis=0) * 100
+        share.columns = [f'pct_{c}' for c in share.columns]
+        out = pd.concat([table, share], axis=1)
+        out['n'] = n
+        out['mean_distance'] = counts.groupby('som_neuron')['distance'].sum() / n
+        out['dominant'] = table.idxmax(axis=1)
+        out['purity'] = table.max(axis=1) / n
+        out.insert(0, 'som_rep2', self.labels[out.index.to_numpy()])
+        return out.reset_index()
+
+def iter_batches(source, batch_rows=500000):
+    # Polars batches of a DataFrame, a pickle path (read once, pickles cannot be streamed),
+    # a Parquet path / glob or a LazyFrame (streamed)
+    if isinstance(source, str) and source.endswith('.pkl'):
+        source = pd.read_pickle(source)
+    if isinstance(source, str):
+        source = pl.scan_parquet(source)
+    if isinstance(source, pd.DataFrame):
+        source = pl.from_pandas(source)
+    if isinstance(source, pl.DataFrame):
+        yield from source.iter_slices(batch_rows)
+    else:
+        yield from source.collect_batches(chunk_size=batch_rows)
+
+def training_module():
+    # 022_DTWSOM.py, for the training selection the SOM was built on
+    spec = importlib.util.spec_from_file_location('dtwsom_training', os.path.join(os.path.dirname(os.path.abspath(__file__)), '022_DTWSOM.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main(kdprov, n_threads=None, standardize=True):
+    # Every q10 training window of the province (as in 023_SOM_FILTERING) through the trained SOM
+    print('===============================================')
+    start_time = time.time()
+    folder = f'{OUTPUT_DIR}/{kdprov}'
+    index = SomIndex.load(f'{folder}/som_training_yy.pkl', standardize=standardize, n_threads=n_threads)
+    training = training_module()
+    source = training.training_pipeline(kdprov, training.read_bridging())
+    purity = index.stream(source, output=f'{folder}/som_winner')
+    purity.to_pickle(f'{folder}/som_purity.pkl')
+    print('Neurons hit:', purity.shape[0], 'mean purity: %.3f' % purity.purity.mean(),
+          'quantization error: %.5f' % ((purity.mean_distance * purity.n).sum() / purity.n.sum()))
+    print("--- %s seconds ---" % (time.time() - start_time))
+    print('===============================================')
+
+############################################
+# Check against som.winner and one-shot assignment
+def check(n=20000, n_reference=100):
+    import tempfile
+    data = dtw_bmu.synthetic_samples(n)
+    som = dtw_bmu.new_som(data)
+    rng = np.random.default_rng(0)
+    df = pl.DataFrame({'idpoint': [f'P{i:07d}' for i in range(n)], 'obs': rng.choice(['1.0', '2.0', '3.0'], n)})
+    df = df.with_columns([pl.Series(c, data[:, 0, i]) for i, c in enumerate(VV)] + [pl.Series(c, data[:, 1, i]) for i, c in enumerate(VH)])
+    index = SomIndex.from_som(som, standardize=False, chunk_size=3000)
+    assigned = index.assign(df)
+    reference = [som.winner(x) for x in data[:n_reference]]
+    same = [tuple(r) for r in assigned.select('som_row', 'som_col').head(n_reference).rows()] == [tuple(map(int, r)) for r in reference]
+    with tempfile.TemporaryDirectory() as folder:
+        df.write_parquet(f'{folder}/input.parquet', row_group_size=5000)
+        # A stale part from an earlier, longer run must not survive
+        os.makedirs(f'{folder}/out')
+        df.head(10).write_parquet(f'{folder}/out/part-99999.parquet')
+        purity = index.stream(f'{folder}/input.parquet', output=f'{folder}/out', batch_rows=4000)
+        streamed = pl.read_parquet(f'{folder}/out/*.parquet').sort('idpoint')
+    same_stream = streamed.height == n and streamed.select(SOM_COLUMNS).equals(assigned.sort('idpoint').select(SOM_COLUMNS))
+    print('BMU same as som.winner:', same, 'streamed same as one-shot:', same_stream,
+          'samples in purity table:', int(purity.n.sum()), '/', n)
+    return same and same_stream and purity.n.sum() == n
+
+if __name__ == "__main__":
+    # python som_index.py <kdprov> [threads] [std|raw] | check [n]
+    if sys.argv[1] == 'check':
+        check(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+    else:
+        main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None, not (len(sys.argv) > 3 and sys.argv[3] == 'raw'))
@@ -0,0 +1,123 @@
+import polars as pl
+import pandas as pd
+from glob import glob
+import os
+import shutil
+import sys
+
+DATA_ROOT = '/data/ksa/parquet'
+
+# Partition keys (key=value directories) of every pipeline intermediate, in directory order.
+# 'year' is derived from the first four characters of 'periode'.
+DATASETS = {
+    'sampling': ['province', 'MGRS', 'year'],
+    'imputation': ['province', 'MGRS', 'year'],
+    'training': ['province', 'polarization', 'year'],
+    'variance_filtering': ['province', 'year'],
+}
+
+def partition_path(dataset, root=DATA_ROOT, **partitions):
+    # Directory for the leading partitions given, e.g. partition_path('imputation', province='32', MGRS='48MXU')
+    path = f'{root}/{dataset}'
+    for key in DATASETS[dataset]:
+        if key not in partitions:
+            break
+        path = f'{path}/{key}={partitions[key]}'
+    return path
+
+def write_dataset(df, dataset, root=DATA_ROOT, **partitions):
+    # Write a Polars/pandas frame under its partition directory, one file per year.
+    # The whole partition is written to a hidden temp directory and swapped in with a rename,
+    # so readers and dataset_exists never see a partial write, and years not in df are removed.
+    if isinstance(df, pd.DataFrame):
+        df = pl.from_pandas(df)
+    keys = DATASETS[dataset]
+    missing = [k for k in keys if k != 'year' and k not in partitions]
+    if missing:
+        raise ValueError(f'Missing partition value for {dataset}: {missing}')
+    if 'year' in keys and 'year' not in partitions and 'periode' in df.columns:
+        groups = df.with_columns(pl.col('periode').cast(pl.Utf8).str.slice(0, 4).alias('year')).partition_by('year', as_dict=True)
+        groups = {k[0]: v.drop('year') for k, v in groups.items()}
+    else:
+        groups = {partitions.get('year', 'all'): df}
+    target = partition_path(dataset, root, **partitions)
+    # Hidden names (leading dot) are not matched by the key=* globs of scan_dataset / partition_values
+    parent, name = os.path.split(target)
+    tmp, old = f'{parent}/.{name}.{os.getpid()}.tmp', f'{parent}/.{name}.{os.getpid()}.old'
+    shutil.rmtree(tmp, ignore_errors=True)
+    written = []
+    try:
+        os.makedirs(tmp)
+        for year, part in groups.items():
+            path = tmp if 'year' in partitions else f'{tmp}/year={year}'
+            os.makedirs(path, exist_ok=True)
+            part.write_parquet(f'{path}/part-0.parquet', statistics=True)
+            written.append(f"{target if 'year' in partitions else f'{target}/year={year}'}/part-0.parquet")
+        if os.path.exists(target):
+            os.replace(target, old)
+        os.replace(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(old, ignore_errors=True)
+    return written
+
+def scan_dataset(dataset, columns=None, filters=None, root=DATA_ROOT, **partitions):
+    # Lazy frame over a dataset. Partition values given here prune directories before
+    # anything is opened; columns and filters are pushed down into the Parquet scan.
+    # Files keep their original columns, so partition keys are not added to the frame.
+    keys = DATASETS[dataset]
+    pattern = f'{root}/{dataset}'
+    for key in keys:
+        pattern = f'{pattern}/{key}={partitions[key]}' if key in partitions else f'{pattern}/{key}=*'
+    files = sorted(glob(f'{pattern}/*.parquet'))
+    if len(files) == 0:
+        raise FileNotFoundError(f'No parquet files for {dataset} {partitions} under {root}')
+    lf = pl.scan_parquet(files, hive_partitioning=False)
+    if filters is not None:
+        lf = lf.filter(filters)
+    if columns is not None:
+        lf = lf.select(columns)
+    return lf
+
+def read_dataset(dataset, columns=None, filters=None, root=DATA_ROOT, **partitions):
+    return scan_dataset(dataset, columns, filters, root, **partitions).collect()
+
+def partition_values(dataset, key, root=DATA_ROOT, **partitions):
+    # Values present on disk for one partition key, e.g. every MGRS of a province
+    return sorted(os.path.basename(i).split('=', 1)[1] for i in glob(f'{partition_path(dataset, root, **partitions)}/{key}=*'))
+
+def dataset_exists(dataset, root=DATA_ROOT, **partitions):
+    return len(glob(f'{partition_path(dataset, root, **partitions)}/**/*.parquet', recursive=True)) > 0
+
+def migrate_pickles(kdprov, root=DATA_ROOT):
+    # Convert the pickled intermediates of a province into the partitioned Parquet layout
+    print('=================================================')
+    print('Migrate pickles for Province: ', kdprov)
+    jobs = []
+    for i in glob(f'/data/ksa/03_Sampling/data/{kdprov}/*.pkl'):
+        mgrs = os.path.basename(i).replace('.pkl', '').replace('sampling_', '')
+        jobs.append((i, 'sampling', {'province': kdprov, 'MGRS': mgrs}))
+    for i in glob(f'/data/ksa/04_Data_Preprocessing/{kdprov}/01_imputation/*_imputed_data.pkl'):
+        mgrs = os.path.basename(i).replace('_imputed_data.pkl', '')
+        jobs.append((i, 'imputation', {'province': kdprov, 'MGRS': mgrs}))
+    for pol in ['VH', 'VV']:
+        i = f'/data/ksa/04_Data_Preprocessing/training-test/{kdprov}/training_imputation_{kdprov}_{pol}.pkl'
+        if os.path.exists(i):
+            jobs.append((i, 'training', {'province': kdprov, 'polarization': pol}))
+    i = f'/data/ksa/04_Data_Preprocessing/{kdprov}/02_variance_filtering/variance_filtering.pkl'
+    if os.path.exists(i):
+        jobs.append((i, 'variance_filtering', {'province': kdprov}))
+    print('Found:', len(jobs), 'pickles')
+    for i, dataset, partitions in jobs:
+        if dataset_exists(dataset, root, **partitions):
+            print(f'{dataset} {partitions} has been migrated. Skip it')
+            continue
+        print('Convert:', i)
+        write_dataset(pd.read_pickle(i), dataset, root, **partitions)
+    print('Finish')
+    print('=================================================')
+
+if __name__ == "__main__":
+    if sys.argv[1] == 'migrate':
+        migrate_pickles(sys.argv[2])
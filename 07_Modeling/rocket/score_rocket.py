@@ -0,0 +1,211 @@
+import importlib.util
+import os
+import shutil
+import sys
+import time
+import joblib
+import numpy as np
+import pandas as pd
+import polars as pl
+
+# Bulk scoring with the joblib'd MiniRocket pipelines of this folder (make_pipeline(MiniRocket,
+# RidgeClassifier), e.g. minirocket_ridge_tuned_model.pkl). The pipeline is loaded once; VH windows
+# (VH_0..VH_30, lag 0 first, as in the training tables) go to MiniRocket as a float32 (n, 1, 31)
+# NumPy panel instead of from_2d_array_to_nested (same features, no nested DataFrame), batch_rows
+# rows at a time, with MiniRocket's numba kernels on n_jobs threads (-1: all cores). For linear
+# heads the class scores are features @ coef_.T + intercept_ in float64 (decision_function of the
+# Ridge / SGD classifier) and the prediction is the class with the highest score. Windows with
+# missing values get a null prediction and NaN scores. A province is scored from the training
+# dataset (storage, VH polarization) or from the imputed data cubes at one period, and written as
+# Parquet parts of idpoint (+ periode / MGRS), prediction and score_<class>, with rows/s reported.
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(MODEL_DIR, '..', '..')
+OUTPUT_DIR = '/data/ksa/07_Modeling/rocket'
+MODEL = 'minirocket_ridge_tuned_model.pkl'
+N_LAGS = 31
+VH = [f'VH_{i}' for i in range(0, N_LAGS)]
+KEYS = ['idpoint', 'periode', 'MGRS']
+
+def repo_module(folder, filename, name):
+    # Module of another pipeline folder (which imports its siblings by plain name)
+    path = os.path.join(REPO_DIR, folder)
+    if path not in sys.path:
+        sys.path.append(path)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def classes(head):
+    # RidgeClassifier keeps its classes in the label binarizer
+    if hasattr(head, 'classes_'):
+        return np.asarray(head.classes_)
+    return np.asarray(head._label_binarizer.classes_)
+
+class RocketScorer:
+    def __init__(self, pipeline, n_jobs=-1, batch_rows=100000):
+        steps = [step for _, step in pipeline.steps] if hasattr(pipeline, 'steps') else [pipeline]
+        if len(steps) != 2:
+            raise ValueError(f'Expected a (transformer, classifier) pipeline, got {len(steps)} steps')
+        self.transformer, self.head = steps
+        # MiniRocket sets the numba threads from n_jobs at every transform (set_params would reset the fit)
+        self.transformer.n_jobs = n_jobs
+        self.classes = classes(self.head)
+        self.batch_rows = batch_rows
+        if hasattr(self.head, 'coef_'):
+            self.coef = np.asarray(self.head.coef_, dtype=np.float64).T
+            self.intercept = np.asarray(self.head.intercept_, dtype=np.float64)
+        else:
+            self.coef = None
+
+    @classmethod
+    def load(cls, model=MODEL, **kwargs):
+        path = model if os.path.isabs(model) else os.path.join(MODEL_DIR, model)
+        return cls(joblib.load(path), **kwargs)
+
+    @property
+    def score_columns(self):
+        if self.coef is not None and self.coef.shape[1] == 1:
+            return [f'score_{self.classes[1]}']
+        return [f'score_{c}' for c in self.classes]
+
+    def features(self, X):
+        # (n, 31) windows -> (n, features) MiniRocket features
+        X = np.ascontiguousarray(X, dtype=np.float32)[:, None, :]
+        return np.asarray(self.transformer.transform(X))
+
+    def head_scores(self, F):
+        if self.coef is None:
+            return self.head.predict_proba(F)
+        return F.astype(np.float64) @ self.coef + self.intercept
+
+    def predict_block(self, X):
+        # Finite (n, 31) windows -> (prediction, scores)
+        scores = self.head_scores(self.features(X))
+        if scores.shape[1] == 1:
+            return self.classes[(scores[:, 0] > 0).astype(int)], scores
+        return self.classes[scores.argmax(axis=1)], scores
+
+    def predict(self, X):
+        # (n, 31) windows in lag order -> prediction (null where missing), scores (NaN where missing)
+        X = np.asarray(X, dtype=np.float32)
+        ok = np.isfinite(X).all(axis=1)
+        prediction = np.full(len(X), None, dtype=object)
+        scores = np.full((len(X), len(self.score_columns)), np.nan)
+        rows = np.flatnonzero(ok)
+        for start in range(0, len(rows), self.batch_rows):
+            sel = rows[start:start + self.batch_rows]
+            prediction[sel], scores[sel] = self.predict_block(X[sel])
+        return prediction, scores
+
+    def score(self, df, keep=KEYS):
+        # Polars / pandas frame with VH_0..VH_30 -> keep columns + prediction + score_<class>
+        if isinstance(df, pd.DataFrame):
+            df = pl.from_pandas(df)
+        prediction, scores = self.predict(df.select(VH).to_numpy())
+        out = df.select([c for c in keep if c in df.columns])
+        return out.with_columns([pl.Series('prediction', prediction.tolist())] +
+                                [pl.Series(c, scores[:, i].astype(np.float32)) for i, c in enumerate(self.score_columns)])
+
+    def stream(self, batches, output, keep=KEYS):
+        # Score every batch into output/part-NNNNN.parquet; returns rows scored. Parts go to a fresh
+        # folder that replaces output at the end, so parts of an earlier run never mix in.
+        tmp = f'{output}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        n_rows = 0
+        start_time = time.time()
+        try:
+            for part, batch in enumerate(batches):
+                batch_time = time.time()
+                scored = self.score(batch, keep)
+                scored.write_parquet(f'{tmp}/part-{part:05d}.parquet')
+                n_rows += scored.height
+                print('Batch', part, 'rows:', scored.height, 'total:', n_rows,
+                      '--- %.0f rows/s --- (%.0f rows/s overall)' % (scored.height / (time.time() - batch_time), n_rows / (time.time() - start_time)))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        shutil.rmtree(output, ignore_errors=True)
+        os.replace(tmp, output)
+        return n_rows
+
+############################################
+# Sources
+def training_batches(kdprov, batch_rows=100000):
+    # VH windows of the province's training dataset, streamed
+    storage = repo_module('06_Training_Preprocessing', 'storage.py', 'storage')
+    scan = storage.scan_dataset('training', columns=KEYS + VH, province=kdprov, polarization='VH')
+    yield from scan.collect_batches(chunk_size=batch_rows)
+
+def cube_windows(cube, periode):
+    # (points, 31) VH windows ending at periode (VH_0 = periode) from an imputed data cube
+    pos = cube.period_pos[periode]
+    if pos < N_LAGS - 1:
+        raise ValueError(f'{periode} has only {pos + 1} periods of history, {N_LAGS} needed')
+    block = cube.read(periods=cube.periods[pos - N_LAGS + 1:pos + 1])
+    return block[:, ::-1, cube.polarizations.index('VH')]
+
+def cube_batches(kdprov, periode, batch_rows=100000):
+    # One province at one period: every MGRS cube of the imputation, batch_rows points at a time
+    data_cube = repo_module('03_Data_Cube', 'data_cube.py', 'data_cube')
+    folder = f'{data_cube.CUBE_ROOT}/imputation/{kdprov}'
+    for mgrs in sorted(os.listdir(folder)):
+        cube = data_cube.open_cube(kdprov, mgrs, dataset='imputation')
+        X = cube_windows(cube, periode)
+        idpoint = cube.idpoint.to_numpy()
+        for start in range(0, len(X), batch_rows):
+            stop = min(start + batch_rows, len(X))
+            yield pl.DataFrame({'idpoint': idpoint[start:stop], 'periode': [periode] * (stop - start), 'MGRS': [mgrs] * (stop - start)}).with_columns(
+                [pl.Series(c, X[start:stop, i]) for i, c in enumerate(VH)])
+
+def main(kdprov, periode=None, model=MODEL, n_jobs=-1, batch_rows=100000):
+    # Without periode: every training window of the province; with periode: the whole imputed cube
+    print('===============================================')
+    start_time = time.time()
+    scorer = RocketScorer.load(model, n_jobs=n_jobs, batch_rows=batch_rows)
+    print('Model:', model, 'classes:', list(scorer.classes))
+    name = os.path.splitext(os.path.basename(model))[0]
+    if periode is None:
+        n_rows = scorer.stream(training_batches(kdprov, batch_rows), f'{OUTPUT_DIR}/{kdprov}/{name}/training')
+    else:
+        n_rows = scorer.stream(cube_batches(kdprov, periode, batch_rows), f'{OUTPUT_DIR}/{kdprov}/{name}/{periode}')
+    seconds = time.time() - start_time
+    print('Rows scored:', n_rows, '--- %.0f rows/s ---' % (n_rows / seconds))
+    print("--- %s seconds ---" % seconds)
+    print('===============================================')
+
+############################################
+# Check against the notebook route (nested DataFrame through the whole pipeline)
+def check(model=MODEL, n=5000, n_jobs=-1):
+    from sktime.datatypes._panel._convert import from_2d_array_to_nested
+    rng = np.random.default_rng(0)
+    X = rng.normal(-15, 3, (n, N_LAGS)).astype(np.float32)
+    X[0, 5] = np.nan
+    scorer = RocketScorer.load(model, n_jobs=n_jobs, batch_rows=2000)
+    scorer.predict(X[1:10])  # compile
+    start_time = time.time()
+    reference = np.asarray(scorer.transformer.transform(from_2d_array_to_nested(X[1:])))
+    reference_scores = scorer.head.decision_function(reference) if scorer.coef is not None else scorer.head.predict_proba(reference)
+    reference_seconds = time.time() - start_time
+    start_time = time.time()
+    prediction, scores = scorer.predict(X)
+    seconds = time.time() - start_time
+    expected = reference_scores.reshape(len(reference), -1)
+    same_features = np.array_equal(scorer.features(X[1:]), reference)
+    same_prediction = np.array_equal(prediction[1:].astype(scorer.classes.dtype), scorer.classes[expected.argmax(axis=1)]) if expected.shape[1] > 1 else True
+    close = np.allclose(scores[1:], expected, rtol=1e-4, atol=1e-4)
+    print('Nested DataFrame, %s rows --- %s seconds --- %.0f rows/s' % (n - 1, reference_seconds, (n - 1) / reference_seconds))
+    print('3D NumPy, %s rows --- %s seconds --- %.0f rows/s' % (n, seconds, n / seconds))
+    print('Features identical:', same_features, 'predictions identical:', same_prediction,
+          'scores within 1e-4:', close, 'missing window -> null:', prediction[0] is None)
+    return same_features and same_prediction and close and prediction[0] is None
+
+if __name__ == "__main__":
+    # python score_rocket.py <kdprov> [periode|training] [model] [n_jobs] | check [model] [n]
+    if sys.argv[1] == 'check':
+        check(sys.argv[2] if len(sys.argv) > 2 else MODEL, int(sys.argv[3]) if len(sys.argv) > 3 else 5000)
+    else:
+        main(sys.argv[1], None if len(sys.argv) < 3 or sys.argv[2] == 'training' else sys.argv[2],
+             sys.argv[3] if len(sys.argv) > 3 else MODEL, int(sys.argv[4]) if len(sys.argv) > 4 else -1)